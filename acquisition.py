@@ -0,0 +1,201 @@
+#  python3.8 som environment
+import asyncio
+import csv
+import random
+from pathlib import Path
+from buildup_graph import BUILDUPGRAPH
+
+"""
+Live acquisition of bridge balances. A bridge is anything with an async readings() generator yielding
+(key, (alpha, beta)) as each balance is found, e.g. ('r11', (0.01357, -0.17217)) during a build up or ('s3', ...)
+during a permutable capacitor run. SIMULATEDBRIDGE plays back the rows of an in.csv or perm.csv style file with a
+settling delay. A session reads from the bridge and computes at the same time: readings are queued as they arrive
+and every calculation runs in a worker thread, so the next instrument wait overlaps it. Only the capacitors that
+depend on the new readings are recomputed (BUILDUPGRAPH with partial=True).
+"""
+
+
+class SIMULATEDBRIDGE(object):
+    def __init__(self, balances, **kwargs):
+        """
+        :param balances: dictionary of key: (alpha, beta), in the order they are to be read
+        :param kwargs: delay= seconds to settle each balance (default 0.1), noise= standard deviation added to each
+        dial reading (default 0), seed= for the noise
+        """
+        self.balances = balances
+        self.delay = 0.1
+        self.noise = 0.0
+        seed = None
+        for arg in kwargs.keys():
+            if arg == 'delay':
+                self.delay = kwargs[arg]
+            elif arg == 'noise':
+                self.noise = kwargs[arg]
+            elif arg == 'seed':
+                seed = kwargs[arg]
+        self.random = random.Random(seed)
+
+    async def readings(self):
+        for key in self.balances:
+            await asyncio.sleep(self.delay)  # the operator or auto-balance finding the null
+            alpha, beta = self.balances[key]
+            if self.noise > 0:
+                alpha = alpha + self.random.gauss(0, self.noise)
+                beta = beta + self.random.gauss(0, self.noise)
+            yield key, (alpha, beta)
+
+
+def file_balances(file_name, keys):
+    """
+    :param file_name: full name of an in.csv or perm.csv style file
+    :param keys: the balance keys wanted, e.g. r1 to r15 or s1 to s12
+    :return: dictionary of key: (alpha, beta) in file order, for SIMULATEDBRIDGE
+    """
+    balances = {}
+    with open(Path(file_name), newline='') as csvfile:
+        for row in csv.reader(csvfile):
+            if row and row[0] in keys:
+                balances[row[0]] = (float(row[1]), float(row[2]))
+    return balances
+
+
+class BUILDUPSESSION(object):
+    def __init__(self, scale, **kwargs):
+        """
+        :param scale: a meas_cap_ratio.CAPSCALE object, before buildup(), whose ratio factors, main ratio, reference
+        and components are used
+        :param kwargs: fresh= True (default) to forget the balances read from the run file so that nothing depending on
+        a balance is computed before it is read, callback= function(names, scale) called after each update with the
+        capacitors recomputed, workers= threads for the independent branches of the graph update
+        """
+        self.scale = scale
+        fresh = True
+        self.callback = None
+        self.workers = None
+        for arg in kwargs.keys():
+            if arg == 'fresh':
+                fresh = kwargs[arg]
+            elif arg == 'callback':
+                self.callback = kwargs[arg]
+            elif arg == 'workers':
+                self.workers = kwargs[arg]
+        self.graph = BUILDUPGRAPH(scale)
+        if fresh:
+            scale.balance_dict = {}
+        self.updates = []  # (readings in the update, nodes recomputed)
+
+    def update(self):
+        return self.graph.update(partial=True, workers=self.workers)
+
+    async def consume(self, queue):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.update)  # whatever needs no balance, e.g. c1
+        finished = False
+        while not finished:
+            keys = []
+            key, balance = await queue.get()
+            while True:  # take every reading that came in during the last calculation
+                if key is None:
+                    finished = True
+                else:
+                    self.graph.set_balance(key, balance)
+                    keys.append(key)
+                if queue.empty():
+                    break
+                key, balance = queue.get_nowait()
+            if keys:
+                names = await loop.run_in_executor(None, self.update)
+                self.updates.append((keys, names))
+                if self.callback is not None:
+                    self.callback([x for x in names if x in self.scale.caps], self.scale)
+        return
+
+    async def run(self, bridge):
+        """
+        Reads the bridge to the end, computing as the balances arrive
+        :param bridge: object with an async readings() generator
+        :return: list of the keys of the capacitors that still lack a balance
+        """
+        queue = asyncio.Queue()
+        consumer = asyncio.ensure_future(self.consume(queue))
+        try:
+            async for key, balance in bridge.readings():
+                await queue.put((key, balance))
+        finally:
+            await queue.put((None, None))
+            await consumer
+        return [x for x in self.graph.dirty if x in self.scale.caps]
+
+
+class PERMUTESESSION(object):
+    def __init__(self, ratio_cal, **kwargs):
+        """
+        :param ratio_cal: a cal_main_ratio.PERMUTE object
+        :param kwargs: fresh= True (default) to forget the switch positions read from the run file, callback=
+        function(main ratio, ratio_cal) called once the ratio has been calculated
+        """
+        self.ratio_cal = ratio_cal
+        fresh = True
+        self.callback = None
+        for arg in kwargs.keys():
+            if arg == 'fresh':
+                fresh = kwargs[arg]
+            elif arg == 'callback':
+                self.callback = kwargs[arg]
+        if fresh:
+            ratio_cal.balance_dict = {}
+        self.main_ratio = None
+
+    def calculate(self):
+        main_ratio = self.ratio_cal.correct_ratio(self.ratio_cal.calc_raw_ratio())
+        self.main_ratio = self.ratio_cal.correct_ratio(main_ratio)  # applied twice, as by cal_main_ratio.py
+        return self.main_ratio
+
+    async def run(self, bridge):
+        """
+        Reads the bridge to the end. The ratio is worked out in a thread as soon as s1 to s11 are in, while s12 (the
+        repeat of s1) is still being balanced.
+        :param bridge: object with an async readings() generator
+        :return: ucomplex main ratio, or None if some of s1 to s11 were never read
+        """
+        loop = asyncio.get_running_loop()
+        needed = ['s%d' % i for i in range(1, 12)]
+        pending = None
+        late = {}  # readings that come in while the ratio is being calculated from balance_dict
+        async for key, balance in bridge.readings():
+            if pending is None:
+                self.ratio_cal.balance_dict[key] = balance
+                if all(x in self.ratio_cal.balance_dict for x in needed):
+                    pending = loop.run_in_executor(None, self.calculate)
+            else:
+                late[key] = balance
+        if pending is None:
+            return None
+        await pending
+        self.ratio_cal.balance_dict.update(late)
+        if self.callback is not None:
+            self.callback(self.main_ratio, self.ratio_cal)
+        return self.main_ratio
+
+
+if __name__ == '__main__':
+    from GTC import ureal
+    from meas_cap_ratio import CAPSCALE
+    import time
+    print('Testing acquisition.py')
+    w = 1e4
+    cap = 99.999581e-12
+    g = ureal(1.9e-6 * w * cap, 0.6e-6 / 2 * w * cap, 50, label='ah11c1d')
+    c = ureal(cap, cap * 0.11e-6 / 2, 50, label='ah11c1c')
+    folder = Path('G:\\My Drive\\KJ\\PycharmProjects\\CapacitanceScale\\datastore')
+    scale = CAPSCALE(folder, ['in.csv', 'leads_and_caps.csv'], 'out.csv', g + 1j * w * c)
+    bridge = SIMULATEDBRIDGE(file_balances(folder / 'in.csv', ['r%d' % i for i in range(1, 16)]), delay=0.05)
+    start = time.perf_counter()
+
+    def show(names, scale):
+        for x in names:
+            print("{:8.3f} s {:^10} {:.8f} pF".format(time.perf_counter() - start, x,
+                                                      scale.caps[x].best_value.imag.x / w * 1e12))
+
+    session = BUILDUPSESSION(scale, callback=show)
+    print('waiting on', asyncio.run(session.run(bridge)))
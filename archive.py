@@ -1,11 +1,11 @@
 #  python3.8 som environment
 from GTC import ureal, ucomplex
 from json import dumps, loads
+from pathlib import Path
+import copy
 import csv
+import hashlib
 from components import LEAD, CAPACITOR
-# imports below are just testing related
-from GTC.reporting import budget  # just for checks
-from math import pi, sqrt  # just for some number creation
 
 
 class GTCSTORE(object):
@@ -117,6 +117,60 @@ class GTCSTORE(object):
             input_file_name.close()
         return input_list
 
+    def iter_gtc(self, gtc_file, **kwargs):
+        """
+        Generator version of read_gtc that yields one row at a time, so only the current row is held in memory
+        :param gtc_file: full name of a csv file
+        :param kwargs: keys= collection of first column values wanted; other rows are skipped and reading stops as
+        soon as every key has been found
+        :return: yields rows as lists of strings
+        """
+        keys = None
+        for arg in kwargs.keys():
+            if arg == 'keys':
+                keys = set(kwargs[arg])
+        with open(gtc_file, newline='') as input_file_name:
+            reader = csv.reader(input_file_name)
+            for row in reader:
+                if keys is None:
+                    yield row
+                elif row and row[0] in keys:
+                    yield row
+                    keys.discard(row[0])
+                    if not keys:
+                        return
+
+    def iter_gtc_real(self, gtc_file, **kwargs):
+        """
+        Generator version of read_gtc_real
+        :param gtc_file: full name of a csv file of single json strings, as written by save_gtc_real
+        :param kwargs: labels= collection of labels wanted; reading stops as soon as every label has been found
+        :return: yields gtc uncertain reals
+        """
+        labels = None
+        for arg in kwargs.keys():
+            if arg == 'labels':
+                labels = set(kwargs[arg])
+        for row in self.iter_gtc(gtc_file):
+            unr_dict = loads(row[0])
+            if labels is None:
+                yield self.dict_to_ureal(unr_dict)
+            elif unr_dict['label'] in labels:
+                yield self.dict_to_ureal(unr_dict)
+                labels.discard(unr_dict['label'])
+                if not labels:
+                    return
+
+    def iter_gtc_complex(self, gtc_file, **kwargs):
+        """
+        Reads [key, json string] rows of uncertain complex values (e.g. the lead network rows of perm.csv)
+        :param gtc_file: full name of a csv file
+        :param kwargs: keys= as for iter_gtc
+        :return: yields (key, gtc uncertain complex) tuples
+        """
+        for row in self.iter_gtc(gtc_file, **kwargs):
+            yield row[0], self.json_to_ucomplex(row[1])
+
     def ucomplex_to_dict(self, unc, **kwargs):
         """
         Turns a GTC uncertain complex into a dictionary of its parts suitable for json storage.
@@ -170,6 +224,7 @@ class GTCSTORE(object):
 class COMPONENTSTORE(object):
     def __init__(self):
         self.gs = GTCSTORE()
+        self.indexes = {}  # file name: (size, modification time, index entries)
 
     def lead_to_dict(self, lead):
         to_store = {'relu': lead.relu, 'w': lead.w, 'label': lead.label, 'z': self.gs.ucomplex_to_json(lead.z),
@@ -218,7 +273,224 @@ class COMPONENTSTORE(object):
 
         return recovered_cap
 
+    def iter_component_dicts(self, file_name, **kwargs):
+        """
+        Lazily reads a csv file of [key, json string] rows such as leads_and_caps.csv
+        :param file_name: full name of the csv file
+        :param kwargs: keys= collection of the components wanted; reading stops as soon as every key has been found
+        :return: yields (key, dictionary) tuples in the form of lead_to_dict or capacitor_to_dict
+        """
+        for row in self.gs.iter_gtc(file_name, **kwargs):
+            yield row[0], loads(row[1])
+
+    def build_index(self, file_name):
+        """
+        Records the byte offset, length and sha1 hash of every row of a [key, json string] csv file. The index is
+        written next to the csv file (e.g. leads_and_caps.csv.idx) together with the size and modification time of
+        the file it describes. Rows must not contain line breaks, which is always true of files written here.
+        :param file_name: full name of the csv file
+        :return: dictionary of key: [offset, length, sha1 hex digest]
+        """
+        entries = {}
+        offset = 0
+        with open(file_name, 'rb') as csvfile:
+            for line in csvfile:
+                row = next(csv.reader([line.decode()]), None)
+                if row:
+                    entries[row[0]] = [offset, len(line), hashlib.sha1(line).hexdigest()]
+                offset += len(line)
+        stat = Path(file_name).stat()
+        self.indexes[str(file_name)] = (stat.st_size, stat.st_mtime_ns, entries)
+        try:
+            with open(str(file_name) + '.idx', 'w') as index_file:
+                index_file.write(dumps({'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'entries': entries}))
+        except OSError:  # e.g. a read only folder, the index is then only kept in memory
+            pass
+        return entries
+
+    def load_index(self, file_name):
+        """
+        Returns the index of a csv file, from memory or the .idx file if they still match the size and modification
+        time of the csv file, otherwise by rebuilding it
+        :param file_name: full name of the csv file
+        :return: dictionary of key: [offset, length, sha1 hex digest]
+        """
+        stat = Path(file_name).stat()
+        known = self.indexes.get(str(file_name))
+        if known is not None and known[:2] == (stat.st_size, stat.st_mtime_ns):
+            return known[2]
+        try:
+            with open(str(file_name) + '.idx') as index_file:
+                stored = loads(index_file.read())
+            if (stored['size'], stored['mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+                self.indexes[str(file_name)] = (stat.st_size, stat.st_mtime_ns, stored['entries'])
+                return stored['entries']
+        except (OSError, ValueError, KeyError):
+            pass
+        return self.build_index(file_name)
+
+    def read_row(self, csvfile, entry):
+        """
+        :param csvfile: csv file opened in binary mode
+        :param entry: [offset, length, sha1 hex digest] from the index
+        :return: the row as a list of strings, or None if the content no longer matches the hash
+        """
+        csvfile.seek(entry[0])
+        line = csvfile.read(entry[1])
+        if hashlib.sha1(line).hexdigest() != entry[2]:
+            return None
+        return next(csv.reader([line.decode()]))
+
+    def file_version(self, file_name):
+        """
+        :param file_name: full name of the csv file
+        :return: (size, modification time), which change whenever the file is written (see COMPONENTREGISTRY)
+        """
+        stat = Path(file_name).stat()
+        return stat.st_size, stat.st_mtime_ns
+
+    def lookup(self, file_name, keys):
+        """
+        Finds components through the index, i.e. one seek and one json decode per key. A stale index is rebuilt.
+        :param file_name: full name of the csv file
+        :param keys: collection of the keys wanted, any not in the file are left out
+        :return: dictionary of key: dictionary in the form of lead_to_dict or capacitor_to_dict
+        """
+        for attempt in range(2):
+            entries = self.load_index(file_name)
+            found = {}
+            with open(file_name, 'rb') as csvfile:
+                for x in keys:
+                    if x in entries:
+                        row = self.read_row(csvfile, entries[x])
+                        if row is None:
+                            break
+                        found[x] = loads(row[1])
+                else:
+                    return found
+            self.build_index(file_name)  # file changed without changing its size or time stamp
+        raise ValueError('index of %s does not match its content' % file_name)
+
+    def find_component(self, file_name, key):
+        """
+        :param file_name: full name of the csv file
+        :param key: key of a lead or capacitor
+        :return: dictionary in the form of lead_to_dict or capacitor_to_dict
+        """
+        found = self.lookup(file_name, [key])
+        if key not in found:
+            raise KeyError('%r not found in %s' % (key, file_name))
+        return found[key]
+
+    def read_components(self, file_name, cap_list, lead_list):
+        """
+        Recovers CAPACITOR and LEAD objects from a csv file of [key, json string] rows such as leads_and_caps.csv
+        :param file_name: full name of the csv file
+        :param cap_list: keys of the capacitors wanted
+        :param lead_list: keys of the leads wanted
+        :return: dictionaries of CAPACITOR and LEAD objects, keyed as in the file
+        """
+        caps = {}
+        leads = {}
+        found = self.lookup(file_name, list(cap_list) + list(lead_list))
+        for x in found:
+            filed = found[x]
+            if x in cap_list:
+                caps[x] = self.dict_to_capacitor(filed)
+            else:
+                leads[x] = self.dict_to_lead(filed)
+        return caps, leads
+
+
+class COMPONENTREGISTRY(object):
+    def __init__(self, **kwargs):
+        """
+        Cache of recovered LEAD and CAPACITOR objects keyed by file name and version (size and modification time),
+        so that a chain of DIALCAL, PERMUTE and CAPSCALE in one process reads and reconstructs each component only
+        once. Capacitors are handed out as shallow copies as the build up changes their best_value and leads; the
+        GTC values inside them are shared.
+        :param kwargs: storecomp= the store that reads the component files (default COMPONENTSTORE, or e.g. a
+        sqlite_store.SQLITESTORE for a database file)
+        """
+        self.storecomp = COMPONENTSTORE()
+        for arg in kwargs.keys():
+            if arg == 'storecomp':
+                self.storecomp = kwargs[arg]
+        self.files = {}  # resolved file name: (version, {key: LEAD or CAPACITOR})
+        self.hits = 0
+        self.misses = 0
+
+    def objects(self, file_name, keys):
+        """
+        :param file_name: full name of a [key, json string] csv file such as leads_and_caps.csv (or whatever file
+        storecomp reads)
+        :param keys: collection of the keys wanted, any not in the file are left out
+        :return: dictionary of the cached (not copied) LEAD and CAPACITOR objects
+        """
+        version = self.storecomp.file_version(file_name)
+        name = str(Path(file_name).resolve())
+        known = self.files.get(name)
+        if known is None or known[0] != version:  # new or changed file
+            known = (version, {})
+            self.files[name] = known
+        cached = known[1]
+        missing = [x for x in keys if x not in cached]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            found = self.storecomp.lookup(file_name, missing)
+            for x in found:
+                if 'nom_cap' in found[x]:
+                    cached[x] = self.storecomp.dict_to_capacitor(found[x])
+                else:
+                    cached[x] = self.storecomp.dict_to_lead(found[x])
+        recovered = {}
+        for x in keys:
+            if x in cached:
+                recovered[x] = cached[x]
+        return recovered
+
+    def components(self, file_name, cap_list, lead_list):
+        """
+        Drop in for COMPONENTSTORE.read_components
+        :param file_name: full name of the csv file
+        :param cap_list: keys of the capacitors wanted
+        :param lead_list: keys of the leads wanted
+        :return: dictionaries of CAPACITOR (copies) and LEAD objects
+        """
+        found = self.objects(file_name, list(cap_list) + list(lead_list))
+        caps = {}
+        leads = {}
+        for x in found:
+            if x in cap_list:
+                caps[x] = copy.copy(found[x])
+            else:
+                leads[x] = found[x]
+        return caps, leads
+
+    def capacitor(self, file_name, key):
+        """
+        :param file_name: full name of the csv file
+        :param key: key of a capacitor
+        :return: a copy of the CAPACITOR object
+        """
+        caps, leads = self.components(file_name, [key], [])
+        if key not in caps:
+            raise KeyError('%r not found in %s' % (key, file_name))
+        return caps[key]
+
+    def clear(self):
+        self.files = {}
+        self.hits = 0
+        self.misses = 0
+        return
+
+
+registry = COMPONENTREGISTRY()  # pass as registry= to DIALCAL, PERMUTE and CAPSCALE to share components
+
 if __name__ == '__main__':
+    from GTC.reporting import budget  # just for checks
+    from math import pi, sqrt  # just for some number creation
     bits = COMPONENTSTORE()
     w = 1e4
     hv1 = LEAD('ah11hv1', (286e-3, 0.782e-6), (0.28e-9, 255.2e-12), w, 0.05)
@@ -0,0 +1,202 @@
+#  python3.8 som environment
+from archive import GTCSTORE, COMPONENTSTORE
+from meas_cap_ratio import CAPSCALE
+from GTC import persistence, result
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import copy
+import csv
+import multiprocessing
+
+"""
+Reprocesses many build up runs, each in its own in.csv style file, against one leads and capacitors file.
+"""
+
+
+def process_run(file_path, run_file, component_file, output_file_name, ref_value):
+    """
+    Builds up one run in a worker process. The reference comes in as a GTC archive (json) of ref_value, which keeps
+    its elementary inputs (e.g. ah11c1c and ah11c1d with their degrees of freedom), or as a picklable function of the
+    date. The best values go back the same way, as a json string that is not restored in the parent. Workers are
+    spawned, not forked, so each has a GTC context of its own and the uids in the archive are its own. Components
+    are shared between the runs handled by the same process through archive.registry.
+    :return: rows as for BATCHSCALE.results and a GTC archive (json) of the best values
+    """
+    from archive import registry
+    store = GTCSTORE()
+    scale = CAPSCALE(file_path, [run_file, component_file], output_file_name, None, registry=registry)
+    if callable(ref_value):
+        scale.ref_cap = ref_value(scale.date_string)
+    else:
+        scale.ref_cap = persistence.loads_json(ref_value).extract('ref_value')
+    scale.buildup()
+    return run_rows(scale, run_file, store), archive_json(scale.caps)
+
+
+def archive_json(caps):
+    """
+    :param caps: dictionary of CAPACITOR objects with best values
+    :return: json string of a GTC archive of the best values, keyed as caps
+    """
+    best_values = persistence.Archive()
+    for x in caps:
+        best_values.add(**{x: result(caps[x].best_value, label=x)})
+    return persistence.dumps_json(best_values)
+
+
+def run_rows(scale, run_file, store):
+    """
+    :return: list of rows [date, run file, capacitor, capacitance in pF, json string of best_value] for one run
+    """
+    rows = []
+    for x in scale.caps:
+        best = scale.caps[x].best_value
+        z = (best / (1j * scale.w)).real * 1e12  # capacitance in pF
+        rows.append([scale.date_string, Path(run_file).name, x, str(z), store.ucomplex_to_json(best, new_label=x)])
+    return rows
+
+
+class BATCHSCALE(object):
+    def __init__(self, file_path, run_files, component_file, output_file_name, ref_value, **kwargs):
+        """
+        The leads and capacitors file is read once. Each run gets its own shallow copies of the CAPACITOR objects
+        (buildup changes best_value and leads) while the GTC inputs inside them are shared between runs.
+        :param file_path: the subfolder that holds the leads and capacitors file and the output file
+        :param run_files: a list of file names relative to file_path, a glob pattern relative to file_path or a
+        directory (relative to file_path) of run files. The leads and capacitors file and the output file are never
+        taken as run files.
+        :param component_file: file name of the leads and capacitors, e.g. 'leads_and_caps.csv'
+        :param output_file_name: csv file for the consolidated results of all the runs
+        :param ref_value: ucomplex value of AH11C1, or a function of the run date string that returns it
+        :param kwargs: pattern= the run files in a directory (default 'in*.csv')
+        """
+        self.data_folder = Path(file_path)
+        self.component_file = component_file
+        self.data_out = self.data_folder / output_file_name
+        self.ref_value = ref_value
+        self.store = GTCSTORE()
+        self.storecomp = COMPONENTSTORE()
+        pattern = 'in*.csv'
+        for arg in kwargs.keys():
+            if arg == 'pattern':
+                pattern = kwargs[arg]
+        if isinstance(run_files, (list, tuple)):
+            self.run_files = list(run_files)  # relative to data_folder, as CAPSCALE expects
+        else:
+            if (self.data_folder / run_files).is_dir():
+                found = (self.data_folder / run_files).glob(pattern)
+            else:
+                found = self.data_folder.glob(run_files)
+            skip = [(self.data_folder / component_file).resolve(), self.data_out.resolve()]
+            self.run_files = sorted(str(x.relative_to(self.data_folder)) for x in found
+                                    if x.is_file() and x.resolve() not in skip)
+        cap_list = ['ah11a1', 'ah11b1', 'ah11c1', 'ah11d1', 'ah11a2', 'ah11b2', 'ah11c2', 'ah11d2', 'es14', 'es13',
+                    'es16', 'gr10', 'gr100', 'gr1000a', 'gr1000b', 'es13_16']
+        lead_list = ['hv1', 'hv2', 'lv2', 'xfrm', 'hv1_xfrm', 'hv2_xfrm', 'no_lead']
+        self.caps, self.leads = self.storecomp.read_components(self.data_folder / component_file, cap_list,
+                                                               lead_list)
+        self.runs = []
+        self.rows = []
+
+    def components(self):
+        """
+        :return: a (caps, leads) tuple suitable for the components= argument of CAPSCALE
+        """
+        caps = {}
+        for x in self.caps:
+            caps[x] = copy.copy(self.caps[x])
+        return caps, dict(self.leads)
+
+    def reference(self, date_string):
+        """
+        :param date_string: the Date of a run
+        :return: the value of AH11C1 to use for that run
+        """
+        if callable(self.ref_value):
+            return self.ref_value(date_string)
+        return self.ref_value
+
+    def run_one(self, run_file):
+        """
+        Builds up the scale for a single run file
+        :param run_file: name of an in.csv style file relative to data_folder
+        :return: CAPSCALE object after buildup
+        """
+        scale = CAPSCALE(self.data_folder, [run_file, self.component_file], self.data_out.name, None,
+                         components=self.components())
+        scale.ref_cap = self.reference(scale.date_string)  # the date is only known once the run file is read
+        scale.buildup()
+        return scale
+
+    def run_all(self, **kwargs):
+        """
+        Builds up the scale for every run file. Runs are independent, so they can be spread over a pool of spawned
+        processes or of threads; the results are merged in the order of self.run_files whatever order they finish in.
+        :param kwargs: workers= pool size (default, serial), executor= 'process' (default) or 'thread'. With a
+        process pool a callable ref_value must be a module level function.
+        :return: self.runs, for every mode a list of GTC archives (json strings) of the best values of each run in the
+        order of self.run_files, keyed by capacitor. GTC.persistence.loads_json restores one when its uncertainty
+        budget is wanted, e.g. in a fresh process; results() has the values as plain rows.
+        """
+        workers = None
+        executor = 'process'
+        for arg in kwargs.keys():
+            if arg == 'workers':
+                workers = kwargs[arg]
+            elif arg == 'executor':
+                executor = kwargs[arg]
+        self.runs = []
+        self.rows = []
+        if workers is None or workers < 2 or executor == 'thread':
+            if workers is None or workers < 2:
+                scales = [self.run_one(x) for x in self.run_files]
+            else:
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    scales = list(pool.map(self.run_one, self.run_files))  # map keeps the order of the run files
+            for scale, run_file in zip(scales, self.run_files):
+                self.rows.extend(run_rows(scale, run_file, self.store))
+                self.runs.append(archive_json(scale.caps))
+            return self.runs
+        ref = self.ref_value
+        if not callable(ref):
+            ref_archive = persistence.Archive()
+            ref_archive.add(ref_value=result(ref))
+            ref = persistence.dumps_json(ref_archive)
+        n = len(self.run_files)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            for rows, best_values in pool.map(process_run, [self.data_folder] * n, self.run_files,
+                                              [self.component_file] * n, [self.data_out.name] * n, [ref] * n):
+                self.rows.extend(rows)
+                self.runs.append(best_values)
+        return self.runs
+
+    def results(self):
+        """
+        :return: list of rows [date, run file, capacitor, capacitance in pF, json string of best_value]
+        """
+        return self.rows
+
+    def store_results(self):
+        """
+        Writes the consolidated results of all runs, keyed by run date and capacitor, to one csv file
+        :return:
+        """
+        with open(self.data_out, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(['Date', 'Run', 'Capacitor', 'pF', 'best_value'])
+            writer.writerows(self.results())
+        return
+
+
+if __name__ == '__main__':
+    from GTC import ureal
+    print('Testing batch_scale.py')
+    w = 1e4
+    cap = 99.999581e-12
+    g = ureal(1.9e-6 * w * cap, 0.6e-6 / 2 * w * cap, 50, label='ah11c1d')
+    c = ureal(cap, cap * 0.11e-6 / 2, 50, label='ah11c1c')
+    batch = BATCHSCALE('G:\\My Drive\\KJ\\PycharmProjects\\CapacitanceScale\\datastore', ['in.csv'],
+                       'leads_and_caps.csv', 'out_batch.csv', g + 1j * w * c)
+    batch.run_all()
+    for row in batch.results():
+        print(row[:4])
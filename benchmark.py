@@ -0,0 +1,321 @@
+#  python3.8 som environment
+from archive import GTCSTORE, COMPONENTSTORE
+from meas_cap_ratio import CAPSCALE
+from cal_balance import DIALCAL
+from cal_main_ratio import PERMUTE
+from components import lead_cache
+from GTC import ureal
+from pathlib import Path
+from json import dumps, loads
+import csv
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+"""
+Timings of the build up, the calibration of the balance dials and main ratio, the lead corrections and the csv
+archive, written as json so that runs on different commits can be compared with compare(). The fixtures are copies
+of in.csv, test.csv, perm1.csv and leads_and_caps.csv in a temporary folder, together with synthetic leads and
+capacitors files holding 10, 100 and 1000 times as many capacitors (renamed copies of the real ones).
+"""
+
+FIXTURES = ['in.csv', 'test.csv', 'perm1.csv', 'leads_and_caps.csv']
+CAP_LIST = ['ah11a1', 'ah11b1', 'ah11c1', 'ah11d1', 'ah11a2', 'ah11b2', 'ah11c2', 'ah11d2', 'es14', 'es13', 'es16',
+            'gr10', 'gr100', 'gr1000a', 'gr1000b', 'es13_16']
+LEAD_LIST = ['hv1', 'hv2', 'lv2', 'xfrm', 'hv1_xfrm', 'hv2_xfrm', 'no_lead']
+# (case name, interpreter arguments) timed as separate processes, so nothing is already imported. The cli cases
+# parse their arguments before any GTC import, which every subcommand that computes then pays (startup_gtc); the
+# calibration modules add little to it, as importing GTC already loads GTC.reporting, NumPy and SciPy.
+STARTUP = [('startup_python', ['-c', 'pass']), ('startup_cli_help', ['cli.py', '--help']),
+           ('startup_cli_run_help', ['cli.py', 'run', '--help']),
+           ('startup_cli_budget_help', ['cli.py', 'budget', '--help']), ('startup_gtc', ['-c', 'import GTC'])]
+
+
+def reference_value(w=1e4, cap=99.999581e-12):
+    """
+    :return: the ucomplex value of AH11C1 used in the __main__ checks of meas_cap_ratio.py
+    """
+    g = ureal(1.9e-6 * w * cap, 0.6e-6 / 2 * w * cap, 50, label='ah11c1d')
+    c = ureal(cap, cap * 0.11e-6 / 2, 50, label='ah11c1c')
+    return g + 1j * w * c
+
+
+def scaled_component_file(source, target, scale):
+    """
+    Writes a leads and capacitors file with scale times as many capacitors. The leads come first, then scale - 1
+    renamed copies of every capacitor (e.g. gr10_7), then the original capacitors, so that the keys used by the
+    build up sit at the end of the file.
+    :param source: full name of a leads and capacitors csv file
+    :param target: full name of the new file
+    :param scale: multiple of the number of capacitors
+    :return: number of rows written
+    """
+    leads = []
+    caps = []
+    with open(source, newline='') as csvfile:
+        for row in csv.reader(csvfile):
+            if 'nom_cap' in loads(row[1]):
+                caps.append(row)
+            else:
+                leads.append(row)
+    rows = list(leads)
+    for k in range(1, scale):
+        for key, filed in caps:
+            rows.append([key + '_' + str(k), filed])
+    rows.extend(caps)
+    with open(target, 'w', newline='') as csvfile:
+        csv.writer(csvfile).writerows(rows)
+    return len(rows)
+
+
+def git_commit(folder):
+    """
+    :return: the current commit hash of the repository holding folder, or None outside a git work tree
+    """
+    try:
+        result = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=str(folder), capture_output=True, text=True,
+                                timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    if result.returncode != 0:
+        return None
+    return result.stdout.strip()
+
+
+class BENCHMARK(object):
+    def __init__(self, file_path, **kwargs):
+        """
+        Copies the fixtures into a temporary working folder, which is removed by close()
+        :param file_path: folder holding the datastore csv files
+        :param kwargs: repeat= number of timed repeats of each case (default 5), scales= multiples of the number of
+        capacitors for the synthetic component files (default (10, 100, 1000)), work_dir= folder to use instead of
+        a temporary one (it is left in place)
+        """
+        self.repeat = 5
+        self.scales = (10, 100, 1000)
+        work_dir = None
+        for arg in kwargs.keys():
+            if arg == 'repeat':
+                self.repeat = kwargs[arg]
+            elif arg == 'scales':
+                self.scales = tuple(kwargs[arg])
+            elif arg == 'work_dir':
+                work_dir = kwargs[arg]
+        self.source_folder = Path(file_path)
+        if work_dir is None:
+            self.work_dir = Path(tempfile.mkdtemp(prefix='capscale_bench_'))
+            self.temporary = True
+        else:
+            self.work_dir = Path(work_dir)
+            self.work_dir.mkdir(parents=True, exist_ok=True)
+            self.temporary = False
+        for x in FIXTURES:
+            shutil.copyfile(self.source_folder / x, self.work_dir / x)
+        self.component_files = {1: 'leads_and_caps.csv'}
+        for scale in self.scales:
+            name = 'leads_and_caps_x%d.csv' % scale
+            scaled_component_file(self.work_dir / 'leads_and_caps.csv', self.work_dir / name, scale)
+            self.component_files[scale] = name
+        self.ref_value = reference_value()
+        self.results = []
+
+    def time_case(self, name, size, setup, run):
+        """
+        Times run(setup()) self.repeat times; setup is not timed, so every repeat can start from fresh objects
+        :param name: name of the case
+        :param size: multiple of the number of capacitors (1 for the datastore files)
+        :param setup: function with no arguments returning the argument of run
+        :param run: function of one argument, the code being timed
+        :return: dictionary of the statistics in seconds
+        """
+        times = []
+        for i in range(self.repeat):
+            argument = setup()
+            start = time.perf_counter()
+            run(argument)
+            times.append(time.perf_counter() - start)
+        result = {'name': name, 'size': size, 'repeat': self.repeat, 'min': min(times),
+                  'median': statistics.median(times), 'mean': statistics.mean(times),
+                  'stdev': statistics.stdev(times) if len(times) > 1 else 0.0}
+        self.results.append(result)
+        return result
+
+    def new_scale(self, size=1):
+        lead_cache.clear()
+        return CAPSCALE(self.work_dir, ['in.csv', self.component_files[size]], 'bench_out.csv', self.ref_value)
+
+    def built_scale(self):
+        scale = self.new_scale()
+        scale.buildup()
+        return scale
+
+    def all_capacitors(self, size):
+        """
+        :return: every CAPACITOR object of a component file, with its leads
+        """
+        storecomp = COMPONENTSTORE()
+        caps = []
+        for key, filed in storecomp.iter_component_dicts(self.work_dir / self.component_files[size]):
+            if 'nom_cap' in filed:
+                caps.append(storecomp.dict_to_capacitor(filed))
+        return caps
+
+    def bench_buildup(self):
+        """
+        CAPSCALE.__init__, buildup and store_buildup on the datastore files
+        """
+        self.time_case('capscale_init', 1, lambda: None, lambda x: self.new_scale())
+        self.time_case('buildup', 1, self.new_scale, lambda scale: scale.buildup())
+        self.time_case('store_buildup', 1, self.built_scale, lambda scale: scale.store_buildup())
+        return
+
+    def bench_calibration(self):
+        """
+        DIALCAL.dialfactors and PERMUTE.calc_raw_ratio and correct_ratio on test.csv and perm1.csv
+        """
+        dials = DIALCAL(self.work_dir, ['test.csv', 'leads_and_caps.csv'], 'bench_dials.csv')
+        self.time_case('dialfactors', 1, lambda: dials, lambda x: x.dialfactors())
+        ratio = PERMUTE(self.work_dir, ['perm1.csv', 'leads_and_caps.csv'], 'bench_ratio.csv')
+        self.time_case('calc_raw_ratio', 1, lambda: ratio, lambda x: x.calc_raw_ratio())
+        raw = ratio.calc_raw_ratio()
+        self.time_case('correct_ratio', 1, lambda: raw, lambda x: ratio.correct_ratio(x))
+        return
+
+    def bench_components(self, size):
+        """
+        Reading, lead corrections and csv round trips of a component file
+        :param size: 1 or one of self.scales
+        """
+        component_file = self.work_dir / self.component_files[size]
+        storecomp = COMPONENTSTORE()
+
+        def cold_store():
+            Path(str(component_file) + '.idx').unlink(missing_ok=True)
+            return COMPONENTSTORE()
+
+        self.time_case('read_components_cold', size, cold_store,
+                       lambda x: x.read_components(component_file, CAP_LIST, LEAD_LIST))
+        storecomp.build_index(component_file)
+        self.time_case('read_components', size, COMPONENTSTORE,
+                       lambda x: x.read_components(component_file, CAP_LIST, LEAD_LIST))
+        if size > 1:
+            self.time_case('capscale_init', size, lambda: None, lambda x: self.new_scale(size))
+        caps = self.all_capacitors(size)
+
+        def corrections(cache):
+            lead_cache.clear()
+            lead_cache.enabled = cache
+            return caps
+
+        def correct_all(cap_list):
+            for cap in cap_list:
+                cap.lead_correction()
+
+        self.time_case('lead_correction', size, lambda: corrections(False), correct_all)
+        lead_cache.enabled = True
+        correct_all(caps)  # fill the cache
+        self.time_case('lead_correction_cached', size, lambda: caps, correct_all)
+        rows = [[x.label, dumps(storecomp.capacitor_to_dict(x))] for x in caps]
+        self.time_case('capacitor_to_dict', size, lambda: caps,
+                       lambda cap_list: [storecomp.capacitor_to_dict(x) for x in cap_list])
+        store = GTCSTORE()
+        copy_file = self.work_dir / 'bench_components.csv'
+        self.time_case('save_components', size, lambda: rows, lambda x: store.save_gtc(x, copy_file))
+        self.time_case('read_components_all', size, lambda: copy_file,
+                       lambda x: [storecomp.dict_to_capacitor(y) for key, y in storecomp.iter_component_dicts(x)])
+        best = [x.best_value for x in caps]
+        json_rows = [[store.ucomplex_to_json(x)] for x in best]
+        gtc_file = self.work_dir / 'bench_gtc.csv'
+        self.time_case('ucomplex_to_json', size, lambda: best, lambda x: [store.ucomplex_to_json(y) for y in x])
+        self.time_case('save_gtc', size, lambda: json_rows, lambda x: store.save_gtc(x, gtc_file))
+        self.time_case('read_gtc_complex', size, lambda: gtc_file,
+                       lambda x: [store.json_to_ucomplex(row[0]) for row in store.read_gtc(x)])
+        lead_cache.clear()
+        return
+
+    def bench_startup(self):
+        """
+        Wall time of fresh interpreters importing the modules, or starting the command line tool, from this folder
+        """
+        folder = Path(__file__).parent
+        for name, arguments in STARTUP:
+            self.time_case(name, 1, lambda: [sys.executable] + arguments,
+                           lambda x: subprocess.run(x, cwd=str(folder), stdout=subprocess.DEVNULL, check=True))
+        return
+
+    def run(self):
+        """
+        Runs every case, the component cases at each size
+        :return: the report dictionary
+        """
+        self.results = []
+        self.bench_startup()
+        self.bench_buildup()
+        self.bench_calibration()
+        for size in sorted(self.component_files):
+            self.bench_components(size)
+        return self.report()
+
+    def report(self):
+        """
+        :return: dictionary of the environment and the list of results, ready for json
+        """
+        return {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': git_commit(Path(__file__).parent),
+                'python': sys.version.split()[0], 'platform': platform.platform(), 'repeat': self.repeat,
+                'scales': list(self.scales), 'results': self.results}
+
+    def save(self, file_name):
+        """
+        :param file_name: full name of the json file
+        :return:
+        """
+        with open(file_name, 'w') as json_file:
+            json_file.write(dumps(self.report(), indent=1))
+        return
+
+    def close(self):
+        if self.temporary:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+        return
+
+
+def compare(old_file, new_file, **kwargs):
+    """
+    Compares the median times of two json reports case by case
+    :param old_file: json file of the earlier run
+    :param new_file: json file of the later run
+    :param kwargs: tolerance= fractional slow down before a case is flagged (default 0.1, i.e. 10 %)
+    :return: list of [name, size, old median, new median, new / old, flag] for the cases in both reports
+    """
+    tolerance = 0.1
+    for arg in kwargs.keys():
+        if arg == 'tolerance':
+            tolerance = kwargs[arg]
+    with open(old_file) as json_file:
+        old = {(x['name'], x['size']): x for x in loads(json_file.read())['results']}
+    with open(new_file) as json_file:
+        new = loads(json_file.read())['results']
+    rows = []
+    for x in new:
+        key = (x['name'], x['size'])
+        if key in old:
+            ratio = x['median'] / old[key]['median'] if old[key]['median'] > 0 else float('inf')
+            flag = 'slower' if ratio > 1 + tolerance else 'faster' if ratio < 1 - tolerance else ''
+            rows.append([x['name'], x['size'], old[key]['median'], x['median'], ratio, flag])
+    return rows
+
+
+if __name__ == '__main__':
+    print('Running benchmark.py')
+    bench = BENCHMARK('G:\\My Drive\\KJ\\PycharmProjects\\CapacitanceScale\\datastore', repeat=5)
+    try:
+        bench.run()
+        for result in bench.results:
+            print("{:<24} {:>6} {:12.6f} s".format(result['name'], result['size'], result['median']))
+        bench.save('benchmark.json')
+    finally:
+        bench.close()
@@ -0,0 +1,278 @@
+#  python3.8 som environment
+import csv
+from json import dumps, loads
+import numpy as np
+from GTC import ureal, ucomplex
+from GTC.reporting import is_ucomplex
+from components import LEAD, CAPACITOR
+
+"""
+Binary alternative to the json-in-csv storage of archive.py. Every ureal or ucomplex becomes one fixed width record
+(x, u, the 4 element v, df and label) in a NumPy structured array, so a whole file is loaded with one bulk read
+(.npz) or memory mapped (.npy) and no json has to be parsed. Records convert back to exactly the json strings that
+GTCSTORE and COMPONENTSTORE write.
+"""
+
+NAME_LENGTH = 64  # longest key, label or name that fits in a record
+
+VALUE = np.dtype([('key', 'U%d' % NAME_LENGTH), ('complex', '?'), ('x', 'f8', 2), ('u', 'f8', 2), ('v', 'f8', 4),
+                  ('df', 'f8'), ('label', 'U%d' % NAME_LENGTH), ('has_label', '?')])
+LEADRECORD = np.dtype([('key', 'U%d' % NAME_LENGTH), ('label', 'U%d' % NAME_LENGTH), ('relu', 'f8'), ('w', 'f8'),
+                       ('z', 'i8'), ('y', 'i8')])  # z and y are rows of the value array
+CAPRECORD = np.dtype([('key', 'U%d' % NAME_LENGTH), ('name', 'U%d' % NAME_LENGTH), ('relu', 'f8'), ('w', 'f8'),
+                      ('nom_cap', 'f8', 2), ('yhv', 'f8', 2), ('ylv', 'f8', 2), ('hv_lead', 'i8'), ('lv_lead', 'i8'),
+                      ('best_value', 'i8')])  # leads are rows of the lead array, best_value is -1 if not set
+
+
+def check_length(text):
+    if text is not None and len(text) > NAME_LENGTH:
+        raise ValueError('%r is longer than %d characters' % (text, NAME_LENGTH))
+    return text
+
+
+class BINARYSTORE(object):
+    def dict_to_record(self, unr_dict, **kwargs):
+        """
+        Turns a dictionary from GTCSTORE (ureal_to_dict or ucomplex_to_dict form) into a fixed width record
+        :param unr_dict: dictionary of parts of a GTC uncertain real or complex
+        :param kwargs: 'key' to identify the record, if wanted
+        :return: numpy record of dtype VALUE
+        """
+        key = ''
+        for arg in kwargs.keys():
+            if arg == 'key':
+                key = kwargs[arg]
+        record = np.zeros((), dtype=VALUE)
+        record['key'] = check_length(key)
+        if 'xreal' in unr_dict:
+            record['complex'] = True
+            record['x'] = (unr_dict['xreal'], unr_dict['ximag'])
+            record['u'] = unr_dict['u']
+            record['v'] = unr_dict['v']
+        else:
+            record['x'] = (unr_dict['x'], 0.0)
+            record['u'] = (unr_dict['u'], 0.0)
+            record['v'] = (unr_dict['u'] ** 2, 0.0, 0.0, 0.0)
+        record['df'] = unr_dict['df']
+        record['has_label'] = unr_dict['label'] is not None
+        if record['has_label']:
+            record['label'] = check_length(unr_dict['label'])
+        return record
+
+    def record_to_dict(self, record):
+        """
+        :param record: numpy record of dtype VALUE
+        :return: dictionary with the same keys, in the same order, as GTCSTORE.ureal_to_dict or ucomplex_to_dict
+        """
+        label = str(record['label']) if record['has_label'] else None
+        if record['complex']:
+            return {'xreal': float(record['x'][0]), 'ximag': float(record['x'][1]),
+                    'u': [float(x) for x in record['u']], 'v': [float(x) for x in record['v']],
+                    'df': float(record['df']), 'label': label}
+        return {'x': float(record['x'][0]), 'u': float(record['u'][0]), 'df': float(record['df']), 'label': label}
+
+    def record_to_json(self, record):
+        """
+        :param record: numpy record of dtype VALUE
+        :return: the json string that GTCSTORE.ureal_to_json or ucomplex_to_json gives for the same value
+        """
+        return dumps(self.record_to_dict(record))
+
+    def record_to_gtc(self, record):
+        """
+        :param record: numpy record of dtype VALUE
+        :return: GTC uncertain real or complex
+        """
+        label = str(record['label']) if record['has_label'] else None
+        if record['complex']:
+            return ucomplex(record['x'][0] + 1j * record['x'][1], tuple(float(x) for x in record['v']),
+                            float(record['df']), label=label)
+        return ureal(float(record['x'][0]), float(record['u'][0]), float(record['df']), label=label)
+
+    def gtc_to_dict(self, un):
+        if is_ucomplex(un):
+            return {'xreal': un.x.real, 'ximag': un.x.imag, 'u': un.u, 'v': un.v, 'df': un.df, 'label': un.label}
+        return {'x': un.x, 'u': un.u, 'df': un.df, 'label': un.label}
+
+    def save_values(self, values, file_name):
+        """
+        Stores uncertain values as a .npy file of fixed width records, which read_values can memory map
+        :param values: dictionary of GTC uncertain reals or complexes
+        :param file_name: full name of a .npy file
+        :return:
+        """
+        records = np.zeros(len(values), dtype=VALUE)
+        for i, x in enumerate(values):
+            records[i] = self.dict_to_record(self.gtc_to_dict(values[x]), key=x)
+        np.save(file_name, records, allow_pickle=False)
+        return
+
+    def read_records(self, file_name, **kwargs):
+        """
+        :param file_name: full name of a .npy file written by save_values
+        :param kwargs: mmap=True to memory map the file rather than read it
+        :return: structured array of dtype VALUE
+        """
+        mmap = False
+        for arg in kwargs.keys():
+            if arg == 'mmap':
+                mmap = kwargs[arg]
+        return np.load(file_name, mmap_mode='r' if mmap else None, allow_pickle=False)
+
+    def read_values(self, file_name):
+        """
+        :param file_name: full name of a .npy file written by save_values
+        :return: dictionary of GTC uncertain reals or complexes
+        """
+        values = {}
+        for record in self.read_records(file_name):
+            values[str(record['key'])] = self.record_to_gtc(record)
+        return values
+
+    def save_component_dicts(self, component_dicts, file_name):
+        """
+        Stores leads and capacitors in the dictionary form of COMPONENTSTORE.lead_to_dict and capacitor_to_dict
+        (i.e. json.loads of each leads_and_caps.csv row) as a .npz file of three record arrays
+        :param component_dicts: dictionary of lead and capacitor dictionaries
+        :param file_name: full name of a .npz file
+        :return:
+        """
+        values = []
+        leads = []
+        caps = []
+
+        def add_value(unc_json):
+            values.append(self.dict_to_record(loads(unc_json)))
+            return len(values) - 1
+
+        def add_lead(key, filed):
+            leads.append((check_length(key), check_length(filed['label']), filed['relu'], filed['w'],
+                          add_value(filed['z']), add_value(filed['y'])))
+            return len(leads) - 1
+
+        for x in component_dicts:
+            filed = component_dicts[x]
+            if 'nom_cap' in filed:
+                best = add_value(filed['best_value']) if filed['flag'] == 'best value set' else -1
+                caps.append((check_length(x), check_length(filed['name']), filed['relu'], filed['ang_freq'],
+                             filed['nom_cap'], filed['yhv'], filed['ylv'], add_lead('', filed['hv_lead']),
+                             add_lead('', filed['lv_lead']), best))
+            else:
+                add_lead(x, filed)
+        np.savez(file_name, values=np.array(values, dtype=VALUE), leads=np.array(leads, dtype=LEADRECORD),
+                 caps=np.array(caps, dtype=CAPRECORD))
+        return
+
+    def read_component_arrays(self, file_name):
+        """
+        One bulk read of a file written by save_component_dicts
+        :param file_name: full name of a .npz file
+        :return: the value, lead and capacitor record arrays
+        """
+        with np.load(file_name, allow_pickle=False) as arrays:
+            return arrays['values'], arrays['leads'], arrays['caps']
+
+    def lead_record_to_dict(self, lead, values):
+        return {'relu': float(lead['relu']), 'w': float(lead['w']), 'label': str(lead['label']),
+                'z': self.record_to_json(values[lead['z']]), 'y': self.record_to_json(values[lead['y']])}
+
+    def read_component_dicts(self, file_name):
+        """
+        :param file_name: full name of a .npz file written by save_component_dicts
+        :return: dictionary of lead and capacitor dictionaries identical to json.loads of the original csv rows
+        """
+        values, leads, caps = self.read_component_arrays(file_name)
+        component_dicts = {}
+        for lead in leads:
+            if lead['key'] != '':  # the leads attached to capacitors have no key of their own
+                component_dicts[str(lead['key'])] = self.lead_record_to_dict(lead, values)
+        for cap in caps:
+            filed = {'relu': float(cap['relu']), 'name': str(cap['name']), 'nom_cap': [float(x) for x in cap['nom_cap']],
+                     'yhv': [float(x) for x in cap['yhv']], 'ylv': [float(x) for x in cap['ylv']],
+                     'ang_freq': float(cap['w']), 'lv_lead': self.lead_record_to_dict(leads[cap['lv_lead']], values),
+                     'hv_lead': self.lead_record_to_dict(leads[cap['hv_lead']], values)}
+            if cap['best_value'] >= 0:
+                filed['best_value'] = self.record_to_json(values[cap['best_value']])
+                filed['flag'] = 'best value set'
+            else:
+                filed['flag'] = 'no best value set'
+            component_dicts[str(cap['key'])] = filed
+        return component_dicts
+
+    def read_components(self, file_name, cap_list, lead_list):
+        """
+        Recovers CAPACITOR and LEAD objects straight from the records, as COMPONENTSTORE.read_components does from
+        a csv file, without any json parsing
+        :param file_name: full name of a .npz file written by save_component_dicts
+        :param cap_list: keys of the capacitors wanted
+        :param lead_list: keys of the leads wanted
+        :return: dictionaries of CAPACITOR and LEAD objects
+        """
+        values, leads, caps = self.read_component_arrays(file_name)
+
+        def make_lead(lead):  # as COMPONENTSTORE.dict_to_lead
+            w = float(lead['w'])
+            z = values[lead['z']]['x']
+            y = values[lead['y']]['x']
+            return LEAD(str(lead['label']), (float(z[0]), float(z[1]) / w), (float(y[0]), float(y[1]) / w), w,
+                        float(lead['relu']))
+
+        recovered_leads = {}
+        for lead in leads:
+            if lead['key'] in lead_list:
+                recovered_leads[str(lead['key'])] = make_lead(lead)
+        recovered_caps = {}
+        for cap in caps:
+            if cap['key'] in cap_list:
+                recovered_cap = CAPACITOR(str(cap['name']), tuple(float(x) for x in cap['nom_cap']),
+                                          tuple(float(x) for x in cap['yhv']), tuple(float(x) for x in cap['ylv']),
+                                          float(cap['w']), make_lead(leads[cap['hv_lead']]),
+                                          make_lead(leads[cap['lv_lead']]), float(cap['relu']))
+                if cap['best_value'] >= 0:
+                    recovered_cap.set_best_value(self.record_to_gtc(values[cap['best_value']]))
+                recovered_caps[str(cap['key'])] = recovered_cap
+        return recovered_caps, recovered_leads
+
+    def csv_to_binary(self, csv_file, npz_file):
+        """
+        Converts a leads and capacitors csv file of [key, json string] rows to the binary form
+        :param csv_file: full name of the csv file
+        :param npz_file: full name of the .npz file
+        :return:
+        """
+        component_dicts = {}
+        with open(csv_file, newline='') as csvfile:
+            reader = csv.reader(csvfile)
+            for row in reader:
+                component_dicts[row[0]] = loads(row[1])
+        self.save_component_dicts(component_dicts, npz_file)
+        return
+
+    def binary_to_csv(self, npz_file, csv_file):
+        """
+        Writes the binary form back as a csv file of [key, json string] rows, leads first as in leads_and_caps.csv
+        :param npz_file: full name of the .npz file
+        :param csv_file: full name of the csv file
+        :return:
+        """
+        component_dicts = self.read_component_dicts(npz_file)
+        with open(csv_file, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            for x in component_dicts:
+                writer.writerow([x, dumps(component_dicts[x])])
+        return
+
+
+if __name__ == '__main__':
+    from pathlib import Path
+    print('Testing binary_archive.py')
+    folder = Path('G:\\My Drive\\KJ\\PycharmProjects\\CapacitanceScale\\datastore')
+    bits = BINARYSTORE()
+    bits.csv_to_binary(folder / 'leads_and_caps.csv', folder / 'leads_and_caps.npz')
+    recovered = bits.read_component_dicts(folder / 'leads_and_caps.npz')
+    with open(folder / 'leads_and_caps.csv', newline='') as csvfile:
+        for row in csv.reader(csvfile):
+            assert dumps(recovered[row[0]]) == row[1], row[0]
+    print('json round trip of', len(recovered), 'components is exact')
+    caps, leads = bits.read_components(folder / 'leads_and_caps.npz', ['ah11a1', 'gr10'], ['hv1'])
+    print(caps['ah11a1'].lead_correction(), leads['hv1'].z)
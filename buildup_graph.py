@@ -0,0 +1,246 @@
+#  python3.8 som environment
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from components import lead_cache
+
+"""
+The capacitance build up of CAPSCALE.buildup expressed as a dependency graph of ratio links. After a balance
+reading, a reference value, a ratio factor or a set of leads changes, only the capacitors downstream of it are
+recomputed; every other best_value is reused as it stands. Independent branches (e.g. the 10 pF, 1000 pF and
+step down groups once c1 is known) can be scheduled on a thread pool, each node as soon as the nodes it needs are
+done, and the results are merged in build up order whatever order they finish in. GTC arithmetic holds the GIL, so
+this mostly overlaps waiting rather than adding cores; batch_scale.py puts whole runs on a process pool.
+"""
+
+RATIO_INPUTS = ['main_ratio', 'factora', 'factorb']  # used by every cap_ratio and sum_ratio step
+BALANCES = ['r%d' % i for i in range(1, 16)]
+
+# (capacitor, reference node, balance, inverse, lead correction added) in the order of CAPSCALE.buildup
+LINKS_10PF = [('ah11a1', 'c1', 'r4', True, True), ('ah11b1', 'c1', 'r5', True, True),
+              ('ah11a2', 'c1', 'r6', True, True), ('ah11b2', 'c1', 'r7', True, True),
+              ('gr10', 'c1', 'r8', True, True)]
+LINKS_100PF = [('c100', 'ref2', 'r9', False, False),  # cross check with c1 for build up consistency
+               ('ah11d1', 'ref2', 'r10', False, True), ('ah11c2', 'ref2', 'r11', False, True),
+               ('ah11d2', 'ref2', 'r12', False, True), ('gr100', 'ref2', 'r13', False, True)]
+LINKS_1000PF = [('gr1000a', 'ref3', 'r14', False, True), ('gr1000b', 'ref3', 'r15', False, True)]
+
+
+class BUILDUPGRAPH(object):
+    def __init__(self, scale):
+        """
+        Builds the graph on a CAPSCALE object. The leads of each capacitor are taken at this point, so the graph must
+        be made before scale.buildup() swaps the leads on ah11c1; the graph itself never swaps leads but corrects
+        ah11c1 through a second connection, 'ah11c1_nox', to the hv2 and hv1 leads.
+        :param scale: a meas_cap_ratio.CAPSCALE object
+        """
+        assert scale.caps['ah11c1'].hvlead is not scale.leads['hv2'], 'make the graph before buildup'
+        self.scale = scale
+        self.connections = {}  # name: (capacitor key, hv lead, lv lead) used for a lead correction
+        for x in scale.caps:
+            self.connections[x] = (x, scale.caps[x].hvlead, scale.caps[x].lvlead)
+        self.connections['ah11c1_nox'] = ('ah11c1', scale.leads['hv2'], scale.leads['hv1'])  # without transformer
+        self.nodes = {}  # name: (method, arguments, dependencies), in evaluation order
+        self.children = {}  # name: nodes that depend directly on it
+        self.values = {}
+        self.dirty = set()
+        self.add('ah11c1', self.same, ('ref_cap',), ['ref_cap'])  # best value from certificate
+        self.add('c1', self.measured, ('ah11c1', 'ref_cap'), ['ref_cap', 'ah11c1 leads'])
+        for link in LINKS_10PF:
+            self.add_link(link)
+        self.add('ref2', self.measured, ('ah11a1', 'ah11a1'), ['ah11a1', 'ah11a1 leads'])
+        for link in LINKS_100PF:
+            self.add_link(link)
+        self.add('ref3', self.measured, ('ah11c1_nox', 'ref_cap'), ['ref_cap', 'ah11c1_nox leads'])
+        for link in LINKS_1000PF:
+            self.add_link(link)
+        self.add_link(('es13_16', 'c1', 'r3', True, False))  # no transformer connection
+        self.add('es_split', self.split, ('es13_16',), ['es13_16', 'r1', 'r2'] + RATIO_INPUTS)
+        for i, x in enumerate(['es13', 'es16', 'es14']):
+            self.add(x, self.pick, ('es_split', i), ['es_split'])
+
+    def add(self, name, method, arguments, dependencies):
+        self.nodes[name] = (method, arguments, dependencies)
+        for x in dependencies:
+            self.children.setdefault(x, []).append(name)
+        self.dirty.add(name)
+        return
+
+    def add_link(self, link):
+        name, source, balance, inverse, corrected = link
+        dependencies = [source, balance] + RATIO_INPUTS
+        if corrected:
+            dependencies.append(name + ' leads')
+        self.add(name, self.ratio, (name, source, balance, inverse, corrected), dependencies)
+        return
+
+    def value(self, name):
+        if name == 'ref_cap':
+            return self.scale.ref_cap
+        return self.values[name]
+
+    def correction(self, connection):
+        cap, hv, lv = self.connections[connection]
+        return lead_cache.correction(self.scale.caps[cap], hv, lv)
+
+    def same(self, source):
+        return self.value(source)
+
+    def measured(self, connection, source):
+        return self.value(source) - self.correction(connection)  # value seen at the end of the leads
+
+    def ratio(self, name, source, balance, inverse, corrected):
+        value = self.scale.cap_ratio(self.scale.balance_dict[balance], self.value(source), inverse)
+        if corrected:
+            value = value + self.correction(name)  # value with no leads
+        return value
+
+    def split(self, source):
+        return self.scale.sum_ratio(self.scale.balance_dict['r1'], self.scale.balance_dict['r2'], self.value(source))
+
+    def pick(self, source, index):
+        return self.value(source)[index]
+
+    def touch(self, name):
+        """
+        Marks everything downstream of an input or node for recomputation
+        :param name: e.g. 'r11', 'ref_cap', 'main_ratio', 'gr10 leads' or a node name
+        :return:
+        """
+        stack = list(self.children.get(name, []))
+        if name in self.nodes:
+            stack.append(name)
+        while stack:
+            x = stack.pop()
+            if x not in self.dirty:
+                self.dirty.add(x)
+                stack.extend(self.children.get(x, []))
+        return
+
+    def set_balance(self, key, balance):
+        """
+        :param key: one of r1 to r15
+        :param balance: (alpha, beta) tuple
+        :return:
+        """
+        self.scale.balance_dict[key] = balance
+        self.touch(key)
+        return
+
+    def set_input(self, name, value):
+        """
+        :param name: 'ref_cap', 'main_ratio', 'factora' or 'factorb'
+        :param value: the new ucomplex value
+        :return:
+        """
+        setattr(self.scale, name, value)
+        self.touch(name)
+        return
+
+    def set_leads(self, connection, hv, lv):
+        """
+        Changes the leads used for the lead correction of a capacitor
+        :param connection: a capacitor key or 'ah11c1_nox'
+        :param hv: LEAD object
+        :param lv: LEAD object
+        :return:
+        """
+        cap = self.connections[connection][0]
+        self.connections[connection] = (cap, hv, lv)
+        if connection == cap:
+            self.scale.caps[cap].set_new_leads(hv, lv)
+        self.touch(connection + ' leads')
+        return
+
+    def compute(self, name):
+        method, arguments, dependencies = self.nodes[name]
+        return method(*arguments)
+
+    def update(self, **kwargs):
+        """
+        Recomputes the nodes marked since the last update and sets the new best values, in build up order
+        :param kwargs: workers= number of threads to evaluate independent branches concurrently (default, serial),
+        partial= True to compute only the nodes whose balances have all been read (see acquisition.py); the others
+        stay marked for a later update.
+        :return: list of the names of the nodes recomputed
+        """
+        workers = None
+        partial = False
+        for arg in kwargs.keys():
+            if arg == 'workers':
+                workers = kwargs[arg]
+            elif arg == 'partial':
+                partial = kwargs[arg]
+        done = [x for x in self.nodes if x in self.dirty]
+        if partial:
+            done = self.ready(done)
+        if workers is None or workers < 2:
+            for name in done:
+                self.values[name] = self.compute(name)
+        else:
+            self.compute_concurrently(done, workers)
+        for name in done:  # merged in build up order whatever order the threads finished in
+            if name in self.scale.caps:
+                self.scale.caps[name].set_best_value(self.values[name])
+        self.dirty = self.dirty - set(done)
+        return done
+
+    def ready(self, names):
+        """
+        :param names: marked nodes in evaluation order
+        :return: those that can be computed now, i.e. every balance they need is in scale.balance_dict and every node
+        they need is computed or can be computed
+        """
+        ready = []
+        for name in names:
+            usable = True
+            for x in self.nodes[name][2]:
+                if x in BALANCES and x not in self.scale.balance_dict:
+                    usable = False
+                elif x in self.nodes and x not in ready and (x in self.dirty or x not in self.values):
+                    usable = False
+            if usable:
+                ready.append(name)
+        return ready
+
+    def compute_concurrently(self, names, workers):
+        """
+        Submits each node as soon as every node it depends on has been computed. Only this thread writes to
+        self.values.
+        :param names: nodes to compute
+        :param workers: number of threads
+        :return:
+        """
+        waiting = {}
+        for x in names:
+            waiting[x] = set(d for d in self.nodes[x][2] if d in names)
+        running = {}
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while waiting or running:
+                for x in [y for y in waiting if not waiting[y]]:
+                    del waiting[x]
+                    running[pool.submit(self.compute, x)] = x
+                finished, pending = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    x = running.pop(future)
+                    self.values[x] = future.result()
+                    for y in waiting:
+                        waiting[y].discard(x)
+        return
+
+
+if __name__ == '__main__':
+    from GTC import ureal
+    from meas_cap_ratio import CAPSCALE
+    print('Testing buildup_graph.py')
+    w = 1e4
+    cap = 99.999581e-12
+    g = ureal(1.9e-6 * w * cap, 0.6e-6 / 2 * w * cap, 50, label='ah11c1d')
+    c = ureal(cap, cap * 0.11e-6 / 2, 50, label='ah11c1c')
+    scale = CAPSCALE('G:\\My Drive\\KJ\\PycharmProjects\\CapacitanceScale\\datastore',
+                     ['in.csv', 'leads_and_caps.csv'], 'out.csv', g + 1j * w * c)
+    graph = BUILDUPGRAPH(scale)
+    print('first pass', len(graph.update()), 'nodes')
+    print('ah11c2 ', scale.caps['ah11c2'].best_value.imag / w * 1e12)
+    alpha, beta = scale.balance_dict['r11']
+    graph.set_balance('r11', (alpha + 0.001, beta))
+    print('after correcting r11', graph.update(workers=4))
+    print('ah11c2 ', scale.caps['ah11c2'].best_value.imag / w * 1e12)
@@ -1,12 +1,11 @@
 #  python3.8 som environment
-from archive import GTCSTORE, COMPONENTSTORE
+from archive import GTCSTORE, COMPONENTSTORE, COMPONENTREGISTRY
 from pathlib import Path
 import csv
-from json import loads
-from GTC.reporting import budget  # just for checks
+from GTC import la, value
 
 class DIALCAL(object):
-    def __init__(self, file_path, input_file_names, output_file_name):
+    def __init__(self, file_path, input_file_names, output_file_name, **kwargs):
         """
         Calibration of the main balance amplifier requires two sets of input data. The first set primarily balances the
         alpha dial at full scale. The second set primarily balances the beta dial at full scale. Calibration is at the
@@ -21,7 +20,17 @@ class DIALCAL(object):
         :param input_file_names: list of files, first is csv with dial settings and components, second has component
         values.
         :param output_file_name: output can be stored in this csv file (same directory)
+        :param kwargs: registry= an archive.COMPONENTREGISTRY to share recovered components with other classes,
+        storecomp= the store that reads the second file when there is no registry (default archive.COMPONENTSTORE,
+        or e.g. a sqlite_store.SQLITESTORE for a database file)
         """
+        registry = None
+        storecomp = None
+        for arg in kwargs.keys():
+            if arg == 'registry':
+                registry = kwargs[arg]
+            elif arg == 'storecomp':
+                storecomp = kwargs[arg]
         self.output_name = output_file_name  # optional store in a csv file
         self.store = GTCSTORE()
         self.data_folder = Path(file_path)
@@ -58,18 +67,16 @@ class DIALCAL(object):
                 else:
                     print('This row does not match. Wrong csv file? ', row)
         assert counter == 12, "csv file incorrect length, should be 12 rows:  %r" % counter
-        # get the latest values of c1 and c2 from 'leads_and_caps.csv'
+        # get the latest values of c1 and c2 from 'leads_and_caps.csv' through its index
         data_in = self.data_folder / input_file_names[1]
-        with open(data_in, newline='') as csvfile:  # format must be correct
-            reader = csv.reader(csvfile)
-            for row in reader:
-                if row[0] == c1:
-                    c1 = row[1]
-                elif row[0] == c2:
-                    c2 = row[1]
-        cstore = COMPONENTSTORE()
-        self.Y1 = cstore.dict_to_capacitor(loads(c1)).best_value  # loads(c1) is a components.CAPACITOR object
-        self.Y2 = cstore.dict_to_capacitor(loads(c2)).best_value  # loads(c1) is a components.CAPACITOR object
+        if registry is None:
+            cstore = COMPONENTSTORE() if storecomp is None else storecomp
+            found = cstore.lookup(data_in, [c1, c2])
+            self.Y1 = cstore.dict_to_capacitor(found[c1]).best_value  # found[c1] is a components.CAPACITOR dictionary
+            self.Y2 = cstore.dict_to_capacitor(found[c2]).best_value
+        else:
+            self.Y1 = registry.capacitor(data_in, c1).best_value
+            self.Y2 = registry.capacitor(data_in, c2).best_value
         self.Y3 = 1 / z3  # e.g. 1/(100k #4) but note loss angle assumes 1.6 kHz
 
     def dialfactors(self, **kwargs):
@@ -104,7 +111,144 @@ class DIALCAL(object):
         return a, b
 
 
+class DIALBATCH(object):
+    def __init__(self, file_path, run_file_names, component_file_name, output_file_name, **kwargs):
+        """
+        Many dial calibrations, e.g. one per date or injection ratio, for trending the balance amplifier. Each run
+        file holds one or more data sets in the DIALCAL format, each set starting at its Date row, so a file of
+        hundreds of sets can be read in one pass. Y1 and Y2 are recovered once per capacitor and Y3 once per distinct
+        z3, then equation 38 is solved for every set at once with GTC uncertain arrays.
+        :param file_path: directory for data in/out
+        :param run_file_names: list of csv files of dial settings
+        :param component_file_name: file of component values, e.g. leads_and_caps.csv
+        :param output_file_name: all the results can be stored in this one csv file (same directory)
+        :param kwargs: registry= an archive.COMPONENTREGISTRY to share recovered components with other classes
+        """
+        self.registry = COMPONENTREGISTRY()
+        for arg in kwargs.keys():
+            if arg == 'registry':
+                self.registry = kwargs[arg]
+        self.output_name = output_file_name
+        self.store = GTCSTORE()
+        self.data_folder = Path(file_path)
+        self.sets = []  # dictionary per data set, in file order
+        for name in run_file_names:
+            self.read_sets(self.data_folder / name)
+        components = self.data_folder / component_file_name
+        admittances = {}  # z3 json string or capacitor key: ucomplex admittance
+        for dial_set in self.sets:
+            for x in ['c1', 'c2']:
+                if dial_set[x] not in admittances:
+                    admittances[dial_set[x]] = self.registry.capacitor(components, dial_set[x]).best_value
+            if dial_set['z3'] not in admittances:
+                admittances[dial_set['z3']] = 1 / self.store.json_to_ucomplex(dial_set['z3'])
+        self.Y1 = la.uarray([admittances[x['c1']] for x in self.sets])
+        self.Y2 = la.uarray([admittances[x['c2']] for x in self.sets])
+        self.Y3 = la.uarray([admittances[x['z3']] for x in self.sets])
+        self.alpha1, self.beta1, self.alpha2, self.beta2 = [la.uarray([x[y] for x in self.sets])
+                                                            for y in ['alpha1', 'beta1', 'alpha2', 'beta2']]
+        self.k = la.uarray([x['k'] for x in self.sets])
+        self.r = la.uarray([x['r'] for x in self.sets])
+
+    def __len__(self):
+        return len(self.sets)
+
+    def read_sets(self, file_name):
+        """
+        :param file_name: full name of a csv file of one or more DIALCAL data sets
+        :return: number of sets read
+        """
+        count = 0
+        dial_set = None
+        with open(file_name, newline='') as csvfile:
+            for row in csv.reader(csvfile):
+                if not row:
+                    continue
+                if row[0] == 'Date':
+                    dial_set = {'Date': row[1]}
+                    self.sets.append(dial_set)
+                    count += 1
+                elif dial_set is None:
+                    print('Data before the first Date row. Wrong csv file? ', row)
+                elif row[0] in ['Reference', 'c1', 'c2', 'z3']:
+                    dial_set[row[0]] = row[1]
+                elif row[0] in ['w', 'r', 'k']:
+                    dial_set[row[0]] = float(row[1])
+                elif row[0] in ['alpha1', 'beta1', 'alpha2', 'beta2']:
+                    dial_set[row[0]] = self.store.json_to_ureal(row[1])
+                else:
+                    print('This row does not match. Wrong csv file? ', row)
+        for dial_set in self.sets[len(self.sets) - count:]:
+            missing = [x for x in ['Reference', 'w', 'alpha1', 'beta1', 'alpha2', 'beta2', 'r', 'k', 'c1', 'c2', 'z3']
+                       if x not in dial_set]
+            assert not missing, "set of %s is missing %r" % (dial_set['Date'], missing)
+        return count
+
+    def dialfactors(self, **kwargs):
+        """
+        Equation 38 of E.005.003 for every set in one evaluation
+        :param kwargs: file_output= True to write the results, append= True to add them to an existing file
+        :return: two uncertain arrays of the dial factors, one element per set
+        """
+        file_output = False
+        append = False
+        for arg in kwargs.keys():
+            if arg == 'file_output':
+                file_output = kwargs[arg]
+            if arg == 'append':
+                append = kwargs[arg]
+        x = self.k / (1e-2 * self.r) * (self.Y1 / self.Y2)
+        y = self.k / (1e-2 * self.r) * (self.Y1 / self.Y3)
+        a = (self.beta2 * x - self.beta1 * y) / (self.alpha1 * self.beta2 - self.alpha2 * self.beta1)
+        b = -1j * (self.alpha2 * x - self.alpha1 * y) / (self.alpha2 * self.beta1 - self.alpha1 * self.beta2)
+        if file_output:
+            self.file_factors(a, b, append=append)
+        return a, b
+
+    def nominal_factors(self):
+        """
+        Equation 38 on the values only, as NumPy arrays, for quick trending of many sets
+        :return: two complex arrays of the dial factors
+        """
+        import numpy as np  # only needed here, as for CAPSCALE.budget_matrix
+
+        def values(array):
+            return np.array([value(x) for x in array])
+
+        k = values(self.k)
+        r = values(self.r)
+        alpha1, beta1, alpha2, beta2 = [values(x) for x in [self.alpha1, self.beta1, self.alpha2, self.beta2]]
+        x = k / (1e-2 * r) * (values(self.Y1) / values(self.Y2))
+        y = k / (1e-2 * r) * (values(self.Y1) / values(self.Y3))
+        a = (beta2 * x - beta1 * y) / (alpha1 * beta2 - alpha2 * beta1)
+        b = -1j * (alpha2 * x - alpha1 * y) / (alpha2 * beta1 - alpha1 * beta2)
+        return a, b
+
+    def file_factors(self, factora, factorb, **kwargs):
+        """
+        Writes every set to the output file, opened once, as DIALCAL.dialfactors would have written them one by one
+        :param factora: uncertain array from dialfactors
+        :param factorb: uncertain array from dialfactors
+        :param kwargs: append= True to add to an existing file
+        :return:
+        """
+        append = False
+        for arg in kwargs.keys():
+            if arg == 'append':
+                append = kwargs[arg]
+        data_out = self.data_folder / self.output_name
+        with open(data_out, 'a' if append else 'w', newline='') as csvfile:
+            outwriter = csv.writer(csvfile)
+            for dial_set, a, b in zip(self.sets, factora, factorb):
+                outwriter.writerow(['Date', dial_set['Date']])
+                outwriter.writerow(['Reference', dial_set['Reference']])
+                outwriter.writerow(['factora', self.store.ucomplex_to_json(a, new_label='factora')])
+                outwriter.writerow(['factorb', self.store.ucomplex_to_json(b, new_label='factorb')])
+        return
+
+
 if __name__ == '__main__':
+    from GTC.reporting import budget  # just for checks
     print('Testing cal_balance.py')
     cal_dials = DIALCAL('G:\\My Drive\\KJ\\PycharmProjects\\CapacitanceScale\\datastore',
                         ['test.csv', 'leads_and_caps.csv'], 'out_test.csv')
@@ -118,3 +262,7 @@ if __name__ == '__main__':
     print(factorb.imag.u)
     for l, u in budget(factorb.imag, trim=0):
         print(l, u)
+    batch = DIALBATCH('G:\\My Drive\\KJ\\PycharmProjects\\CapacitanceScale\\datastore', ['test.csv'],
+                      'leads_and_caps.csv', 'out_test_batch.csv')
+    factors = batch.dialfactors(file_output=True)
+    print(len(batch), 'sets', factors[0][0], batch.nominal_factors()[0][0])
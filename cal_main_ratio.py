@@ -2,75 +2,161 @@
 from archive import GTCSTORE, COMPONENTSTORE
 from pathlib import Path
 import csv
-from json import loads
-from GTC import ucomplex
-from GTC.reporting import budget  # just for checks
+import time
+from GTC import ucomplex, value
 
 """
 Takes results of a Permutable Capacitor run and returns an uncertain complex value for the main 10:1 ratio. 
 """
+
+NETWORK = ['za', 'ya', 'zinta', 'y3', 'y4Y2', 'zb', 'yb', 'zintb', 'y1', 'y2Y1']  # lead network of equation 45
+
+
+class NETWORKCACHE(object):
+    def __init__(self):
+        """
+        The lead network terms of equation 45 (top and bottom) depend only on the ten lead values, not on the ratio.
+        Runs given the same cache whose files hold the same lead values (the same json strings) share one set of
+        ucomplex lead values and one evaluation of the network terms. They are then correlated through the leads, as
+        runs made with the same leads should be; runs without a cache each restore their own lead values.
+        """
+        self.entries = {}  # tuple of json strings: [tuple of ucomplex lead values, (top, bottom) or None]
+        self.hits = 0
+        self.misses = 0
+
+    def leads(self, jsons, store):
+        """
+        :param jsons: tuple of the json strings of the NETWORK values, in NETWORK order
+        :param store: GTCSTORE used to restore the values the first time they are seen
+        :return: tuple of ucomplex lead values, shared by every run with the same jsons
+        """
+        if jsons not in self.entries:
+            self.entries[jsons] = [tuple(store.json_to_ucomplex(x) for x in jsons), None]
+        return self.entries[jsons][0]
+
+    def terms(self, jsons, leads):
+        """
+        :param jsons: tuple of the json strings the lead values were restored from
+        :param leads: tuple of the ucomplex lead values now held by the run, in NETWORK order
+        :return: (top, bottom) of equation 45, evaluated once for each set of lead values
+        """
+        entry = self.entries.get(jsons)
+        shared = entry is not None and all(a is b for a, b in zip(entry[0], leads))  # not replaced by the caller
+        if shared and entry[1] is not None:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        found = network_terms(leads)
+        if shared:
+            entry[1] = found
+        return found
+
+    def stats(self):
+        """
+        :return: dictionary of hits, misses and number of lead networks held
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'networks': len(self.entries)}
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+        return
+
+
+def network_terms(leads):
+    """
+    :param leads: tuple of the ten ucomplex lead values, in NETWORK order
+    :return: (top, bottom) of equation 45
+    """
+    za, ya, zinta, y3, y4Y2, zb, yb, zintb, y1, y2Y1 = leads
+    top = 1+zb*(y2Y1 + (yb/2 + y1)*(1+zintb*y2Y1)) + zintb*y2Y1
+    bottom =1+za*(y4Y2 + (ya/2 + y3)*(1+zinta*y4Y2)) + zinta*y4Y2
+    return top, bottom
+
+
 class PERMUTE(object):
-    def __init__(self, file_path, input_file_names, output_file_name):
+    def __init__(self, file_path, input_file_names, output_file_name, **kwargs):
+        """
+        :param file_path: directory for data in/out
+        :param input_file_names: list of files, first is csv of the permutable capacitor run, second has component
+        values.
+        :param output_file_name: output can be stored in this csv file (same directory)
+        :param kwargs: registry= an archive.COMPONENTREGISTRY to share recovered components with other classes,
+        storecomp= the store that reads the second file when there is no registry (default archive.COMPONENTSTORE,
+        or e.g. a sqlite_store.SQLITESTORE for a database file), network_cache= a NETWORKCACHE shared with other
+        runs (default none, the run restores its own lead values)
+        """
+        registry = None
+        storecomp = None
+        self.network_cache = None
+        for arg in kwargs.keys():
+            if arg == 'registry':
+                registry = kwargs[arg]
+            elif arg == 'storecomp':
+                storecomp = kwargs[arg]
+            elif arg == 'network_cache':
+                self.network_cache = kwargs[arg]
         self.output_name = output_file_name  # optional store in a csv file
         self.store = GTCSTORE()
         self.data_folder = Path(file_path)
         self.r = 0.0001  # for 10:1 transformer injection through 10 pF
+        self.reference_cap = 'gr10'  # injected through, a key of the second file
         data_in = self.data_folder / input_file_names[0]
         with open(data_in, newline='') as csvfile:  # format must be correct
             reader = csv.reader(csvfile)
             counter = 0
             self.balance_dict = {}
-            switches = ['s1', 's2', 's3', 's4', 's5', 's6', 's7', 's8', 's9', 's10', 's11', 's12']
+            network = {}
             for row in reader:
                 counter += 1
-                if row[0] == 'Date':
-                    self.date_string = row[1]
-                elif row[0] == 'Reference':
-                    self.reference_string = row[1]
-                elif row[0] == 'w':  # radians per second
-                    self.w = float(row[1])
-                elif row[0] in switches:  # each switch setting has an (alpha, beta) tuple
-                    self.balance_dict[row[0]] = (float(row[1]), float(row[2]))
-                elif row[0] == 'factora':
-                    self.factora = self.store.json_to_ucomplex(row[1])
-                elif row[0] == 'factorb':
-                    self.factorb = self.store.json_to_ucomplex(row[1])
-                elif row[0] == 'za':
-                    self.za = self.store.json_to_ucomplex(row[1])
-                elif row[0] == 'ya':
-                    self.ya = self.store.json_to_ucomplex(row[1])
-                elif row[0] == 'zinta':
-                    self.zinta = self.store.json_to_ucomplex(row[1])
-                elif row[0] == 'y3':
-                    self.y3 = self.store.json_to_ucomplex(row[1])
-                elif row[0] == 'y4Y2':
-                    self.y4Y2 = self.store.json_to_ucomplex(row[1])
-                elif row[0] == 'zb':
-                    self.zb = self.store.json_to_ucomplex(row[1])
-                elif row[0] == 'yb':
-                    self.yb = self.store.json_to_ucomplex(row[1])
-                elif row[0] == 'zintb':
-                    self.zintb = self.store.json_to_ucomplex(row[1])
-                elif row[0] == 'y1':
-                    self.y1 = self.store.json_to_ucomplex(row[1])
-                elif row[0] == 'y2Y1':
-                    self.y2Y1 = self.store.json_to_ucomplex(row[1])
-                else:
+                if row[0] in NETWORK:  # lead network of equation 45, kept as the json strings
+                    network[row[0]] = row[1]
+                elif not self.read_row(row):
                     print('This row does not match. Wrong csv file? ', row)
-        assert counter == 27, "csv file incorrect length, should be 27 rows:  %r" % counter
+        self.set_network(network)
+        self.check_run(counter)
         data_in = self.data_folder / input_file_names[1]
-        with open(data_in, newline='') as csvfile:  # format must be correct
-            reader = csv.reader(csvfile)
-            for row in reader:
-                if row[0] == 'gr10':
-                    cgr10 = loads(row[1])  # a components.CAPACITOR object
-
-        cstore = COMPONENTSTORE()
-        admit_GR10 = cstore.dict_to_capacitor(cgr10).best_value  # admittance at 10000 rad/s
+        if registry is None:
+            cstore = COMPONENTSTORE() if storecomp is None else storecomp
+            cgr10 = cstore.find_component(data_in, self.reference_cap)  # a components.CAPACITOR dictionary
+            admit_GR10 = cstore.dict_to_capacitor(cgr10).best_value  # admittance at 10000 rad/s
+        else:
+            admit_GR10 = registry.capacitor(data_in, self.reference_cap).best_value
         self.GR10 = admit_GR10/(1j * self.w)
         # self.GR10 = 10e-12  # temporary value of GR10 ( to be picked up from csv)
+
+    def read_row(self, row):
+        """
+        :param row: row of the run file, other than the lead network
+        :return: True if the row was recognised
+        """
+        switches = ['s1', 's2', 's3', 's4', 's5', 's6', 's7', 's8', 's9', 's10', 's11', 's12']
+        if row[0] == 'Date':
+            self.date_string = row[1]
+        elif row[0] == 'Reference':
+            self.reference_string = row[1]
+        elif row[0] == 'w':  # radians per second
+            self.w = float(row[1])
+        elif row[0] in switches:  # each switch setting has an (alpha, beta) tuple
+            self.balance_dict[row[0]] = (float(row[1]), float(row[2]))
+        elif row[0] == 'factora':
+            self.factora = self.store.json_to_ucomplex(row[1])
+        elif row[0] == 'factorb':
+            self.factorb = self.store.json_to_ucomplex(row[1])
+        else:
+            return False
+        return True
+
+    def check_run(self, counter):
+        """
+        :param counter: number of rows in the run file
+        :return:
+        """
+        assert counter == 27, "csv file incorrect length, should be 27 rows:  %r" % counter
         self.PC = (10.000144 + 10.000304 + 10.000218 + 10.000151 + 10.000200 + 10.000138 + 9.9998906 + 10.000130
                    + 10.000025 + 10.000043 + 10.000277) * 1e-12  # sum of 11 PC capacitors, p.33 of KJ Diary2
+        return
 
     def calc_raw_ratio(self):
         # implement formula 37 and 46 of E.005.03
@@ -87,12 +173,77 @@ class PERMUTE(object):
         raw_ratio = (11-1)/(1 + (self.GR10/self.PC) * dsum * self.r)  # 0.0001 accounts for injection ratio
         return raw_ratio
 
+    def set_network(self, network):
+        """
+        Restores the lead network of equation 45 as new GTC inputs of this run, so runs are not correlated through
+        shared lead values, or takes them from network_cache if the run has one
+        :param network: dictionary of NETWORK name: json string, as read from the run file
+        :return:
+        """
+        missing = [x for x in NETWORK if x not in network]
+        assert not missing, "run file is missing %r" % missing
+        self.network_key = tuple(network[x] for x in NETWORK)
+        if self.network_cache is None:
+            leads = [self.store.json_to_ucomplex(x) for x in self.network_key]
+        else:
+            leads = self.network_cache.leads(self.network_key, self.store)
+        for x, lead_value in zip(NETWORK, leads):
+            setattr(self, x, lead_value)
+        self.network = None  # (lead values, (top, bottom)) once network_terms is called
+        return
+
+    def network_terms(self):
+        """
+        The terms depend only on the ten lead values, not on the ratio, so they are kept until a lead value is
+        replaced, in network_cache if the run has one
+        :return: (top, bottom) of equation 45
+        """
+        check = tuple(getattr(self, x) for x in NETWORK)
+        if self.network_cache is not None:
+            return self.network_cache.terms(self.network_key, check)
+        if self.network is None or not all(a is b for a, b in zip(self.network[0], check)):
+            self.network = (check, network_terms(check))
+        return self.network[1]
+
     def correct_ratio(self, uncorrected_ratio):  # equation 45 of E.005.003
-        top = 1+self.zb*(self.y2Y1 + (self.yb/2 + self.y1)*(1+self.zintb*self.y2Y1)) + self.zintb*self.y2Y1
-        bottom =1+self.za*(self.y4Y2 + (self.ya/2 + self.y3)*(1+self.zinta*self.y4Y2)) + self.zinta*self.y4Y2
+        top, bottom = self.network_terms()
         corrected = uncorrected_ratio * top / bottom
         return corrected
 
+    def iterate_ratio(self, uncorrected_ratio, **kwargs):
+        """
+        Finds the corrected ratio R = uncorrected ratio * top / bottom by fixed-point iteration, stopping when the
+        relative change in the value of R is below tol. Equation 45 does not depend on R, so this settles on the
+        second pass; correct_ratio applied to its own output is not this iteration, it applies the correction again
+        (as the published out_perm1.csv does, see __main__). The iterations, last change, time taken and whether tol
+        was met are left in self.convergence.
+        :param uncorrected_ratio: from calc_raw_ratio
+        :param kwargs: tol= relative tolerance (default 1e-12), max_iter= (default 10)
+        :return: corrected ratio
+        """
+        tol = 1e-12
+        max_iter = 10
+        for arg in kwargs.keys():
+            if arg == 'tol':
+                tol = kwargs[arg]
+            elif arg == 'max_iter':
+                max_iter = kwargs[arg]
+        start = time.perf_counter()
+        ratio = uncorrected_ratio
+        change = None
+        iterations = 0
+        while iterations < max_iter:
+            iterations += 1
+            new_ratio = self.correct_ratio(uncorrected_ratio)
+            change = abs(value(new_ratio) - value(ratio)) / abs(value(new_ratio))
+            ratio = new_ratio
+            if iterations > 1 and change < tol:
+                break
+        self.convergence = {'iterations': iterations, 'change': change, 'seconds': time.perf_counter() - start,
+                            'converged': change < tol}
+        assert self.convergence['converged'], "ratio did not converge in %r iterations: %r" % (max_iter, change)
+        return ratio
+
     def file_ratio(self, correction):
         output_file = self.data_folder / self.output_name
         with open(output_file, 'w', newline='') as csvfile:
@@ -102,7 +253,107 @@ class PERMUTE(object):
             outwriter.writerow([self.store.ucomplex_to_json(correction, new_label='main_ratio')])
 
 
+class PERMUTEN(PERMUTE):
+    def __init__(self, file_path, input_file_names, output_file_name, **kwargs):
+        """
+        Permutable capacitor run with any number of elements. The run file has the rows of a PERMUTE file, any
+        number of switch positions s1, s2, ... and optionally
+        elements: the number of elements N, giving an N-1 to 1 ratio (default, every position less the repeats)
+        repeats: the positions that repeat s1 (default none, so a run with a repeat must say which position it is)
+        pc: the N element capacitances in pF (default the 11 PC capacitors of PERMUTE)
+        reference_cap: key of the capacitor in the second file that is injected through (default gr10)
+        :param file_path: directory for data in/out
+        :param input_file_names: list of files, first is csv of the permutable capacitor run, second has component
+        values.
+        :param output_file_name: output can be stored in this csv file (same directory)
+        :param kwargs: registry= an archive.COMPONENTREGISTRY to share recovered components with other classes,
+        repeats= list of the positions that repeat s1, for run files without a repeats row (e.g. ['s12'] for
+        perm1.csv)
+        """
+        self.elements = None
+        self.repeats = None
+        self.pc = None
+        for arg in kwargs.keys():
+            if arg == 'repeats':
+                self.repeats = list(kwargs[arg])
+        PERMUTE.__init__(self, file_path, input_file_names, output_file_name,
+                         **{x: kwargs[x] for x in kwargs if x != 'repeats'})
+
+    def read_row(self, row):
+        """
+        :param row: row of the run file, other than the lead network
+        :return: True if the row was recognised
+        """
+        if row[0][:1] == 's' and row[0][1:].isdigit():  # each switch setting has an (alpha, beta) tuple
+            self.balance_dict[row[0]] = (float(row[1]), float(row[2]))
+        elif row[0] == 'elements':
+            self.elements = int(row[1])
+        elif row[0] == 'repeats':
+            self.repeats = [x for x in row[1:] if x]
+        elif row[0] == 'pc':
+            self.pc = [float(x) for x in row[1:] if x]
+        elif row[0] == 'reference_cap':
+            self.reference_cap = row[1]
+        else:
+            return PERMUTE.read_row(self, row)
+        return True
+
+    def check_run(self, counter):
+        """
+        :param counter: number of rows in the run file, any number is accepted
+        :return:
+        """
+        assert 's1' in self.balance_dict, 'the run needs an s1 position'
+        if self.repeats is None:
+            self.repeats = []
+        unknown = [x for x in self.repeats if x not in self.balance_dict or x == 's1']
+        assert not unknown, "repeats that are not repeat positions of the run: %r" % unknown
+        self.positions = [x for x in self.balance_dict if x not in self.repeats]
+        if self.elements is None:
+            self.elements = len(self.positions)
+        assert len(self.positions) == self.elements, "do not have %r balance values: %r" % (self.elements,
+                                                                                            len(self.positions))
+        pc = self.pc
+        if pc is None:
+            assert self.elements == 11, 'pc values are needed for a run that is not of the 11 PC capacitors'
+            pc = [10.000144, 10.000304, 10.000218, 10.000151, 10.000200, 10.000138, 9.9998906, 10.000130, 10.000025,
+                  10.000043, 10.000277]  # p.33 of KJ Diary2
+        assert len(pc) == self.elements, "need %r pc values: %r" % (self.elements, len(pc))
+        self.PC = sum(pc) * 1e-12
+        return
+
+    def drift(self):
+        """
+        :return: dictionary of repeat position: (alpha, beta) dial change from s1, i.e. the drift over the run
+        """
+        first = self.balance_dict['s1']
+        changes = {}
+        for x in self.repeats:
+            changes[x] = (value(self.balance_dict[x][0]) - value(first[0]),
+                          value(self.balance_dict[x][1]) - value(first[1]))
+        return changes
+
+    def calc_raw_ratio(self, **kwargs):
+        """
+        Equations 37 and 46 of E.005.03 for N elements. The factors are common to every position so the corrected
+        dial sum is factora * sum(alpha) + j factorb * sum(beta), with both sums taken over arrays in one step.
+        :param kwargs: drift_limit= largest change in either dial between s1 and its repeats that is accepted
+        :return: uncorrected N-1 to 1 ratio
+        """
+        import numpy as np  # only needed here, keeps the import of this module light
+        for arg in kwargs.keys():
+            if arg == 'drift_limit':
+                worst = max([max(abs(a), abs(b)) for a, b in self.drift().values()] + [0.0])
+                assert worst <= kwargs[arg], "drift between s1 and its repeats is %r" % worst
+        alphas = np.array([self.balance_dict[x][0] for x in self.positions])  # object arrays if ureal readings
+        betas = np.array([self.balance_dict[x][1] for x in self.positions])
+        dsum = self.factora * alphas.sum() + 1j * self.factorb * betas.sum()
+        raw_ratio = (self.elements - 1) / (1 + (self.GR10 / self.PC) * dsum * self.r)
+        return raw_ratio
+
+
 if __name__ == '__main__':
+    from GTC.reporting import budget  # just for checks
     print('Testing cal_main_ratio.py')
     ratio_cal = PERMUTE('G:\\My Drive\\KJ\\PycharmProjects\\CapacitanceScale\\datastore',
                         ['perm1.csv', 'leads_and_caps.csv'], 'out_perm1.csv')
@@ -129,6 +380,17 @@ if __name__ == '__main__':
 
     ratio_cal.file_ratio(final_ratio)
 
+    general_cal = PERMUTEN('G:\\My Drive\\KJ\\PycharmProjects\\CapacitanceScale\\datastore',
+                           ['perm1.csv', 'leads_and_caps.csv'], 'out_perm1.csv', repeats=['s12'])
+    print('N =', general_cal.elements, 'drift', general_cal.drift())
+    print('N element raw ratio', repr(general_cal.calc_raw_ratio(drift_limit=0.01)))
+    shared = NETWORKCACHE()  # runs with the same lead values share the network terms
+    for run in range(3):
+        run_cal = PERMUTEN('G:\\My Drive\\KJ\\PycharmProjects\\CapacitanceScale\\datastore',
+                           ['perm1.csv', 'leads_and_caps.csv'], 'out_perm1.csv', repeats=['s12'], network_cache=shared)
+        print('iterated ratio', repr(run_cal.iterate_ratio(run_cal.calc_raw_ratio())), run_cal.convergence)
+    print(shared.stats())
+
 
     # temporary creation of most likely values for leads etc.
     # will make ucomplex for storage
@@ -1,5 +1,7 @@
 #  python3.8 som environment
+import numpy as np
 from meas_cap_ratio import CAPSCALE
+from history import HISTORYSTORE
 from GTC import ureal
 from GTC.reporting import budget  # just for checks
 
@@ -18,6 +20,13 @@ buildup = CAPSCALE('G:\\My Drive\\KJ\\PycharmProjects\\CapacitanceScale\\datasto
                    ['in.csv', 'leads_and_caps.csv'], 'out.csv', cert)
 buildup.buildup()
 buildup.store_buildup()
+# to keep this build up in a history, set history_file to its csv file, e.g.
+# 'G:\\My Drive\\KJ\\PycharmProjects\\CapacitanceScale\\datastore\\history.csv'; a later build up can then take its
+# reference from there with history.ref_value('ah11c1', end=<date of the run>) in place of the certificate value above
+history_file = None
+if history_file is not None:
+    history = HISTORYSTORE(history_file)
+    history.append_buildup(buildup)
 
 # example uncertainty budget
 select = buildup.caps['gr1000a'].best_value
@@ -27,4 +36,13 @@ print(capacitance)
 print('budget')
 print(capacitance.u / capacitance * 1e6)
 for label, u in budget(capacitance, trim=0):
-    print("{:^20} {:.2e}   {:.3f}".format(label, u, u/capacitance.x * 1e6))
\ No newline at end of file
+    print("{:^20} {:.2e}   {:.3f}".format(label, u, u/capacitance.x * 1e6))
+
+# budgets of every capacitor in one pass, three largest components of the capacitance of each
+rows, labels, matrix = buildup.budget_matrix(top=3)
+for (key, part), components in zip(rows, matrix):
+    if part == 'imag':
+        nominal = buildup.caps[key].best_value.imag.x
+        largest = ["{} {:.3f}".format(labels[j], abs(components[j]) / nominal * 1e6)
+                   for j in np.argsort(-np.abs(components))[:3] if components[j] != 0]
+        print("{:^10} ppm: {}".format(key, ', '.join(largest)))
@@ -0,0 +1,198 @@
+#  python3.8 som environment
+from json import loads
+import numpy as np
+from components import LEAD, CAPACITOR, pi_correction
+
+"""
+Table (struct of arrays) form of many CAPACITOR objects for large customer batches. Nominal admittances are held in
+NumPy arrays, one row per capacitor, and each capacitor refers to its leads by row number in a table of distinct
+leads, so identical leads are stored once. The nominal lead corrections of every capacitor come from one vectorised
+evaluation of pi_correction. CAPACITOR objects, with their GTC uncertainties, are only made when asked for, each with
+leads of its own as when recovered from leads_and_caps.csv.
+"""
+
+
+class CAPACITORTABLE(object):
+    def __init__(self):
+        self.labels = []
+        self.rows = {}  # label: row
+        self.w = np.zeros(0)
+        self.relu = np.zeros(0)
+        self.y13 = np.zeros(0, dtype=complex)
+        self.y12 = np.zeros(0, dtype=complex)
+        self.y34 = np.zeros(0, dtype=complex)
+        self.hv = np.zeros(0, dtype=int)  # row in the lead arrays
+        self.lv = np.zeros(0, dtype=int)
+        self.best = np.zeros(0, dtype=complex)  # nominal best value, nan if not set
+        self.best_values = {}  # row: ucomplex best value, for rows that have one
+        self.lead_labels = []
+        self.lead_rows = {}  # (label, w, relu, z, y): row
+        self.lead_w = []
+        self.lead_relu = []
+        self.lead_z = []
+        self.lead_y = []
+
+    def __len__(self):
+        return len(self.labels)
+
+    def add_lead(self, label, w, relu, z, y):
+        """
+        :param label: label of the lead
+        :param w: angular frequency in radians per second
+        :param relu: relative uncertainty of the lead values
+        :param z: nominal complex series impedance
+        :param y: nominal complex admittance to screen
+        :return: row of the lead, shared with any identical lead already in the table
+        """
+        key = (label, w, relu, z, y)
+        if key not in self.lead_rows:
+            self.lead_rows[key] = len(self.lead_labels)
+            self.lead_labels.append(label)
+            self.lead_w.append(w)
+            self.lead_relu.append(relu)
+            self.lead_z.append(z)
+            self.lead_y.append(y)
+        return self.lead_rows[key]
+
+    def extend(self, rows):
+        """
+        Appends capacitors in one step
+        :param rows: list of (label, w, relu, y13, y12, y34, hv lead row, lv lead row, nominal best value or nan)
+        :return:
+        """
+        if not rows:
+            return
+        start = len(self.labels)
+        label, w, relu, y13, y12, y34, hv, lv, best = zip(*rows)
+        for i, x in enumerate(label):
+            self.rows[x] = start + i
+        self.labels.extend(label)
+        self.w = np.concatenate((self.w, w))
+        self.relu = np.concatenate((self.relu, relu))
+        self.y13 = np.concatenate((self.y13, y13))
+        self.y12 = np.concatenate((self.y12, y12))
+        self.y34 = np.concatenate((self.y34, y34))
+        self.hv = np.concatenate((self.hv, np.asarray(hv, dtype=int)))
+        self.lv = np.concatenate((self.lv, np.asarray(lv, dtype=int)))
+        self.best = np.concatenate((self.best, np.asarray(best, dtype=complex)))
+        return
+
+    def lead_corrections(self, **kwargs):
+        """
+        Nominal lead corrections of all (or some) capacitors in one evaluation of equation 40
+        :param kwargs: rows= array of rows (default all)
+        :return: complex array of corrections so that true Y = measured Y + correction
+        """
+        rows = slice(None)
+        for arg in kwargs.keys():
+            if arg == 'rows':
+                rows = kwargs[arg]
+        lead_z = np.asarray(self.lead_z, dtype=complex)
+        lead_y = np.asarray(self.lead_y, dtype=complex)
+        hv = self.hv[rows]
+        lv = self.lv[rows]
+        return pi_correction(lead_z[hv], lead_y[hv], lead_z[lv], lead_y[lv], self.y12[rows], self.y34[rows],
+                             self.y13[rows])
+
+    def lead(self, row):
+        """
+        :param row: row in the lead arrays
+        :return: new LEAD object with its own GTC inputs, as COMPONENTSTORE.dict_to_lead gives for each capacitor, so
+        capacitors that share a row of the table are not correlated through their leads
+        """
+        w = self.lead_w[row]
+        z = self.lead_z[row]
+        y = self.lead_y[row]
+        return LEAD(self.lead_labels[row], (z.real, z.imag / w), (y.real, y.imag / w), w, self.lead_relu[row])
+
+    def capacitor(self, label):
+        """
+        :param label: capacitor label
+        :return: CAPACITOR object with full GTC uncertainties, as COMPONENTSTORE.dict_to_capacitor would give
+        """
+        i = self.rows[label]
+        w = self.w[i]
+        cap = CAPACITOR(label, (self.y13[i].real, self.y13[i].imag / w), (self.y12[i].real, self.y12[i].imag / w),
+                        (self.y34[i].real, self.y34[i].imag / w), w, self.lead(self.hv[i]), self.lead(self.lv[i]),
+                        self.relu[i])
+        if i in self.best_values:
+            cap.set_best_value(self.best_values[i])
+        return cap
+
+    def capacitors(self):
+        """
+        :return: dictionary of CAPACITOR objects keyed by label
+        """
+        caps = {}
+        for x in self.labels:
+            caps[x] = self.capacitor(x)
+        return caps
+
+
+def table_from_capacitors(caps):
+    """
+    :param caps: dictionary of CAPACITOR objects, keyed by the labels to use in the table
+    :return: CAPACITORTABLE object
+    """
+    table = CAPACITORTABLE()
+    rows = []
+    for x in caps:
+        cap = caps[x]
+        hv = table.add_lead(cap.hvlead.label, cap.hvlead.w, cap.hvlead.relu, cap.hvlead.z.x, cap.hvlead.y.x)
+        lv = table.add_lead(cap.lvlead.label, cap.lvlead.w, cap.lvlead.relu, cap.lvlead.z.x, cap.lvlead.y.x)
+        best = getattr(cap, 'best_value', None)
+        if best is not None:
+            table.best_values[len(rows)] = best
+        rows.append((x, cap.w, cap.relu, cap.y13.x, cap.y12.x, cap.y34.x, hv, lv,
+                     best.x if best is not None else complex(np.nan, np.nan)))
+    table.extend(rows)
+    return table
+
+
+def table_from_dicts(dicts):
+    """
+    Builds a table straight from capacitor_to_dict dictionaries, e.g. from COMPONENTSTORE.iter_component_dicts, with
+    no GTC objects made. Best values are kept as nominal values only. Lead dictionaries are skipped.
+    :param dicts: iterable of (key, dictionary) tuples
+    :return: CAPACITORTABLE object
+    """
+    table = CAPACITORTABLE()
+    rows = []
+
+    def lead_row(filed):
+        z = loads(filed['z'])
+        y = loads(filed['y'])
+        return table.add_lead(filed['label'], filed['w'], filed['relu'], complex(z['xreal'], z['ximag']),
+                              complex(y['xreal'], y['ximag']))
+
+    for key, filed in dicts:
+        if 'nom_cap' not in filed:
+            continue
+        w = filed['ang_freq']
+        best = complex(np.nan, np.nan)
+        if filed['flag'] == 'best value set':
+            value = loads(filed['best_value'])
+            best = complex(value['xreal'], value['ximag'])
+        rows.append((key, w, filed['relu'], complex(filed['nom_cap'][0], filed['nom_cap'][1] * w),
+                     complex(filed['yhv'][0], filed['yhv'][1] * w), complex(filed['ylv'][0], filed['ylv'][1] * w),
+                     lead_row(filed['hv_lead']), lead_row(filed['lv_lead']), best))
+    table.extend(rows)
+    return table
+
+
+if __name__ == '__main__':
+    from archive import COMPONENTSTORE
+    import time
+    print('Testing capacitor_table.py')
+    storecomp = COMPONENTSTORE()
+    file_name = 'G:\\My Drive\\KJ\\PycharmProjects\\CapacitanceScale\\datastore\\leads_and_caps.csv'
+    table = table_from_dicts(storecomp.iter_component_dicts(file_name))
+    print(len(table), 'capacitors', len(table.lead_labels), 'distinct leads')
+    start = time.perf_counter()
+    corrections = table.lead_corrections()
+    print('vectorised', time.perf_counter() - start)
+    caps = table.capacitors()
+    start = time.perf_counter()
+    one_by_one = [caps[x].lead_correction().x for x in caps]
+    print('one at a time', time.perf_counter() - start)
+    print('largest difference', np.max(np.abs(corrections - np.array(one_by_one))))
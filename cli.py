@@ -0,0 +1,145 @@
+#  python3.8 som environment
+import argparse
+import sys
+
+"""
+Command line entry point, e.g.
+    python cli.py run datastore
+    python cli.py dials datastore --input test.csv --output out_test.csv
+    python cli.py ratio datastore --input perm1.csv --output out_perm1.csv
+    python cli.py budget datastore --top 3
+    python cli.py customers datastore --devices customers.csv
+Only argparse is imported at start up. GTC (which brings in NumPy and SciPy) and the calibration modules are imported
+by the subcommand that needs them, so --help and argument errors return at once and each subcommand loads no more
+than its own chain of modules.
+"""
+
+# NMIA certificate value of AH11C1, as in cap_scale.py
+CERTIFICATE = {'cap': 99.999581e-12, 'ucap': 0.11e-6, 'dfact': 1.9e-6, 'udfact': 0.6e-6, 'df': 50}
+
+
+def reference_value(args, w):
+    """
+    :param args: parsed arguments with reference (json string of a ucomplex) or the certificate values
+    :param w: angular frequency of the build up
+    :return: ucomplex admittance of AH11C1
+    """
+    if args.reference is not None:
+        from archive import GTCSTORE
+        return GTCSTORE().json_to_ucomplex(args.reference)
+    from GTC import ureal
+    g = ureal(args.dfact * w * args.cap, args.udfact / 2 * w * args.cap, args.df, label='ah11c1d')
+    c = ureal(args.cap, args.cap * args.ucap / 2, args.df, label='ah11c1c')
+    return g + 1j * w * c
+
+
+def built_scale(args):
+    from meas_cap_ratio import CAPSCALE
+    scale = CAPSCALE(args.folder, [args.input, args.components], args.output, None)
+    scale.ref_cap = reference_value(args, scale.w)
+    scale.buildup()
+    return scale
+
+
+def run(args):
+    scale = built_scale(args)
+    if not args.no_store:
+        scale.store_buildup()
+    for x in scale.caps:
+        capacitance = scale.caps[x].best_value.imag / scale.w
+        print("{:^10} {:16.10f} pF  u {:.2e} pF".format(x, capacitance.x * 1e12, capacitance.u * 1e12))
+    return 0
+
+
+def dials(args):
+    from cal_balance import DIALCAL
+    cal_dials = DIALCAL(args.folder, [args.input, args.components], args.output)
+    factora, factorb = cal_dials.dialfactors(file_output=not args.no_store, append=args.append)
+    print('factora', factora)
+    print('factorb', factorb)
+    return 0
+
+
+def ratio(args):
+    from cal_main_ratio import PERMUTE
+    ratio_cal = PERMUTE(args.folder, [args.input, args.components], args.output)
+    main_ratio = ratio_cal.correct_ratio(ratio_cal.calc_raw_ratio())
+    main_ratio = ratio_cal.correct_ratio(main_ratio)  # applied twice, as cal_main_ratio.py files it in out_perm1.csv
+    if not args.no_store:
+        ratio_cal.file_ratio(main_ratio)
+    print('main ratio', repr(main_ratio))
+    print('deviation from 10 (ppm)', (main_ratio.real.x / 10 - 1) * 1e6)
+    return 0
+
+
+def budget(args):
+    scale = built_scale(args)
+    keys = args.caps if args.caps else list(scale.caps.keys())
+    rows, labels, matrix = scale.budget_matrix(caps=keys, top=args.top)
+    for (key, part), components in zip(rows, matrix):
+        if part == 'imag':  # capacitance
+            nominal = scale.caps[key].best_value.imag.x
+            print(key, 'u', scale.caps[key].best_value.imag.u / nominal * 1e6, 'ppm')
+            for j in sorted(components.nonzero()[0], key=lambda i: -abs(components[i])):
+                print("    {:<28} {:10.4f} ppm".format(labels[j], abs(components[j]) / nominal * 1e6))
+    return 0
+
+
+def customers(args):
+    from customer_cal import CUSTOMERCAL
+    scale = built_scale(args)
+    folder = scale.data_folder
+    count = CUSTOMERCAL(scale).calibrate(folder / args.devices, folder / args.results, append=args.append)
+    print(count, 'devices calibrated, results in', folder / args.results)
+    return 0
+
+
+def parser():
+    top = argparse.ArgumentParser(prog='capscale', description='Capacitance scale build up and calibrations')
+    commands = top.add_subparsers(dest='command', required=True)
+
+    def add_command(name, function, description, input_file, output_file):
+        command = commands.add_parser(name, help=description, description=description)
+        command.add_argument('folder', help='folder holding the csv files')
+        command.add_argument('--input', default=input_file, help='run file (default %(default)s)')
+        command.add_argument('--components', default='leads_and_caps.csv',
+                             help='leads and capacitors file (default %(default)s)')
+        command.add_argument('--output', default=output_file, help='output csv file (default %(default)s)')
+        command.set_defaults(function=function)
+        return command
+
+    def add_reference(command):
+        command.add_argument('--reference', default=None, help='json string of the ucomplex value of AH11C1, '
+                                                               'instead of the certificate values below')
+        for key in CERTIFICATE:
+            command.add_argument('--' + key, type=type(CERTIFICATE[key]), default=CERTIFICATE[key],
+                                 help='certificate value (default %(default)s)')
+        return command
+
+    command = add_reference(add_command('run', run, 'build up all the capacitors', 'in.csv', 'out.csv'))
+    command.add_argument('--no-store', action='store_true', help='do not write the output file')
+    command = add_command('dials', dials, 'calibrate the balance dial factors', 'test.csv', 'out_test.csv')
+    command.add_argument('--append', action='store_true', help='append to the output file')
+    command.add_argument('--no-store', action='store_true', help='do not write the output file')
+    command = add_command('ratio', ratio, 'main 10:1 ratio from a permutable capacitor run', 'perm1.csv',
+                          'out_perm1.csv')
+    command.add_argument('--no-store', action='store_true', help='do not write the output file')
+    command = add_reference(add_command('budget', budget, 'uncertainty budgets of the built up capacitors',
+                                        'in.csv', 'out.csv'))
+    command.add_argument('--caps', nargs='*', default=None, help='capacitor keys (default all)')
+    command.add_argument('--top', type=int, default=5, help='components listed per capacitor (default %(default)s)')
+    command = add_reference(add_command('customers', customers, 'calibrate customer devices against the build up',
+                                        'in.csv', 'out.csv'))
+    command.add_argument('--devices', default='customers.csv', help='device csv file (default %(default)s)')
+    command.add_argument('--results', default='out_customers.csv', help='results csv file (default %(default)s)')
+    command.add_argument('--append', action='store_true', help='append to the results file')
+    return top
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    return args.function(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,12 +1,114 @@
 #  python3.8 som environment
+import threading
+import weakref
 from GTC import ucomplex
-from GTC.reporting import budget  # just for checks
 
 """
 Develop classes and methods for dealing efficiently with lead corrections in impedance bridges.
 """
 
 
+def pi_correction(hv_z, hv_y, lv_z, lv_y, y12, y34, y13):
+    """
+    Lead correction of a two terminal-pair capacitor connected through hv and lv leads. Only arithmetic is used so
+    the arguments can be ucomplex, complex or NumPy arrays of samples (see monte_carlo.py).
+    :param hv_z: series impedance of the hv lead
+    :param hv_y: admittance to screen of the hv lead
+    :param lv_z: series impedance of the lv lead
+    :param lv_y: admittance to screen of the lv lead
+    :param y12: admittance to screen at the HV terminal of the capacitor
+    :param y34: admittance to screen at the LV terminal of the capacitor
+    :param y13: direct admittance of the capacitor
+    :return: correction so that true Y = measured Y + correction
+    """
+    # from A3, Figure 7, equation 40 of E.005.003
+    z1 = hv_z
+    y1 = hv_y / 2 + y12  # half lead capacitance plus screen capacitance.
+    z2 = lv_z
+    y2 = y34 + lv_y / 2  # screen capacitance plus half lead capacitance
+    b = z1 + z2 + z1 * z2 * (y1 + y2)
+    # y_meas = y13 / (a + b * y13) with a = 1 + z1 * y1 + z2 * y2 + z1 * y1 * z2 * y2. The correction y13 - y_meas is
+    # a few parts in 1e7 of y13, so it is taken as y13 * (a - 1 + b * y13) / (a + b * y13) rather than by subtraction,
+    # which would leave only about 9 significant digits
+    small = z1 * y1 + z2 * y2 + z1 * y1 * z2 * y2 + b * y13  # a - 1 + b * y13
+    correction = y13 * small / (1 + small)  # i.e. y13 = y_meas + correction
+    return correction
+
+
+class CORRECTIONCACHE(object):
+    def __init__(self):
+        """
+        Memoises lead corrections per (capacitor, hv lead, lv lead, w). An entry is only reused if the capacitor
+        and both leads still hold the very same z, y, y12, y34 and y13 objects, so replacing a lead's values (or
+        the lead itself) forces a fresh calculation. Entries disappear with the capacitor they belong to. One lock
+        guards the entries and the statistics, as build ups on threads (e.g. batch_scale.py) share the cache.
+        """
+        self.lock = threading.RLock()
+        self.enabled = True
+        self.entries = weakref.WeakKeyDictionary()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def correction(self, component, hv, lv):
+        """
+        :param component: CAPACITOR or PARALLEL object
+        :param hv: LEAD (or CONNECT) object at the HV terminal
+        :param lv: LEAD (or CONNECT) object at the LV terminal
+        :return: ucomplex correction so that true Y = measured Y + correction
+        """
+        if not self.enabled:
+            return pi_correction(hv.z, hv.y, lv.z, lv.y, component.y12, component.y34, component.y13)
+        with self.lock:
+            key = (id(hv), id(lv), component.w)
+            check = (hv, lv, hv.z, hv.y, lv.z, lv.y, component.y12, component.y34, component.y13)
+            entries = self.entries.setdefault(component, {})
+            if key in entries:
+                stored, value = entries[key]
+                if all(a is b for a, b in zip(stored, check)):
+                    self.hits += 1
+                    return value
+                self.invalidations += 1
+            self.misses += 1
+            value = pi_correction(hv.z, hv.y, lv.z, lv.y, component.y12, component.y34, component.y13)
+            entries[key] = (check, value)  # check holds the leads so their ids are not reused
+            return value
+
+    def invalidate(self, component):
+        """
+        Drops all the cached corrections of a capacitor
+        :param component: CAPACITOR or PARALLEL object
+        :return:
+        """
+        with self.lock:
+            if self.entries.pop(component, None):
+                self.invalidations += 1
+        return
+
+    def stats(self):
+        """
+        :return: dictionary of hits, misses, invalidations and number of capacitors with cached corrections
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'invalidations': self.invalidations,
+                    'capacitors': len(self.entries)}
+
+    def clear(self):
+        """
+        Empties the cache and resets the statistics
+        :return:
+        """
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.invalidations = 0
+        return
+
+
+lead_cache = CORRECTIONCACHE()  # shared by all CAPACITOR and PARALLEL objects
+
+
 class LEAD(object):
     def __init__(self, name, series_z, parallel_y, ang_freq, rel_u):
         """
@@ -41,6 +143,7 @@ class CONNECT(object):
         assert lead1.relu == lead2.relu, 'leads need same relative uncertainty'
         self.relu = lead1.relu
         self.label = lead1.label + lead2.label  # not really used as it is an intermediate calculation step
+        self.leads = (lead1, lead2)  # the elementary inputs are in these (see lead_inputs)
         self.z = lead1.z + lead2.z
         self.y = lead1.y + lead2.y
 
@@ -80,16 +183,7 @@ class CAPACITOR(object):
         connects the hv and lv leads to capacitor and calculates the modified value of the capacitor
         :return: ucomplex correction so that true Y = measured Y + correction
         """
-        # from A3, Figure 7, equation 40 of E.005.003
-        z1 = self.hvlead.z
-        y1 = self.hvlead.y / 2 + self.y12  # half lead capacitance plus screen capacitance.
-        z2 = self.lvlead.z
-        y2 = self.y34 + self.lvlead.y / 2  # screen capacitance plus half lead capacitance
-        a = 1 + z1 * y1 + z2 * y2 + z1 * y1 * z2 * y2
-        b = z1 + z2 + z1 * z2 * (y1 + y2)
-        y_meas = self.y13 / (a + b * self.y13)
-        correction = self.y13 - y_meas  # i.e. y13 = y_meas + correction
-        return correction
+        return lead_cache.correction(self, self.hvlead, self.lvlead)
 
     def set_best_value(self, value):
         """
@@ -110,6 +204,7 @@ class CAPACITOR(object):
         """
         self.hvlead = hv
         self.lvlead = lv
+        lead_cache.invalidate(self)
         return
 
 class PARALLEL(object):
@@ -125,6 +220,7 @@ class PARALLEL(object):
         assert cap1.w == cap2.w, 'Both CAPACITOR objects must be defined at same frequency'
         self.w = cap1.w
         self.label = cap1.label + cap2.label
+        self.caps = (cap1, cap2)  # the elementary inputs are in these and their leads (see capacitor_inputs)
         assert cap1.relu == cap2.relu, 'capacitors need same relative uncertainty'
         self.relu = cap1.relu
         self.y13 = cap1.y13 + cap2.y13
@@ -138,16 +234,7 @@ class PARALLEL(object):
         connects the hv and lv leads to capacitor and calculates the modified value of the capacitor
         :return: ucomplex correction so that true Y = measured Y + correction
         """
-        # from A3, Figure 7, equation 40 of E.005.003
-        z1 = self.hvlead.z
-        y1 = self.hvlead.y / 2 + self.y12  # half lead capacitance plus screen capacitance.
-        z2 = self.lvlead.z
-        y2 = self.y34 + self.lvlead.y / 2  # screen capacitance plus half lead capacitance
-        a = 1 + z1 * y1 + z2 * y2 + z1 * y1 * z2 * y2
-        b = z1 + z2 + z1 * z2 * (y1 + y2)
-        y_meas = self.y13 / (a + b * self.y13)
-        correction = self.y13 - y_meas  # i.e. y13 = y_meas + correction
-        return correction
+        return lead_cache.correction(self, self.hvlead, self.lvlead)
 
     def set_best_value(self, value):
         """
@@ -160,7 +247,31 @@ class PARALLEL(object):
         return
 
 
+def lead_inputs(lead):
+    """
+    :param lead: LEAD or CONNECT object
+    :return: list of the ucomplex inputs (z and y of each lead) it is made from
+    """
+    if hasattr(lead, 'leads'):
+        return lead_inputs(lead.leads[0]) + lead_inputs(lead.leads[1])
+    return [lead.z, lead.y]
+
+
+def capacitor_inputs(cap):
+    """
+    :param cap: CAPACITOR or PARALLEL object
+    :return: list of the ucomplex inputs of its admittances, with the leads of paralleled capacitors
+    """
+    if hasattr(cap, 'caps'):
+        found = []
+        for x in cap.caps:
+            found = found + capacitor_inputs(x) + lead_inputs(x.hvlead) + lead_inputs(x.lvlead)
+        return found
+    return [cap.y13, cap.y12, cap.y34]
+
+
 if __name__ == '__main__':
+    from GTC.reporting import budget  # just for checks
     relu = 0.05
     print('Testing components.py')
     w = 1e4
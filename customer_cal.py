@@ -0,0 +1,136 @@
+#  python3.8 som environment
+from archive import GTCSTORE
+from components import CAPACITOR, lead_cache
+import csv
+
+"""
+Calibration of customer capacitors against the capacitors of a completed build up. Each device is compared by one
+ratio measurement with a reference capacitor of CAPSCALE.caps, exactly as the build up goes from one capacitor to the
+next: the reference value seen at the end of its leads is cap_ratio'd to the device and the device's own lead
+correction is added. The optional columns ref_hv_lead and ref_lv_lead put the reference on other leads of
+CAPSCALE.leads for the comparison. A csv file of devices is read and the results written one row at a time, so a
+batch of any size is never held in memory.
+"""
+
+FIELDS = ['device', 'reference', 'alpha', 'beta', 'inverse', 'nominal_pF', 'yhv_pF', 'ylv_pF', 'hv_lead', 'lv_lead']
+OPTIONAL_FIELDS = ['ref_hv_lead', 'ref_lv_lead']  # leads of the reference, if not those it has after the build up
+OUTPUT_FIELDS = ['device', 'reference', 'capacitance_pF', 'u_capacitance_pF', 'conductance_nS', 'u_conductance_nS',
+                 'best_value']
+
+
+class CUSTOMERCAL(object):
+    def __init__(self, scale, **kwargs):
+        """
+        :param scale: a meas_cap_ratio.CAPSCALE object after buildup(). Unless a row gives ref_hv_lead and
+        ref_lv_lead, the reference capacitors keep the leads they have at that point, i.e. ah11c1 is on the hv2 and
+        hv1 leads without the transformer.
+        :param kwargs: relu= relative uncertainty of the device screen admittances (default 0.01, as the build up)
+        """
+        self.scale = scale
+        self.relu = 0.01
+        for arg in kwargs.keys():
+            if arg == 'relu':
+                self.relu = kwargs[arg]
+        self.store = GTCSTORE()
+        self.references = {}  # (key, hv lead, lv lead): reference value at the end of the leads
+        self.count = 0
+
+    def reference(self, key, **kwargs):
+        """
+        :param key: key of a capacitor in scale.caps
+        :param kwargs: hv_lead= and lv_lead= keys of scale.leads the reference is measured on (default the leads it
+        has after the build up)
+        :return: the value of the reference as measured, i.e. best_value less its lead correction, found once per key
+        and pair of leads
+        """
+        hv_lead = None
+        lv_lead = None
+        for arg in kwargs.keys():
+            if arg == 'hv_lead':
+                hv_lead = kwargs[arg] or None
+            elif arg == 'lv_lead':
+                lv_lead = kwargs[arg] or None
+        if (key, hv_lead, lv_lead) not in self.references:
+            cap = self.scale.caps[key]
+            if hv_lead is None and lv_lead is None:
+                correction = cap.lead_correction()
+            else:
+                assert hv_lead is not None and lv_lead is not None, "need both leads of reference %r" % key
+                correction = lead_cache.correction(cap, self.scale.leads[hv_lead], self.scale.leads[lv_lead])
+            self.references[(key, hv_lead, lv_lead)] = cap.best_value - correction
+        return self.references[(key, hv_lead, lv_lead)]
+
+    def device(self, name, nominal, yhv, ylv, hv_lead, lv_lead):
+        """
+        :param name: device name, the label of the CAPACITOR and so of its GTC inputs
+        :param nominal: nominal capacitance in pF
+        :param yhv: capacitance to screen at the HV terminal in pF
+        :param ylv: capacitance to screen at the LV terminal in pF
+        :param hv_lead: key of scale.leads
+        :param lv_lead: key of scale.leads
+        :return: CAPACITOR object, a new one for each device
+        """
+        return CAPACITOR(name, (0.0, nominal * 1e-12), (0.0, yhv * 1e-12), (0.0, ylv * 1e-12), self.scale.w,
+                         self.scale.leads[hv_lead], self.scale.leads[lv_lead], self.relu)
+
+    def device_value(self, row):
+        """
+        :param row: dictionary with the FIELDS of one device, and optionally OPTIONAL_FIELDS; hv_lead and lv_lead may
+        be empty for no lead correction
+        :return: ucomplex admittance of the device with no leads
+        """
+        balance = (float(row['alpha']), float(row['beta']))
+        inverse = row['inverse'].strip().lower() in ('1', 'true', 'yes')
+        reference = self.reference(row['reference'], hv_lead=row.get('ref_hv_lead'), lv_lead=row.get('ref_lv_lead'))
+        value = self.scale.cap_ratio(balance, reference, inverse)
+        if row['hv_lead'] and row['lv_lead']:
+            dut = self.device(row['device'], float(row['nominal_pF']), float(row['yhv_pF'] or 0),
+                              float(row['ylv_pF'] or 0), row['hv_lead'], row['lv_lead'])
+            value = value + dut.lead_correction()
+        return value
+
+    def calibrate(self, input_file, output_file, **kwargs):
+        """
+        Streams a csv file of devices (a header row of FIELDS, then one device per row) to a csv file of results
+        :param input_file: full name of the device file
+        :param output_file: full name of the results file
+        :param kwargs: append= True to add to an existing results file without a new header
+        :return: number of devices calibrated
+        """
+        append = False
+        for arg in kwargs.keys():
+            if arg == 'append':
+                append = kwargs[arg]
+        count = 0
+        w = self.scale.w
+        with open(input_file, newline='') as infile, open(output_file, 'a' if append else 'w', newline='') as outfile:
+            reader = csv.DictReader(infile)
+            missing = [x for x in FIELDS if x not in (reader.fieldnames or [])]
+            assert not missing, "device file is missing columns: %r" % missing
+            writer = csv.writer(outfile)
+            if not append:
+                writer.writerow(OUTPUT_FIELDS)
+            for row in reader:
+                value = self.device_value(row)
+                capacitance = value.imag / w
+                writer.writerow([row['device'], row['reference'], capacitance.x * 1e12, capacitance.u * 1e12,
+                                 value.real.x * 1e9, value.real.u * 1e9,
+                                 self.store.ucomplex_to_json(value, new_label=row['device'])])
+                count += 1
+        self.count += count
+        return count
+
+
+if __name__ == '__main__':
+    from GTC import ureal
+    from meas_cap_ratio import CAPSCALE
+    print('Testing customer_cal.py')
+    w = 1e4
+    cap = 99.999581e-12
+    g = ureal(1.9e-6 * w * cap, 0.6e-6 / 2 * w * cap, 50, label='ah11c1d')
+    c = ureal(cap, cap * 0.11e-6 / 2, 50, label='ah11c1c')
+    folder = 'G:\\My Drive\\KJ\\PycharmProjects\\CapacitanceScale\\datastore\\'
+    scale = CAPSCALE(folder, ['in.csv', 'leads_and_caps.csv'], 'out.csv', g + 1j * w * c)
+    scale.buildup()
+    customers = CUSTOMERCAL(scale)
+    print(customers.calibrate(folder + 'customers.csv', folder + 'out_customers.csv'), 'devices calibrated')
@@ -0,0 +1,316 @@
+#  python3.8 som environment
+from archive import GTCSTORE
+from bisect import bisect_left, bisect_right
+from datetime import date, datetime
+from json import dumps, loads
+from pathlib import Path
+import csv
+import io
+
+"""
+History of capacitor values. Every build up (or certificate, or old out.csv snapshot) is appended to one csv file as
+a row per capacitor of [key, date, reference, w, capacitance pF, u pF, json ucomplex best value]; rows are never
+rewritten. An index of the rows of each key in date order (byte offset and length) is kept in memory and in a .idx
+file beside the csv file. As the file only grows, a stale index is brought up to date by reading the new rows at its
+end. Range and latest value queries read only the rows they return, and drift fits are kept until a new point for
+that capacitor arrives.
+"""
+
+FIELDS = ['key', 'date', 'reference', 'w', 'capacitance_pF', 'u_capacitance_pF', 'best_value']
+
+
+def iso_date(when):
+    """
+    :param when: datetime.date, or a string such as '2019-11-15' or '15 November 2019' (as in the Date rows), or
+    just '2019-11' or '2019' for the first day of the month or year
+    :return: 'yyyy-mm-dd' string, which sorts in date order
+    """
+    if isinstance(when, date):
+        return when.strftime('%Y-%m-%d')
+    for form in ['%Y-%m-%d', '%d %B %Y', '%d %b %Y', '%Y-%m', '%Y']:
+        try:
+            return datetime.strptime(when.strip(), form).strftime('%Y-%m-%d')
+        except ValueError:
+            pass
+    raise ValueError('date not understood: %r' % when)
+
+
+class HISTORYSTORE(object):
+    def __init__(self, file_name):
+        """
+        :param file_name: full name of the history csv file, made if it does not exist
+        """
+        self.file_name = Path(file_name)
+        self.store = GTCSTORE()
+        self.size = 0  # bytes of the csv file covered by the index
+        self.entries = {}  # key: [[date, offset, length], ...] in date order
+        self.fits = {}  # key: drift fit, dropped when a point is added for the key
+        if not self.file_name.exists():
+            with open(self.file_name, 'w', newline='') as csvfile:
+                csv.writer(csvfile).writerow(FIELDS)
+        self.load_index()
+
+    def add_entry(self, key, when, offset, length):
+        entries = self.entries.setdefault(key, [])
+        entry = [when, offset, length]
+        if not entries or entries[-1][0] <= when:
+            entries.append(entry)  # the usual case, results are added in date order
+        else:
+            entries.insert(bisect_right([x[0] for x in entries], when), entry)
+        self.fits.pop(key, None)
+        return
+
+    def index_from(self, start):
+        """
+        Indexes the rows of the csv file after byte start
+        :param start: byte offset of the first row not yet indexed
+        :return: number of rows indexed
+        """
+        count = 0
+        offset = start
+        with open(self.file_name, 'rb') as csvfile:
+            csvfile.seek(start)
+            for line in csvfile:
+                row = next(csv.reader([line.decode()]), None)
+                if row and row[0] != FIELDS[0]:
+                    self.add_entry(row[0], row[1], offset, len(line))
+                    count += 1
+                offset += len(line)
+        self.size = offset
+        return count
+
+    def load_index(self):
+        """
+        Takes the index from the .idx file if there is one, then indexes any rows appended since
+        :return:
+        """
+        self.entries = {}
+        self.fits = {}
+        self.size = 0
+        size = self.file_name.stat().st_size
+        try:
+            with open(str(self.file_name) + '.idx') as index_file:
+                stored = loads(index_file.read())
+            if stored['size'] <= size:
+                self.entries = stored['entries']
+                self.size = stored['size']
+        except (OSError, ValueError, KeyError):
+            pass
+        if self.index_from(self.size):
+            self.save_index()
+        return
+
+    def save_index(self):
+        try:
+            with open(str(self.file_name) + '.idx', 'w') as index_file:
+                index_file.write(dumps({'size': self.size, 'entries': self.entries}))
+        except OSError:  # e.g. a read only folder, the index is then only kept in memory
+            pass
+        return
+
+    def refresh(self):
+        """
+        Indexes rows appended by anyone else since the index was last brought up to date
+        :return: number of new rows
+        """
+        size = self.file_name.stat().st_size
+        if size < self.size:  # not append only after all
+            self.load_index()
+            return 0
+        return self.index_from(self.size) if size > self.size else 0
+
+    def append(self, points):
+        """
+        Appends results in one write
+        :param points: list of (key, date, reference, ucomplex admittance, w) tuples
+        :return:
+        """
+        self.refresh()
+        lines = []
+        for key, when, reference, admittance, w in points:
+            capacitance = admittance.imag / w
+            lines.append((key, iso_date(when), [key, iso_date(when), reference, w, capacitance.x * 1e12,
+                                                capacitance.u * 1e12,
+                                                self.store.ucomplex_to_json(admittance, new_label=key)]))
+        with open(self.file_name, 'ab') as csvfile:
+            csvfile.seek(0, io.SEEK_END)
+            offset = csvfile.tell()
+            if offset > self.size:  # rows appended by anyone else since the refresh
+                self.index_from(self.size)
+            for key, when, row in lines:
+                line = csv_line(row)
+                csvfile.write(line)
+                self.add_entry(key, when, offset, len(line))
+                offset += len(line)
+            self.size = offset
+        self.save_index()
+        return
+
+    def append_buildup(self, scale, **kwargs):
+        """
+        :param scale: a meas_cap_ratio.CAPSCALE object after buildup()
+        :param kwargs: when= date of the results (default the Date row of the run file), reference= (default the
+        Reference row of the run file)
+        :return:
+        """
+        when = scale.date_string
+        reference = scale.reference_string
+        for arg in kwargs.keys():
+            if arg == 'when':
+                when = kwargs[arg]
+            elif arg == 'reference':
+                reference = kwargs[arg]
+        self.append([(x, when, reference, scale.caps[x].best_value, scale.w) for x in scale.caps])
+        return
+
+    def import_snapshot(self, file_name, when, **kwargs):
+        """
+        Adds the best values of an out.csv file written by CAPSCALE.store_buildup
+        :param file_name: full name of the snapshot
+        :param when: date of the build up it holds
+        :param kwargs: reference= (default the file name)
+        :return: number of capacitors added
+        """
+        reference = Path(file_name).name
+        for arg in kwargs.keys():
+            if arg == 'reference':
+                reference = kwargs[arg]
+        points = []
+        with open(file_name, newline='') as csvfile:
+            for row in csv.reader(csvfile):
+                filed = loads(row[2])
+                if filed.get('flag') == 'best value set':
+                    points.append((row[0], when, reference, self.store.json_to_ucomplex(filed['best_value']),
+                                   filed['ang_freq']))
+        self.append(points)
+        return len(points)
+
+    def rows(self, key, **kwargs):
+        """
+        :param key: capacitor key
+        :param kwargs: start= and end= dates, inclusive (default no limit)
+        :return: list of the rows of the key in date order, as lists of FIELDS strings
+        """
+        self.refresh()
+        entries = self.entries.get(key, [])
+        dates = [x[0] for x in entries]
+        first = 0
+        last = len(entries)
+        for arg in kwargs.keys():
+            if arg == 'start' and kwargs[arg] is not None:
+                first = bisect_left(dates, iso_date(kwargs[arg]))
+            elif arg == 'end' and kwargs[arg] is not None:
+                last = bisect_right(dates, iso_date(kwargs[arg]))
+        found = []
+        with open(self.file_name, 'rb') as csvfile:
+            for when, offset, length in entries[first:last]:
+                csvfile.seek(offset)
+                found.append(next(csv.reader([csvfile.read(length).decode()])))
+        return found
+
+    def values(self, key, **kwargs):
+        """
+        :param key: capacitor key
+        :param kwargs: start= and end= dates, inclusive
+        :return: list of (date, capacitance pF, u pF), with no GTC objects made
+        """
+        return [(row[1], float(row[4]), float(row[5])) for row in self.rows(key, **kwargs)]
+
+    def best_values(self, key, **kwargs):
+        """
+        :param key: capacitor key
+        :param kwargs: start= and end= dates, inclusive
+        :return: list of (date, ucomplex admittance)
+        """
+        return [(row[1], self.store.json_to_ucomplex(row[6])) for row in self.rows(key, **kwargs)]
+
+    def latest(self, **kwargs):
+        """
+        Latest value of each capacitor, e.g. latest(nominal=10) for every 10 pF standard
+        :param kwargs: keys= the capacitors wanted (default all), nominal= keep only those within 1 % of this many pF,
+        end= latest on or before this date
+        :return: dictionary of key: (date, capacitance pF, u pF)
+        """
+        keys = list(self.entries.keys())
+        nominal = None
+        end = None
+        for arg in kwargs.keys():
+            if arg == 'keys':
+                keys = kwargs[arg]
+            elif arg == 'nominal':
+                nominal = kwargs[arg]
+            elif arg == 'end':
+                end = kwargs[arg]
+        found = {}
+        for key in keys:
+            last = self.values(key, end=end)[-1:]
+            if last and (nominal is None or abs(last[0][1] / nominal - 1) < 0.01):
+                found[key] = last[0]
+        return found
+
+    def ref_value(self, key, **kwargs):
+        """
+        :param key: e.g. 'ah11c1'
+        :param kwargs: end= the latest value on or before this date (default the latest of all)
+        :return: ucomplex admittance, for the ref_value of CAPSCALE
+        """
+        found = self.best_values(key, **kwargs)
+        if not found:
+            raise KeyError('no value of %r in %s' % (key, self.file_name))
+        return found[-1][1]
+
+    def drift(self, key):
+        """
+        Straight line fit of capacitance against time, weighted by 1/u**2, kept until a new point for key is added
+        :param key: capacitor key
+        :return: dictionary of n, epoch (date of the first point), the fitted capacitance at the epoch in pF and the
+        drift in ppm per year (None if there are fewer than two dates)
+        """
+        self.refresh()  # points added by anyone else drop the fit
+        if key not in self.fits:
+            import numpy as np  # only needed here, as for CAPSCALE.budget_matrix
+            points = self.values(key)
+            assert points, 'no value of %r' % key
+            epoch = datetime.strptime(points[0][0], '%Y-%m-%d')
+            years = np.array([(datetime.strptime(x[0], '%Y-%m-%d') - epoch).days / 365.25 for x in points])
+            pf = np.array([x[1] for x in points])
+            weights = np.array([1 / x[2] if x[2] > 0 else 1.0 for x in points])
+            fit = {'n': len(points), 'epoch': points[0][0], 'capacitance_pF': float(np.average(pf, weights=weights**2)),
+                   'drift_ppm_per_year': None}
+            if len(set(years)) > 1:
+                slope, intercept = np.polyfit(years, pf, 1, w=weights)
+                fit['capacitance_pF'] = float(intercept)
+                fit['drift_ppm_per_year'] = float(slope / intercept * 1e6)
+            self.fits[key] = fit
+        return self.fits[key]
+
+
+def csv_line(row):
+    """
+    :param row: list of values
+    :return: the bytes csv.writer writes for the row
+    """
+    text = io.StringIO()
+    csv.writer(text).writerow(row)
+    return text.getvalue().encode()
+
+
+if __name__ == '__main__':
+    from GTC import ureal
+    from meas_cap_ratio import CAPSCALE
+    print('Testing history.py')
+    folder = Path('G:\\My Drive\\KJ\\PycharmProjects\\CapacitanceScale\\datastore')
+    history = HISTORYSTORE(folder / 'history.csv')
+    if 'ah11c1' not in history.entries:  # start from the NMIA certificate value, as cap_scale.py
+        w = 1e4
+        cap = 99.999581e-12
+        g = ureal(1.9e-6 * w * cap, 0.6e-6 / 2 * w * cap, 50, label='ah11c1d')
+        c = ureal(cap, cap * 0.11e-6 / 2, 50, label='ah11c1c')
+        history.append([('ah11c1', '2019-06-01', 'NMIA certificate', g + 1j * w * c, w)])
+    scale = CAPSCALE(folder, ['in.csv', 'leads_and_caps.csv'], 'out.csv', None)
+    scale.ref_cap = history.ref_value('ah11c1', end=scale.date_string)
+    scale.buildup()
+    history.append_buildup(scale)
+    print(history.values('gr1000a', start='2015'))
+    print(history.latest(nominal=10))
+    print(history.drift('ah11c1'))
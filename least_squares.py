@@ -0,0 +1,337 @@
+#  python3.8 som environment
+import numpy as np
+from scipy.sparse import csr_matrix, bmat, block_diag
+from scipy.sparse.linalg import splu
+from GTC import log, exp, result, ureal, value, get_covariance
+from GTC.reporting import sensitivity
+from components import lead_cache, lead_inputs, capacitor_inputs
+
+"""
+Generalised least squares solution of an over-determined capacitance build up. Each ratio measurement links two
+capacitors, ln(Y_target) - ln(Y_source) = ln(ratio) + corrections, and each reference fixes one ln(Y). The real and
+imaginary parts of all the observations are stacked into one vector y = A x + J e, where e are the deviations of the
+inputs the observations are made from (main ratio, factora, factorb, the balance readings of each link, the
+reference, the leads and capacitor screen admittances) and J their sensitivities, a few per row. The covariance
+V = J S J^T is never formed, as main ratio, factora and factorb make it dense. Instead the one sparse symmetric system
+    [0    A  J     ] [l]   [y]
+    [A^T  0  0     ] [x] = [0]
+    [J^T  0  -S^-1 ] [e]   [0]
+is factorised once with scipy.sparse.linalg.splu, S being block diagonal in the inputs. It gives the estimates x and
+l = V^-1 (y - A x) for chi-squared, and one more solve per unknown gives the gain and covariance of x. Each link
+needs a measurement uncertainty of its own, ureal balances from readings.READINGLOG or balance_u=, otherwise V is
+singular. The estimates are formed as linear combinations of the GTC observations, so their uncertainties keep every
+correlation between inputs.
+"""
+
+
+def complex_parts(x):
+    """
+    :param x: ucomplex, or a number
+    :return: list of its real and imaginary ureal parts, empty for a number
+    """
+    if not hasattr(x, 'real') or not hasattr(x.real, 'u'):
+        return []
+    return [x.real, x.imag]
+
+
+def declared(x):
+    """
+    :param x: ucomplex
+    :return: x if it is elementary, otherwise x declared as an intermediate result so sensitivities can be taken to it
+    """
+    if x.is_elementary:
+        return x
+    return result(x)
+
+
+def pairwise_sum(terms):
+    """
+    :param terms: list of uncertain numbers
+    :return: their sum, added in pairs as each GTC addition merges the dependencies of both sides, so summing a long
+    list one term at a time costs the square of its length
+    """
+    while len(terms) > 1:
+        terms = [terms[j] + terms[j + 1] if j + 1 < len(terms) else terms[j] for j in range(0, len(terms), 2)]
+    return terms[0]
+
+
+# (source, target, balance, inverse, source connection, target connection) for CAPSCALE.buildup plus the r9 check
+BUILDUP_LINKS = [('ah11c1', 'ah11a1', 'r4', True, 'ah11c1', 'ah11a1'),
+                 ('ah11c1', 'ah11b1', 'r5', True, 'ah11c1', 'ah11b1'),
+                 ('ah11c1', 'ah11a2', 'r6', True, 'ah11c1', 'ah11a2'),
+                 ('ah11c1', 'ah11b2', 'r7', True, 'ah11c1', 'ah11b2'),
+                 ('ah11c1', 'gr10', 'r8', True, 'ah11c1', 'gr10'),
+                 ('ah11a1', 'ah11c1', 'r9', False, 'ah11a1', 'ah11c1'),  # the cross check, no longer thrown away
+                 ('ah11a1', 'ah11d1', 'r10', False, 'ah11a1', 'ah11d1'),
+                 ('ah11a1', 'ah11c2', 'r11', False, 'ah11a1', 'ah11c2'),
+                 ('ah11a1', 'ah11d2', 'r12', False, 'ah11a1', 'ah11d2'),
+                 ('ah11a1', 'gr100', 'r13', False, 'ah11a1', 'gr100'),
+                 ('ah11c1', 'gr1000a', 'r14', False, 'ah11c1_nox', 'gr1000a'),
+                 ('ah11c1', 'gr1000b', 'r15', False, 'ah11c1_nox', 'gr1000b'),
+                 ('ah11c1', 'es13_16', 'r3', True, 'ah11c1', None)]  # es13_16 value is taken without leads
+
+
+class GLSSCALE(object):
+    def __init__(self, scale, **kwargs):
+        """
+        :param scale: a meas_cap_ratio.CAPSCALE object, used for balances, ratio factors and components. As for
+        BUILDUPGRAPH it must not have had buildup() run, which swaps the leads on ah11c1.
+        :param kwargs: balance_u= standard uncertainty of each dial reading of a link whose balance is a pair of
+        floats (default None, solve() then refuses such a link), birge_limit= largest Birge ratio sqrt(chi2 / dof)
+        solve() accepts (default 2.0, None for no check)
+        """
+        assert scale.caps['ah11c1'].hvlead is not scale.leads['hv2'], 'make the solver before buildup'
+        self.scale = scale
+        self.balance_u = None
+        self.birge_limit = 2.0
+        for arg in kwargs.keys():
+            if arg == 'balance_u':
+                self.balance_u = kwargs[arg]
+            elif arg == 'birge_limit':
+                self.birge_limit = kwargs[arg]
+        self.connections = {}  # name: (capacitor key, hv lead, lv lead) used for a lead correction
+        for x in scale.caps:
+            self.connections[x] = (x, scale.caps[x].hvlead, scale.caps[x].lvlead)
+        self.connections['ah11c1_nox'] = ('ah11c1', scale.leads['hv2'], scale.leads['hv1'])  # without transformer
+        self.main_ratio = declared(scale.main_ratio)
+        self.factora = declared(scale.factora)
+        self.factorb = declared(scale.factorb)
+        self.unknowns = []
+        self.rows = []  # (list of (unknown, coefficient), ucomplex observation, description, blocks of inputs)
+        self.unmeasured = []  # descriptions of links with no measurement uncertainty
+        self.best = {}
+        self.residuals = None
+        self.obs_u = None
+        self.chi2 = None
+        self.dof = None
+        self.cov = None
+
+    def index(self, key):
+        if key not in self.unknowns:
+            self.unknowns.append(key)
+        return self.unknowns.index(key)
+
+    def connection_inputs(self, connection):
+        """
+        :param connection: a connection name or None
+        :return: list of the ucomplex inputs of its lead correction
+        """
+        if connection is None:
+            return []
+        cap, hv, lv = self.connections[connection]
+        return capacitor_inputs(self.scale.caps[cap]) + lead_inputs(hv) + lead_inputs(lv)
+
+    def relative_correction(self, connection):
+        """
+        :param connection: a connection name or None
+        :return: lead correction divided by the nominal admittance, i.e. ln(Y) - ln(Y measured) to first order
+        """
+        if connection is None:
+            return 0
+        cap, hv, lv = self.connections[connection]
+        return lead_cache.correction(self.scale.caps[cap], hv, lv) / self.scale.caps[cap].y13
+
+    def add_reference(self, key, ref_value):
+        """
+        :param key: capacitor key
+        :param ref_value: ucomplex admittance of the capacitor with no leads
+        :return:
+        """
+        ref_value = declared(ref_value)
+        self.rows.append(([(self.index(key), 1.0)], log(ref_value), key, [complex_parts(ref_value)]))
+        return
+
+    def add_link(self, source, target, balance, inverse, source_connection, target_connection, **kwargs):
+        """
+        One ratio measurement, equation 47 as CAPSCALE.cap_ratio, between two capacitors
+        :param source: key of the capacitor the ratio is taken from
+        :param target: key of the capacitor being measured
+        :param balance: (alpha, beta) tuple of floats or ureals, or a key of scale.balance_dict
+        :param inverse: as for cap_ratio
+        :param source_connection: connection for the source lead correction (None for no correction)
+        :param target_connection: connection for the target lead correction (None for no correction)
+        :param kwargs: balance_u= standard uncertainty of each dial reading if the balance is a pair of floats
+        (default that given to GLSSCALE)
+        :return:
+        """
+        balance_u = self.balance_u
+        for arg in kwargs.keys():
+            if arg == 'balance_u':
+                balance_u = kwargs[arg]
+        description = '%s -> %s' % (source, target)
+        label = description
+        if isinstance(balance, str):
+            description = description + ' (' + balance + ')'
+            label = balance
+            balance = self.scale.balance_dict[balance]
+        alpha, beta = balance
+        if not hasattr(alpha, 'u') and not hasattr(beta, 'u') and balance_u:
+            alpha = ureal(alpha, balance_u, label=label + ' alpha')
+            beta = ureal(beta, balance_u, label=label + ' beta')
+        readings = [x for x in (alpha, beta) if hasattr(x, 'u') and x.u > 0]
+        if not readings:
+            self.unmeasured.append(description)
+        ratio = self.main_ratio * 1 / (1 + self.scale.r * (alpha * self.factora + 1j * beta * self.factorb))
+        if inverse:
+            ratio = 1 / ratio
+        observed = log(ratio) + self.relative_correction(target_connection) \
+            - self.relative_correction(source_connection)
+        inputs = [self.main_ratio, self.factora, self.factorb] + self.connection_inputs(target_connection) \
+            + self.connection_inputs(source_connection)
+        blocks = [readings] + [complex_parts(x) for x in inputs]
+        self.rows.append(([(self.index(target), 1.0), (self.index(source), -1.0)], observed, description, blocks))
+        return
+
+    def add_buildup_links(self):
+        """
+        Sets up the links of CAPSCALE.buildup, the r9 cross check included, with scale.ref_cap on ah11c1
+        :return:
+        """
+        self.add_reference('ah11c1', self.scale.ref_cap)
+        for link in BUILDUP_LINKS:
+            self.add_link(*link)
+        return
+
+    def input_blocks(self):
+        """
+        The inputs of all the observations, each taken once, in blocks that may be correlated within but not between
+        blocks: the real and imaginary parts of a ucomplex, or the alpha and beta readings of a link. Parts with no
+        uncertainty are left out.
+        :return: list of ureal parts, list of the correlation matrix of each block
+        """
+        parts = []
+        correlations = []
+        seen = set()
+        for row in self.rows:
+            for block in row[3]:
+                block = [x for x in block if x.u > 0 and id(x) not in seen]
+                if not block:
+                    continue
+                correlation = np.identity(len(block))
+                for j in range(len(block)):
+                    seen.add(id(block[j]))
+                    for k in range(j):
+                        correlation[j, k] = correlation[k, j] = get_covariance(block[j], block[k]) / \
+                            (block[j].u * block[k].u)
+                parts = parts + block
+                correlations.append(correlation)
+        return parts, correlations
+
+    def solve(self):
+        """
+        Solves for the real and imaginary parts of every ln(Y) together, weighted by the inverse of the covariance of
+        the stacked observations. Rows are scaled to unit uncertainty and inputs to unit standard deviation, so the
+        system is well conditioned whatever the units.
+        :return: dictionary of ucomplex best values
+        """
+        if self.unmeasured:
+            raise ValueError('no measurement uncertainty for ' + ', '.join(self.unmeasured) +
+                             ', give ureal balances or balance_u')
+        m = len(self.rows)
+        n = len(self.unknowns)
+        assert m >= n, 'fewer observations than capacitors'
+        obs = [x[1].real for x in self.rows] + [x[1].imag for x in self.rows]
+        inputs, correlations = self.input_blocks()
+        column = dict((id(x), j) for j, x in enumerate(inputs))
+        entries, rows, cols = [], [], []
+        for r, part in enumerate(obs):
+            for block in self.rows[r % m][3]:
+                for x in block:
+                    if id(x) in column:
+                        c = sensitivity(part, x) * x.u
+                        if c != 0:
+                            entries.append(c)
+                            rows.append(r)
+                            cols.append(column[id(x)])
+        jac = csr_matrix((entries, (rows, cols)), shape=(2 * m, len(inputs)))  # J S^1/2, sensitivity to unit inputs
+        corr = block_diag(correlations, format='csc')
+        corr_inverse = block_diag([np.linalg.inv(x) for x in correlations], format='csc')
+        obs_u = np.sqrt(np.asarray(jac.multiply(jac @ corr).sum(axis=1)).ravel())
+        if not np.allclose(obs_u, [x.u for x in obs], rtol=1e-6, atol=0):
+            raise ValueError('an observation depends on inputs not found in its leads, capacitors or ratio factors')
+        design = np.zeros((2 * m, 2 * n))  # the same links for the real (top) and imaginary (bottom) parts
+        for row, (terms, observed, description, blocks) in enumerate(self.rows):
+            for unknown, coefficient in terms:
+                design[row, unknown] = coefficient
+                design[m + row, n + unknown] = coefficient
+        step = np.median(obs_u)  # unknowns in units of a typical observation uncertainty
+        scaled_design = csr_matrix(design * step / obs_u[:, None])
+        scaled_jac = csr_matrix(jac.multiply(1 / obs_u[:, None]))
+        kkt = bmat([[None, scaled_design, scaled_jac],
+                    [scaled_design.T, None, None],
+                    [scaled_jac.T, None, -corr_inverse]], format='csc')
+        lu = splu(kkt)
+        rhs = np.zeros((kkt.shape[0], 2 * n + 1))
+        rhs[:2 * m, 0] = np.array([value(x) for x in obs]) / obs_u
+        rhs[2 * m:2 * m + 2 * n, 1:] = np.identity(2 * n)
+        solution = lu.solve(rhs)
+        multiplier = solution[:2 * m, 0]  # V^-1 (y - A x), scaled
+        self.cov = -step ** 2 * solution[2 * m:2 * m + 2 * n, 1:]  # (A^T V^-1 A)^-1, covariance of ln(Y) parts
+        gain = step * solution[:2 * m, 1:].T / obs_u[None, :]  # (A^T V^-1 A)^-1 A^T V^-1
+        estimates = []
+        for k in range(2 * n):
+            estimates.append(pairwise_sum([gain[k, r] * obs[r] for r in range(2 * m) if gain[k, r] != 0]))
+        residual = np.array([value(x) for x in obs]) - design @ (step * solution[2 * m:2 * m + 2 * n, 0])
+        self.residuals = residual[:m] + 1j * residual[m:]
+        self.obs_u = obs_u[:m] + 1j * obs_u[m:]
+        self.chi2 = float(multiplier @ (residual / obs_u))  # r^T V^-1 r
+        self.dof = 2 * (m - n)
+        self.best = {}
+        if self.birge_limit is not None and self.dof > 0 and np.sqrt(self.chi2 / self.dof) > self.birge_limit:
+            raise ValueError('inconsistent build up, Birge ratio %.3g exceeds %.3g, see report()' %
+                             (np.sqrt(self.chi2 / self.dof), self.birge_limit))
+        for k, key in enumerate(self.unknowns):
+            self.best[key] = exp(estimates[k] + 1j * estimates[n + k])
+        return self.best
+
+    def apply(self):
+        """
+        Sets the best values on scale.caps, splitting es13_16 into es13, es16 and es14 with sum_ratio as in buildup
+        :return:
+        """
+        for key in self.best:
+            self.scale.caps[key].set_best_value(self.best[key])
+        if 'es13_16' in self.best:
+            c13, c16, c14 = self.scale.sum_ratio(self.scale.balance_dict['r1'], self.scale.balance_dict['r2'],
+                                                 self.best['es13_16'])
+            self.scale.caps['es13'].set_best_value(c13)
+            self.scale.caps['es16'].set_best_value(c16)
+            self.scale.caps['es14'].set_best_value(c14)
+        return
+
+    def report(self):
+        """
+        :return: list of (description, real residual / u, imaginary residual / u), each part divided by its own
+        standard uncertainty only, and the chi-squared (r^T V^-1 r with the full covariance), degrees of freedom and
+        Birge ratio of the fit
+        """
+        rows = []
+        for (terms, observed, description, blocks), residual, u in zip(self.rows, self.residuals, self.obs_u):
+            rows.append((description, residual.real / u.real, residual.imag / u.imag))
+        birge = np.sqrt(self.chi2 / self.dof) if self.dof > 0 else float('nan')
+        return rows, self.chi2, self.dof, birge
+
+
+if __name__ == '__main__':
+    from GTC import ureal
+    from meas_cap_ratio import CAPSCALE
+    print('Testing least_squares.py')
+    w = 1e4
+    cap = 99.999581e-12
+    g = ureal(1.9e-6 * w * cap, 0.6e-6 / 2 * w * cap, 50, label='ah11c1d')
+    c = ureal(cap, cap * 0.11e-6 / 2, 50, label='ah11c1c')
+    scale = CAPSCALE('G:\\My Drive\\KJ\\PycharmProjects\\CapacitanceScale\\datastore',
+                     ['in.csv', 'leads_and_caps.csv'], 'out.csv', g + 1j * w * c)
+    solver = GLSSCALE(scale, balance_u=1e-3)  # dial resolution, 0.1 ppm of the ratio
+    solver.add_buildup_links()
+    try:
+        best = solver.solve()
+    except ValueError as error:
+        print(error)
+        best = {}
+    rows, chi2, dof, birge = solver.report()
+    for row in rows:
+        print("{:<28} {:8.3f} {:8.3f}".format(*row))
+    print('chi-squared', chi2, 'dof', dof, 'Birge ratio', birge)
+    for key in best:
+        print(key, best[key].imag / w * 1e12)
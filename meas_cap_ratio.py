@@ -2,24 +2,37 @@
 from archive import GTCSTORE, COMPONENTSTORE
 from pathlib import Path
 import csv
-from components import CAPACITOR, LEAD, CONNECT, PARALLEL
-from GTC import ucomplex
-from GTC.reporting import budget  # just for checks
+from components import CAPACITOR, LEAD, CONNECT, PARALLEL, lead_inputs, capacitor_inputs
+from GTC import ucomplex, result
 from json import dumps, loads
 
 class CAPSCALE(object):
-    def __init__(self, file_path, input_files, output_file_name, ref_value):
+    def __init__(self, file_path, input_files, output_file_name, ref_value, **kwargs):
         """
 
         :param file_path: the subfolder that holds all the csv files
         :param input_files: a list of file names for dial factors, 10:1 ratio, leads, capacitors and balance readings
         :param output_file_name: csv file for calculated values of all the capacitors
         :param ref_value is the up to date value of AH11C1 (derived from external calibration history)
+        :param kwargs: components= a (caps, leads) tuple of dictionaries already recovered from the leads and
+        capacitors file, which is then not read again (see batch_scale.py), registry= an archive.COMPONENTREGISTRY
+        to share recovered components with DIALCAL and PERMUTE, storecomp= the store that reads the leads and
+        capacitors file (default archive.COMPONENTSTORE, or e.g. a sqlite_store.SQLITESTORE for a database file)
         """
+        components = None
+        registry = None
+        storecomp = None
+        for arg in kwargs.keys():
+            if arg == 'components':
+                components = kwargs[arg]
+            elif arg == 'registry':
+                registry = kwargs[arg]
+            elif arg == 'storecomp':
+                storecomp = kwargs[arg]
         self.ref_cap = ref_value
         self.output_name = output_file_name  # optional store in a csv file
         self.store = GTCSTORE()
-        self.storecomp = COMPONENTSTORE()
+        self.storecomp = COMPONENTSTORE() if storecomp is None else storecomp
         self.data_folder = Path(file_path)
         data_in = self.data_folder / input_files[0]
         self.data_out = self.data_folder / output_file_name
@@ -54,19 +67,15 @@ class CAPSCALE(object):
                     'es16',
                     'gr10', 'gr100', 'gr1000a', 'gr1000b', 'es13_16']
         lead_list = ['hv1', 'hv2', 'lv2', 'xfrm', 'hv1_xfrm', 'hv2_xfrm', 'no_lead']
-        self.caps = {}
-        self.leads = {}
-        with open(data_in, newline='') as csvfile:
-            reader = csv.reader(csvfile)
-            for row in reader:
-                if row[0] in cap_list:
-                    item = loads(row[1])
-                    item = self.storecomp.dict_to_capacitor(item)
-                    self.caps[row[0]] = item
-                elif row[0] in lead_list:
-                    item = loads(row[1])
-                    item = self.storecomp.dict_to_lead(item)
-                    self.leads[row[0]] = item
+        if components is not None:
+            self.caps, self.leads = components
+        elif registry is not None:
+            self.caps, self.leads = registry.components(data_in, cap_list, lead_list)
+        else:
+            self.caps, self.leads = self.storecomp.read_components(data_in, cap_list, lead_list)
+        self.networks = list(self.leads.values())  # every lead used, as buildup moves some capacitors to others
+        for x in self.caps.values():
+            self.networks = self.networks + [x.hvlead, x.lvlead]
 
     def cap_ratio(self, balance, cap, inverse):
         # equation 47 of E.005.003
@@ -93,6 +102,8 @@ class CAPSCALE(object):
 
     def buildup(self):
         # start with the best value for c1 (from certificate)
+        if hasattr(self.ref_cap, 'is_elementary') and not self.ref_cap.is_elementary:
+            self.ref_cap = result(self.ref_cap)  # an intermediate result, so budget_matrix can take components to it
         self.caps['ah11c1'].set_best_value(self.ref_cap)
         c1 = self.caps['ah11c1'].best_value - self.caps['ah11c1'].lead_correction()  # measured C slightly larger
         r4 = self.balance_dict['r4']
@@ -167,8 +178,79 @@ class CAPSCALE(object):
                 z = simple_i.real * 1e12  # and putting it in units of pF
                 writer.writerow([x, z, dumps(y)])
 
+    def inputs(self):
+        """
+        The uncertain inputs of the build up, each once: the reference, main_ratio, factora, factorb, the balance
+        readings if they are ureals, and every lead z and y and capacitor screen admittance.
+        :return: list of (label, ureal) of the elementary or intermediate parts with an uncertainty
+        """
+        found = []
+        seen = set()
+        named = [('ref_cap', self.ref_cap), ('main_ratio', self.main_ratio), ('factora', self.factora),
+                 ('factorb', self.factorb)]
+        for x in self.balance_dict:
+            named = named + [(x + ' alpha', self.balance_dict[x][0]), (x + ' beta', self.balance_dict[x][1])]
+        networks = list(self.networks)
+        for x in self.caps.values():
+            networks = networks + [x.hvlead, x.lvlead]
+            named = named + [(x.label, y) for y in capacitor_inputs(x)]
+        for x in networks:
+            named = named + [(x.label, y) for y in lead_inputs(x)]
+        for name, x in named:
+            if not hasattr(x, 'u'):  # a plain reading
+                continue
+            parts = [(name, x)] if not hasattr(x, 'imag') or x.imag is x or not hasattr(x.imag, 'u') else \
+                [(name + '_re', x.real), (name + '_im', x.imag)]
+            for label, y in parts:
+                if id(y) in seen or y.u == 0 or not (y.is_elementary or y.is_intermediate):
+                    continue
+                seen.add(id(y))
+                found.append((y.label if y.label is not None else label, y))
+        return found
+
+    def budget_matrix(self, **kwargs):
+        """
+        Uncertainty budgets of all the capacitors at once. The inputs are gathered once (see inputs) and each row
+        filled with the signed components of uncertainty of one part of a best_value with respect to them. The
+        reference is a column of its own (ref_cap_re, ref_cap_im) rather than the inputs it was made from, as
+        buildup declares it an intermediate result. Inputs stored with a covariance (main_ratio, factora and factorb)
+        are included as budget does, so the sum of squares of a row only equals u**2 when the inputs are independent.
+        Labels can repeat, e.g. each capacitor recovered from leads_and_caps.csv has its own copy of its leads, so
+        columns are kept apart by input.
+        :param kwargs: caps= list of capacitor keys (default all of self.caps), top= keep only the top largest
+        components of each row, the rest are set to zero and columns left empty are dropped
+        :return: list of (key, 'real' or 'imag') rows, list of input labels and an array of the components of
+        uncertainty of the parts of each best_value, one row per part
+        """
+        import numpy as np  # only needed here, keeps the import of this module light
+        from GTC.reporting import u_component
+        keys = list(self.caps.keys())
+        top = None
+        for arg in kwargs.keys():
+            if arg == 'caps':
+                keys = kwargs[arg]
+            elif arg == 'top':
+                top = kwargs[arg]
+        inputs = self.inputs()
+        rows = []
+        matrix = np.zeros((2 * len(keys), len(inputs)))
+        for x in keys:
+            best = self.caps[x].best_value
+            for part in ('real', 'imag'):
+                y = getattr(best, part)
+                matrix[len(rows)] = [u_component(y, z) for label, z in inputs]
+                rows.append((x, part))
+        kept = np.any(matrix != 0, axis=0)
+        if top is not None and top < len(inputs):
+            smaller = np.argsort(-np.abs(matrix), axis=1)[:, top:]
+            np.put_along_axis(matrix, smaller, 0.0, axis=1)
+            kept = np.any(matrix != 0, axis=0)
+        labels = [label for (label, z), k in zip(inputs, kept) if k]
+        return rows, labels, matrix[:, kept]
+
 
 if __name__ == '__main__':
+    from GTC.reporting import budget  # just for checks
     scale = CAPSCALE('G:\\My Drive\\KJ\\PycharmProjects\\CapacitanceScale\\datastore',
                      ['in.csv', 'leads_and_caps.csv'], 'out.csv')
     # for b in scale.balance_dict:
@@ -0,0 +1,263 @@
+#  python3.8 som environment
+import copy
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from GTC import value, get_correlation
+from GTC.reporting import is_ureal, is_ucomplex
+
+"""
+Monte Carlo propagation for the capacitance build up, used to check the linear propagation done by GTC.
+Every uncertain input of a CAPSCALE object is replaced by a NumPy array of samples and the unchanged
+CAPSCALE.buildup is run on that shadow copy, so cap_ratio, sum_ratio and lead_correction evaluate all the trials
+in one batched complex128 pass.
+"""
+
+
+class MONTECARLO(object):
+    def __init__(self, scale, trials, **kwargs):
+        """
+        Takes a snapshot of the inputs of a CAPSCALE object. The snapshot must be taken before scale.buildup() as the
+        build up swaps the leads on ah11c1.
+        :param scale: a meas_cap_ratio.CAPSCALE object
+        :param trials: total number of Monte Carlo trials
+        :param kwargs: seed= for the random number generator, chunk= trials per batched pass (limits memory use),
+        balance_u= standard uncertainty of each alpha and beta dial reading (default 0, i.e. exact as in buildup),
+        workers= number of threads running chunks at the same time (NumPy releases the GIL for the array work)
+        """
+        assert scale.caps['ah11c1'].hvlead is not scale.leads['hv2'], 'take the Monte Carlo snapshot before buildup'
+        self.scale = scale
+        self.trials = int(trials)
+        self.seed = None
+        self.chunk = 100000
+        self.balance_u = 0.0
+        self.workers = None
+        for arg in kwargs.keys():
+            if arg == 'seed':
+                self.seed = kwargs[arg]
+            elif arg == 'chunk':
+                self.chunk = int(kwargs[arg])
+            elif arg == 'balance_u':
+                self.balance_u = kwargs[arg]
+            elif arg == 'workers':
+                self.workers = kwargs[arg]
+        self.ref_cap = scale.ref_cap
+        self.main_ratio = scale.main_ratio
+        self.factora = scale.factora
+        self.factorb = scale.factorb
+        self.balance_dict = dict(scale.balance_dict)
+        self.caps = dict(scale.caps)
+        self.leads = dict(scale.leads)
+        self.attached = {}  # leads attached to each capacitor at the time of the snapshot
+        for x in self.caps:
+            self.attached[x] = (self.caps[x].hvlead, self.caps[x].lvlead)
+        self.stats = {}
+
+    def draw(self, un, n, rng, memo):
+        """
+        Samples an input. The same GTC object always gets the same samples within one pass so that any sharing of
+        inputs (e.g. a lead used by several capacitors) is kept. Degrees of freedom are ignored (Gaussian sampling).
+        :param un: ureal, ucomplex or plain number
+        :param n: number of samples
+        :param rng: numpy random Generator
+        :param memo: dictionary of samples already drawn in this pass
+        :return: NumPy array of samples, or the plain value if un has no uncertainty
+        """
+        if id(un) in memo:
+            return memo[id(un)][1]
+        if is_ucomplex(un):
+            rr, ri, ir, ii = un.v
+            if rr == 0 and ii == 0:
+                sample = value(un)
+            else:
+                x = value(un)
+                l11 = np.sqrt(rr)
+                l21 = ri / l11 if l11 > 0 else 0.0
+                l22 = np.sqrt(max(ii - l21 ** 2, 0.0))
+                e = rng.standard_normal((2, n))
+                sample = (x.real + l11 * e[0]) + 1j * (x.imag + l21 * e[0] + l22 * e[1])
+        elif is_ureal(un):
+            if un.u == 0:
+                sample = value(un)
+            else:
+                sample = value(un) + un.u * rng.standard_normal(n)
+        else:
+            sample = un
+        memo[id(un)] = (un, sample)  # keep a reference to un so that its id is not reused
+        return sample
+
+    def draw_balance(self, balance, n, rng, memo):
+        """
+        Samples an (alpha, beta) balance, jointly if both are correlated ureals as made by readings.READINGLOG
+        :param balance: (alpha, beta) tuple of floats or ureals
+        :param n: number of samples
+        :param rng: numpy random Generator
+        :param memo: dictionary of samples already drawn in this pass
+        :return: alpha and beta samples
+        """
+        alpha, beta = balance
+        if not (is_ureal(alpha) and is_ureal(beta)) or id(alpha) in memo or id(beta) in memo:
+            return self.draw(alpha, n, rng, memo), self.draw(beta, n, rng, memo)
+        r = get_correlation(alpha, beta)
+        if r == 0:
+            return self.draw(alpha, n, rng, memo), self.draw(beta, n, rng, memo)
+        e = rng.standard_normal((2, n))
+        sample_a = value(alpha) + alpha.u * e[0]
+        sample_b = value(beta) + beta.u * (r * e[0] + np.sqrt(1 - r ** 2) * e[1])
+        memo[id(alpha)] = (alpha, sample_a)
+        memo[id(beta)] = (beta, sample_b)
+        return sample_a, sample_b
+
+    def shadow(self, n, rng):
+        """
+        Builds a copy of the CAPSCALE object with every uncertain input replaced by n samples.
+        :param n: number of samples
+        :param rng: numpy random Generator
+        :return: CAPSCALE object ready for buildup()
+        """
+        memo = {}
+        leads = {}
+
+        def shadow_lead(lead):
+            if id(lead) not in leads:
+                new_lead = copy.copy(lead)
+                new_lead.z = self.draw(lead.z, n, rng, memo)
+                new_lead.y = self.draw(lead.y, n, rng, memo)
+                leads[id(lead)] = new_lead
+            return leads[id(lead)]
+
+        sim = copy.copy(self.scale)
+        sim.ref_cap = self.draw(self.ref_cap, n, rng, memo)
+        sim.main_ratio = self.draw(self.main_ratio, n, rng, memo)
+        sim.factora = self.draw(self.factora, n, rng, memo)
+        sim.factorb = self.draw(self.factorb, n, rng, memo)
+        sim.balance_dict = {}
+        for x in self.balance_dict:
+            alpha, beta = self.draw_balance(self.balance_dict[x], n, rng, memo)
+            if self.balance_u > 0:
+                alpha = alpha + self.balance_u * rng.standard_normal(n)
+                beta = beta + self.balance_u * rng.standard_normal(n)
+            sim.balance_dict[x] = (alpha, beta)
+        sim.leads = {}
+        for x in self.leads:
+            sim.leads[x] = shadow_lead(self.leads[x])
+        sim.caps = {}
+        for x in self.caps:
+            cap = copy.copy(self.caps[x])
+            cap.y13 = self.draw(self.caps[x].y13, n, rng, memo)
+            cap.y12 = self.draw(self.caps[x].y12, n, rng, memo)
+            cap.y34 = self.draw(self.caps[x].y34, n, rng, memo)
+            cap.hvlead = shadow_lead(self.attached[x][0])
+            cap.lvlead = shadow_lead(self.attached[x][1])
+            sim.caps[x] = cap
+        return sim
+
+    def run(self):
+        """
+        Runs the trials in chunks, pooling the mean and (co)variance of the real and imaginary parts of every
+        capacitor's best_value (Chan et al. pairwise update, so no samples are kept between chunks). Each chunk has
+        its own random stream spawned from the seed and chunks are pooled in order, so the result does not depend on
+        the number of workers.
+        :return: dictionary of statistics keyed as CAPSCALE.caps
+        """
+        sizes = [self.chunk] * (self.trials // self.chunk)
+        if self.trials % self.chunk:
+            sizes.append(self.trials % self.chunk)
+        streams = np.random.SeedSequence(self.seed).spawn(len(sizes))
+        self.stats = {}
+        if self.workers is None or self.workers < 2:
+            for n, stream in zip(sizes, streams):
+                self.pool_chunk(self.run_chunk(n, stream))
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                for chunk in pool.map(self.run_chunk, sizes, streams):  # map keeps the chunk order
+                    self.pool_chunk(chunk)
+        return self.stats
+
+    def run_chunk(self, n, stream):
+        """
+        :param n: number of trials
+        :param stream: numpy SeedSequence for this chunk
+        :return: dictionary of arrays of best_value samples
+        """
+        sim = self.shadow(n, np.random.default_rng(stream))
+        sim.buildup()
+        samples = {}
+        for x in sim.caps:
+            samples[x] = np.broadcast_to(sim.caps[x].best_value, (n,))
+        return samples
+
+    def pool_chunk(self, samples):
+        for x in samples:
+            self.pool(x, samples[x].real, samples[x].imag)
+        return
+
+    def pool(self, key, re, im):
+        """
+        Merges the statistics of one chunk into self.stats.
+        :param key: capacitor key
+        :param re: array of real part samples
+        :param im: array of imaginary part samples
+        :return:
+        """
+        n = len(re)
+        mean = np.array([re.mean(), im.mean()])
+        dev = np.vstack((re - mean[0], im - mean[1]))
+        m2 = dev @ dev.T  # 2 x 2 sums of squares and cross products
+        if key not in self.stats:
+            self.stats[key] = {'n': n, 'mean': mean, 'm2': m2}
+            return
+        old = self.stats[key]
+        total = old['n'] + n
+        delta = mean - old['mean']
+        old['m2'] = old['m2'] + m2 + np.outer(delta, delta) * old['n'] * n / total
+        old['mean'] = old['mean'] + delta * n / total
+        old['n'] = total
+        return
+
+    def summary(self, key):
+        """
+        :param key: capacitor key
+        :return: Monte Carlo mean (complex), standard uncertainties of the real and imaginary parts and their
+        correlation coefficient
+        """
+        s = self.stats[key]
+        cov = s['m2'] / (s['n'] - 1)
+        u = np.sqrt(np.diag(cov))
+        r = cov[0, 1] / (u[0] * u[1]) if u[0] > 0 and u[1] > 0 else 0.0
+        return complex(s['mean'][0], s['mean'][1]), (u[0], u[1]), r
+
+    def compare(self):
+        """
+        Side by side Monte Carlo and GTC values of conductance (nS) and capacitance (pF). Needs both run() and
+        scale.buildup() to have been called.
+        :return: list of rows [key, G mc, u(G) mc, G gtc, u(G) gtc, C mc, u(C) mc, C gtc, u(C) gtc]
+        """
+        w = self.scale.w
+        rows = []
+        for x in self.stats:
+            mean, u, r = self.summary(x)
+            best = self.scale.caps[x].best_value
+            rows.append([x, mean.real * 1e9, u[0] * 1e9, best.real.x * 1e9, best.real.u * 1e9,
+                         mean.imag / w * 1e12, u[1] / w * 1e12, best.imag.x / w * 1e12, best.imag.u / w * 1e12])
+        return rows
+
+
+if __name__ == '__main__':
+    from GTC import ureal
+    from meas_cap_ratio import CAPSCALE
+    import time
+    print('Testing monte_carlo.py')
+    w = 1e4
+    cap = 99.999581e-12
+    g = ureal(1.9e-6 * w * cap, 0.6e-6 / 2 * w * cap, 50, label='ah11c1d')
+    c = ureal(cap, cap * 0.11e-6 / 2, 50, label='ah11c1c')
+    scale = CAPSCALE('G:\\My Drive\\KJ\\PycharmProjects\\CapacitanceScale\\datastore',
+                     ['in.csv', 'leads_and_caps.csv'], 'out.csv', g + 1j * w * c)
+    mc = MONTECARLO(scale, 100000, seed=1)
+    scale.buildup()
+    start = time.perf_counter()
+    mc.run()
+    print('trials', mc.trials, 'time', time.perf_counter() - start)
+    print("{:^10} {:>14} {:>10} {:>14} {:>10}".format('', 'C mc/pF', 'u mc', 'C gtc/pF', 'u gtc'))
+    for row in mc.compare():
+        print("{:^10} {:14.8f} {:10.2e} {:14.8f} {:10.2e}".format(row[0], row[5], row[6], row[7], row[8]))
@@ -0,0 +1,208 @@
+#  python3.8 som environment
+from archive import GTCSTORE, COMPONENTSTORE
+from pathlib import Path
+from json import dumps, loads
+import csv
+import hashlib
+
+"""
+Runs the traceability chain DIALCAL -> PERMUTE -> CAPSCALE in one go. The dial factors replace factora and factorb
+of the permutable capacitor run, and the dial factors and main ratio replace those pasted into in.csv. Each stage
+is identified by a sha1 hash of the rows of its run file that it uses, the rows of the leads and capacitors file it
+reads (from the index of that file), its parameters and the hashes of the stages before it. Outputs are kept as
+json in a cache folder, so a stage is only run again when something it depends on has changed: editing a build up
+balance reruns only CAPSCALE, editing the gr10 capacitor reruns PERMUTE and CAPSCALE.
+Every stage hands its results on as json, exactly as the manual chain of files does, so the results do not depend
+on which stages came from the cache.
+"""
+
+CAP_LIST = ['ah11a1', 'ah11b1', 'ah11c1', 'ah11d1', 'ah11a2', 'ah11b2', 'ah11c2', 'ah11d2', 'es14', 'es13', 'es16',
+            'gr10', 'gr100', 'gr1000a', 'gr1000b', 'es13_16']
+LEAD_LIST = ['hv1', 'hv2', 'lv2', 'xfrm', 'hv1_xfrm', 'hv2_xfrm', 'no_lead']
+
+
+class PIPELINE(object):
+    def __init__(self, file_path, ref_value, **kwargs):
+        """
+        :param file_path: the subfolder that holds all the csv files
+        :param ref_value: ucomplex value of AH11C1 (derived from external calibration history)
+        :param kwargs: dial_files=, ratio_files=, scale_files= lists of [run file, leads and capacitors file] for
+        each stage (default test.csv, perm1.csv and in.csv with leads_and_caps.csv), dial_output=, ratio_output=,
+        scale_output= output file names (default out_test.csv, out_perm1.csv and out.csv), cache= folder for the
+        cached results (default a 'cache' folder inside file_path), registry= an archive.COMPONENTREGISTRY
+        """
+        self.data_folder = Path(file_path)
+        self.ref_value = ref_value
+        self.dial_files = ['test.csv', 'leads_and_caps.csv']
+        self.ratio_files = ['perm1.csv', 'leads_and_caps.csv']
+        self.scale_files = ['in.csv', 'leads_and_caps.csv']
+        self.dial_output = 'out_test.csv'
+        self.ratio_output = 'out_perm1.csv'
+        self.scale_output = 'out.csv'
+        self.cache_folder = self.data_folder / 'cache'
+        self.registry = None
+        for arg in kwargs.keys():
+            if arg == 'dial_files':
+                self.dial_files = kwargs[arg]
+            elif arg == 'ratio_files':
+                self.ratio_files = kwargs[arg]
+            elif arg == 'scale_files':
+                self.scale_files = kwargs[arg]
+            elif arg == 'dial_output':
+                self.dial_output = kwargs[arg]
+            elif arg == 'ratio_output':
+                self.ratio_output = kwargs[arg]
+            elif arg == 'scale_output':
+                self.scale_output = kwargs[arg]
+            elif arg == 'cache':
+                self.cache_folder = Path(kwargs[arg])
+            elif arg == 'registry':
+                self.registry = kwargs[arg]
+        self.store = GTCSTORE()
+        self.storecomp = COMPONENTSTORE()
+        self.ran = []  # stages run (not taken from the cache) by the last call of run()
+
+    def run_rows(self, file_name, skip):
+        """
+        :param file_name: run file name, e.g. 'in.csv'
+        :param skip: first column values of rows replaced by an earlier stage
+        :return: dictionary of first column: rest of the row
+        """
+        rows = {}
+        with open(self.data_folder / file_name, newline='') as csvfile:
+            for row in csv.reader(csvfile):
+                if row and row[0] not in skip:
+                    rows[row[0]] = row[1:]
+        return rows
+
+    def component_hashes(self, file_name, keys):
+        """
+        :param file_name: leads and capacitors file name
+        :param keys: component keys used by a stage
+        :return: dictionary of key: sha1 hash of its row, from the index of the file
+        """
+        entries = self.storecomp.load_index(self.data_folder / file_name)
+        hashes = {}
+        for x in keys:
+            hashes[x] = entries[x][2] if x in entries else None
+        return hashes
+
+    def stage_key(self, stage, run_rows, component_hashes, upstream):
+        description = dumps([stage, run_rows, component_hashes, upstream], sort_keys=True)
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    def cached(self, stage, key):
+        """
+        :return: the stored dictionary of json strings of a stage, or None
+        """
+        try:
+            with open(self.cache_folder / ('%s_%s.json' % (stage, key))) as json_file:
+                return loads(json_file.read())
+        except (OSError, ValueError):
+            return None
+
+    def save(self, stage, key, results):
+        self.cache_folder.mkdir(parents=True, exist_ok=True)
+        with open(self.cache_folder / ('%s_%s.json' % (stage, key)), 'w') as json_file:
+            json_file.write(dumps(results))
+        return
+
+    def dial_stage(self):
+        """
+        :return: stage key and dictionary of json strings of factora and factorb
+        """
+        rows = self.run_rows(self.dial_files[0], [])
+        key = self.stage_key('dials', rows, self.component_hashes(self.dial_files[1], [rows['c1'][0],
+                                                                                        rows['c2'][0]]), [])
+        results = self.cached('dials', key)
+        if results is None:
+            from cal_balance import DIALCAL
+            cal_dials = DIALCAL(self.data_folder, self.dial_files, self.dial_output, registry=self.registry)
+            a, b = cal_dials.dialfactors(file_output=True)
+            results = {'factora': self.store.ucomplex_to_json(a, new_label='factora'),
+                       'factorb': self.store.ucomplex_to_json(b, new_label='factorb')}
+            self.save('dials', key, results)
+            self.ran.append('dials')
+        return key, results
+
+    def ratio_stage(self, dial_key, dials):
+        """
+        :param dial_key: stage key of the dial factors
+        :param dials: dictionary of json strings of factora and factorb
+        :return: stage key and dictionary of the json string of main_ratio
+        """
+        rows = self.run_rows(self.ratio_files[0], ['factora', 'factorb'])
+        key = self.stage_key('ratio', [rows, 'corrected twice'], self.component_hashes(self.ratio_files[1], ['gr10']),
+                             [dial_key])  # results of the single correction are not reused
+        results = self.cached('ratio', key)
+        if results is None:
+            from cal_main_ratio import PERMUTE
+            ratio_cal = PERMUTE(self.data_folder, self.ratio_files, self.ratio_output, registry=self.registry)
+            ratio_cal.factora = self.store.json_to_ucomplex(dials['factora'])
+            ratio_cal.factorb = self.store.json_to_ucomplex(dials['factorb'])
+            main_ratio = ratio_cal.correct_ratio(ratio_cal.calc_raw_ratio())
+            main_ratio = ratio_cal.correct_ratio(main_ratio)  # applied twice, as by cal_main_ratio.py
+            ratio_cal.file_ratio(main_ratio)
+            results = {'main_ratio': self.store.ucomplex_to_json(main_ratio, new_label='main_ratio')}
+            self.save('ratio', key, results)
+            self.ran.append('ratio')
+        return key, results
+
+    def scale_stage(self, upstream, dials, ratio):
+        """
+        :param upstream: stage keys of the dial factors and main ratio
+        :param dials: dictionary of json strings of factora and factorb
+        :param ratio: dictionary of the json string of main_ratio
+        :return: stage key and dictionary of the json strings of each capacitor's best_value
+        """
+        rows = self.run_rows(self.scale_files[0], ['factora', 'factorb', 'main_ratio'])
+        reference = self.store.ucomplex_to_json(self.ref_value)
+        key = self.stage_key('scale', [rows, reference], self.component_hashes(self.scale_files[1],
+                                                                               CAP_LIST + LEAD_LIST), upstream)
+        results = self.cached('scale', key)
+        if results is None:
+            from meas_cap_ratio import CAPSCALE
+            scale = CAPSCALE(self.data_folder, self.scale_files, self.scale_output, self.ref_value,
+                             registry=self.registry)
+            scale.factora = self.store.json_to_ucomplex(dials['factora'])
+            scale.factorb = self.store.json_to_ucomplex(dials['factorb'])
+            scale.main_ratio = self.store.json_to_ucomplex(ratio['main_ratio'])
+            scale.buildup()
+            scale.store_buildup()
+            results = {}
+            for x in scale.caps:
+                results[x] = self.store.ucomplex_to_json(scale.caps[x].best_value, new_label=x)
+            self.save('scale', key, results)
+            self.ran.append('scale')
+        return key, results
+
+    def run(self):
+        """
+        Runs, or recovers from the cache, each stage in turn
+        :return: dictionary of ucomplex factora, factorb, main_ratio and the best_value of every capacitor
+        """
+        self.ran = []
+        dial_key, dials = self.dial_stage()
+        ratio_key, ratio = self.ratio_stage(dial_key, dials)
+        scale_key, caps = self.scale_stage([dial_key, ratio_key], dials, ratio)
+        values = {}
+        for results in (dials, ratio, caps):
+            for x in results:
+                values[x] = self.store.json_to_ucomplex(results[x])
+        return values
+
+
+if __name__ == '__main__':
+    from GTC import ureal
+    print('Testing pipeline.py')
+    w = 1e4
+    cap = 99.999581e-12
+    g = ureal(1.9e-6 * w * cap, 0.6e-6 / 2 * w * cap, 50, label='ah11c1d')
+    c = ureal(cap, cap * 0.11e-6 / 2, 50, label='ah11c1c')
+    chain = PIPELINE('G:\\My Drive\\KJ\\PycharmProjects\\CapacitanceScale\\datastore', g + 1j * w * c)
+    values = chain.run()
+    print('stages run', chain.ran)
+    print('main ratio', repr(values['main_ratio']))
+    print('gr1000a', values['gr1000a'].imag / w * 1e12)
+    values = chain.run()
+    print('stages run again', chain.ran)
@@ -0,0 +1,262 @@
+#  python3.8 som environment
+from archive import GTCSTORE, COMPONENTSTORE
+from meas_cap_ratio import CAPSCALE
+from cal_balance import DIALCAL
+from cal_main_ratio import PERMUTE
+from components import CAPACITOR, PARALLEL, CORRECTIONCACHE
+from json import dumps
+import contextvars
+import cProfile
+import csv
+import functools
+import io
+import pstats
+import threading
+import time
+import tracemalloc
+
+"""
+Opt in timing of the stages of CAPSCALE, DIALCAL and PERMUTE. While any "with STAGETIMER() as timer:" block is open
+the methods listed in STAGES are replaced by wrappers on their classes, shared by every open block and put back when
+the last one closes (or fails to open). A wrapper only times a call for the timer of the block it runs in, found
+from a context variable, so calls made outside every block, or inside another block on another thread, are not
+mixed into its records. Nested stages are separated, e.g. the time parsing in.csv is CAPSCALE.__init__ less the time
+spent reconstructing components and decoding json within it. New threads start outside the block, so work handed to
+a thread pool is not timed.
+"""
+
+# (stage, class, method name)
+STAGES = [('parse', CAPSCALE, '__init__'), ('parse', DIALCAL, '__init__'), ('parse', PERMUTE, '__init__'),
+          ('index', COMPONENTSTORE, 'lookup'),
+          ('components', COMPONENTSTORE, 'dict_to_capacitor'), ('components', COMPONENTSTORE, 'dict_to_lead'),
+          ('json', GTCSTORE, 'json_to_ucomplex'), ('json', GTCSTORE, 'json_to_ureal'),
+          ('json', GTCSTORE, 'ucomplex_to_json'),
+          ('buildup', CAPSCALE, 'buildup'), ('ratio', CAPSCALE, 'cap_ratio'), ('ratio', CAPSCALE, 'sum_ratio'),
+          ('lead_correction', CAPACITOR, 'lead_correction'), ('lead_correction', PARALLEL, 'lead_correction'),
+          ('lead_correction', CORRECTIONCACHE, 'correction'),
+          ('dial_factors', DIALCAL, 'dialfactors'), ('main_ratio', PERMUTE, 'calc_raw_ratio'),
+          ('main_ratio', PERMUTE, 'correct_ratio'),
+          ('output', CAPSCALE, 'store_buildup'), ('output', PERMUTE, 'file_ratio')]
+
+active_timer = contextvars.ContextVar('active_timer', default=None)  # the STAGETIMER of the innermost open block
+patch_lock = threading.Lock()
+patches = {}  # (class, method name): [original method, number of open blocks using the wrapper]
+
+
+def timing_wrapper(cls, name, method):
+    """
+    :param cls: class that holds the method
+    :param name: method name
+    :param method: the original method
+    :return: function that times calls for the active STAGETIMER, if it lists the method, and otherwise just calls
+    the original
+    """
+    @functools.wraps(method)
+    def timed(*args, **kwargs):
+        timer = active_timer.get()
+        if timer is None or (cls, name) not in timer.methods:
+            return method(*args, **kwargs)
+        return timer.timed_call(cls, name, method, args, kwargs)
+    return timed
+
+
+def patch(cls, name):
+    with patch_lock:
+        if (cls, name) not in patches:
+            method = cls.__dict__[name]
+            setattr(cls, name, timing_wrapper(cls, name, method))
+            patches[(cls, name)] = [method, 0]
+        patches[(cls, name)][1] += 1
+    return
+
+
+def unpatch(cls, name):
+    with patch_lock:
+        entry = patches.get((cls, name))
+        if entry is not None:
+            entry[1] -= 1
+            if entry[1] == 0:
+                setattr(cls, name, entry[0])
+                del patches[(cls, name)]
+    return
+
+
+class STAGETIMER(object):
+    def __init__(self, **kwargs):
+        """
+        :param kwargs: callback= function called after every timed call as callback(stage, method, seconds),
+        stages= list of (stage, class, method name) to use instead of STAGES, profile= True to also run cProfile,
+        memory= True to also run tracemalloc (both add a lot of overhead of their own)
+        """
+        self.callback = None
+        self.stages = STAGES
+        self.use_profile = False
+        self.use_memory = False
+        for arg in kwargs.keys():
+            if arg == 'callback':
+                self.callback = kwargs[arg]
+            elif arg == 'stages':
+                self.stages = kwargs[arg]
+            elif arg == 'profile':
+                self.use_profile = kwargs[arg]
+            elif arg == 'memory':
+                self.use_memory = kwargs[arg]
+        self.methods = {(cls, name): stage for stage, cls, name in self.stages}
+        self.records = {}  # (stage, method): [calls, total seconds, own seconds]
+        self.lock = threading.Lock()
+        self.local = threading.local()  # the call stack of each thread timed by this timer
+        self.patched = []
+        self.token = None
+        self.profile = None
+        self.memory = None  # (current, peak) bytes and the final snapshot
+        self.wall = 0.0
+
+    def timed_call(self, cls, name, method, args, kwargs):
+        stage = self.methods[(cls, name)]
+        method_name = cls.__name__ + '.' + name
+        stack = getattr(self.local, 'stack', None)  # time spent in nested timed calls, one entry per call in progress
+        if stack is None:
+            stack = self.local.stack = []
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            with self.lock:
+                record = self.records.setdefault((stage, method_name), [0, 0.0, 0.0])
+                record[0] += 1
+                record[1] += elapsed
+                record[2] += elapsed - nested
+            if self.callback is not None:
+                self.callback(stage, method_name, elapsed)
+
+    def restore(self):
+        """
+        Closes the block: the timer is no longer active and methods no other open block uses are put back
+        :return:
+        """
+        if self.token is not None:
+            active_timer.reset(self.token)
+            self.token = None
+        while self.patched:
+            unpatch(*self.patched.pop())
+        return
+
+    def __enter__(self):
+        try:
+            for stage, cls, name in self.stages:
+                patch(cls, name)
+                self.patched.append((cls, name))
+            self.token = active_timer.set(self)
+            if self.use_memory:
+                tracemalloc.start()
+            if self.use_profile:
+                self.profile = cProfile.Profile()
+                self.profile.enable()
+        except BaseException:
+            self.restore()
+            raise
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.wall += time.perf_counter() - self.start
+            if self.profile is not None:
+                self.profile.disable()
+            if self.use_memory:
+                self.memory = (tracemalloc.get_traced_memory(), tracemalloc.take_snapshot())
+                tracemalloc.stop()
+        finally:
+            self.restore()
+        return False
+
+    def report(self):
+        """
+        :return: list of dictionaries of stage, method, calls, total and own seconds, slowest own time first
+        """
+        rows = []
+        for (stage, method), (calls, total, own) in self.records.items():
+            rows.append({'stage': stage, 'method': method, 'calls': calls, 'total': total, 'own': own})
+        rows.sort(key=lambda x: -x['own'])
+        return rows
+
+    def stage_totals(self):
+        """
+        :return: dictionary of the own time of each stage; these add up to the timed part of the wall time
+        """
+        totals = {}
+        for row in self.report():
+            totals[row['stage']] = totals.get(row['stage'], 0.0) + row['own']
+        return totals
+
+    def profile_text(self, lines=20):
+        """
+        :param lines: number of functions to list
+        :return: the cProfile statistics sorted by cumulative time, or '' if profile was not requested
+        """
+        if self.profile is None:
+            return ''
+        out = io.StringIO()
+        pstats.Stats(self.profile, stream=out).sort_stats('cumulative').print_stats(lines)
+        return out.getvalue()
+
+    def memory_text(self, lines=10):
+        """
+        :param lines: number of source lines to list
+        :return: current and peak traced memory and the lines holding the most memory, or '' if memory was not
+        requested
+        """
+        if self.memory is None:
+            return ''
+        (current, peak), snapshot = self.memory
+        text = ['traced memory %.1f kB, peak %.1f kB' % (current / 1024, peak / 1024)]
+        for stat in snapshot.statistics('lineno')[:lines]:
+            text.append(str(stat))
+        return '\n'.join(text)
+
+    def __str__(self):
+        text = ["{:<16} {:<36} {:>7} {:>11} {:>11}".format('stage', 'method', 'calls', 'total/ms', 'own/ms')]
+        for row in self.report():
+            text.append("{:<16} {:<36} {:>7} {:11.3f} {:11.3f}".format(row['stage'], row['method'], row['calls'],
+                                                                        row['total'] * 1e3, row['own'] * 1e3))
+        timed = sum(self.stage_totals().values())
+        text.append('wall time %.3f ms, %.3f ms of it in timed stages' % (self.wall * 1e3, timed * 1e3))
+        return '\n'.join(text)
+
+    def save(self, file_name):
+        """
+        Exports the report, as json if the file name ends in .json and as csv otherwise
+        :param file_name: full name of the output file
+        :return:
+        """
+        if str(file_name).endswith('.json'):
+            with open(file_name, 'w') as json_file:
+                json_file.write(dumps({'wall': self.wall, 'stages': self.stage_totals(), 'methods': self.report()},
+                                      indent=1))
+        else:
+            with open(file_name, 'w', newline='') as csvfile:
+                writer = csv.writer(csvfile)
+                writer.writerow(['stage', 'method', 'calls', 'total', 'own'])
+                for row in self.report():
+                    writer.writerow([row['stage'], row['method'], row['calls'], row['total'], row['own']])
+        return
+
+
+if __name__ == '__main__':
+    from GTC import ureal
+    print('Testing profiling.py')
+    w = 1e4
+    cap = 99.999581e-12
+    g = ureal(1.9e-6 * w * cap, 0.6e-6 / 2 * w * cap, 50, label='ah11c1d')
+    c = ureal(cap, cap * 0.11e-6 / 2, 50, label='ah11c1c')
+    with STAGETIMER(memory=True) as timer:
+        scale = CAPSCALE('G:\\My Drive\\KJ\\PycharmProjects\\CapacitanceScale\\datastore',
+                         ['in.csv', 'leads_and_caps.csv'], 'out.csv', g + 1j * w * c)
+        scale.buildup()
+    print(timer)
+    print(timer.memory_text(5))
@@ -0,0 +1,191 @@
+#  python3.8 som environment
+import csv
+from math import sqrt
+from GTC import multiple_ureal, set_correlation
+
+"""
+Repeated balance readings. Each ratio of in.csv (r1 to r15) or switch position of perm.csv (s1 to s12) can be read
+many times; the readings are accumulated one at a time (Welford's method, extended to the alpha-beta covariance) so a
+log of any length is reduced in a single pass with nothing but the running sums kept. Each set of readings becomes an
+(alpha, beta) pair of ureals, the mean with a Type A standard uncertainty of the mean, n - 1 degrees of freedom and
+the observed correlation, which replaces the exact float pair in a balance_dict.
+"""
+
+
+class WELFORD(object):
+    def __init__(self):
+        """
+        Running count, means and sums of squared deviations of (alpha, beta) readings
+        """
+        self.n = 0
+        self.mean = [0.0, 0.0]
+        self.m2 = [0.0, 0.0]
+        self.c = 0.0  # sum of the products of the alpha and beta deviations
+
+    def add(self, alpha, beta):
+        self.n += 1
+        da = alpha - self.mean[0]
+        db = beta - self.mean[1]
+        self.mean[0] += da / self.n
+        self.mean[1] += db / self.n
+        self.m2[0] += da * (alpha - self.mean[0])
+        self.m2[1] += db * (beta - self.mean[1])
+        self.c += da * (beta - self.mean[1])
+        return
+
+    def merge(self, other):
+        """
+        Combines the readings of another WELFORD object (e.g. from a second log of the same ratio)
+        :param other: WELFORD object
+        :return:
+        """
+        if other.n == 0:
+            return
+        total = self.n + other.n
+        da = other.mean[0] - self.mean[0]
+        db = other.mean[1] - self.mean[1]
+        weight = self.n * other.n / total
+        self.m2[0] += other.m2[0] + da * da * weight
+        self.m2[1] += other.m2[1] + db * db * weight
+        self.c += other.c + da * db * weight
+        self.mean[0] += da * other.n / total
+        self.mean[1] += db * other.n / total
+        self.n = total
+        return
+
+    def variance(self):
+        """
+        :return: sample variances of alpha and beta and their sample covariance
+        """
+        if self.n < 2:
+            return 0.0, 0.0, 0.0
+        return self.m2[0] / (self.n - 1), self.m2[1] / (self.n - 1), self.c / (self.n - 1)
+
+    def balance(self, label):
+        """
+        :param label: e.g. 'r11', giving ureals labelled r11 alpha and r11 beta
+        :return: (alpha, beta) tuple of ureals with the standard uncertainty of the mean and n - 1 degrees of freedom,
+        or the floats of the mean if there is only one reading
+        """
+        assert self.n > 0, 'no readings for %s' % label
+        var_a, var_b, cov = self.variance()
+        if self.n < 2 or (var_a == 0 and var_b == 0):
+            return self.mean[0], self.mean[1]
+        alpha, beta = multiple_ureal(self.mean, [sqrt(var_a / self.n), sqrt(var_b / self.n)], self.n - 1,
+                                     label_seq=[label + ' alpha', label + ' beta'])
+        if var_a > 0 and var_b > 0 and cov != 0:
+            set_correlation(cov / sqrt(var_a * var_b), alpha, beta)
+        return alpha, beta
+
+
+class READINGLOG(object):
+    def __init__(self):
+        self.accumulators = {}  # key: WELFORD object, in the order first read
+
+    def add(self, key, balance):
+        """
+        :param key: e.g. 'r11' or 's3'
+        :param balance: (alpha, beta) floats of one reading
+        :return:
+        """
+        if key not in self.accumulators:
+            self.accumulators[key] = WELFORD()
+        self.accumulators[key].add(balance[0], balance[1])
+        return
+
+    def read(self, file_name, **kwargs):
+        """
+        Accumulates a log of [key, alpha, beta] rows (any other rows are skipped) in one pass
+        :param file_name: full name of the csv log
+        :param kwargs: keys= collection of the keys to take (default all)
+        :return: number of readings taken
+        """
+        keys = None
+        for arg in kwargs.keys():
+            if arg == 'keys':
+                keys = kwargs[arg]
+        count = 0
+        with open(file_name, newline='') as csvfile:
+            for row in csv.reader(csvfile):
+                if len(row) < 3 or (keys is not None and row[0] not in keys):
+                    continue
+                try:
+                    balance = (float(row[1]), float(row[2]))
+                except ValueError:  # e.g. a header or a Date row
+                    continue
+                self.add(row[0], balance)
+                count += 1
+        return count
+
+    def balances(self):
+        """
+        :return: dictionary of key: (alpha, beta), ready to update a CAPSCALE or PERMUTE balance_dict
+        """
+        found = {}
+        for key in self.accumulators:
+            found[key] = self.accumulators[key].balance(key)
+        return found
+
+    def apply(self, target):
+        """
+        Replaces the balances of a CAPSCALE or PERMUTE object with those of the log, for the keys it already has
+        :param target: object with a balance_dict
+        :return: list of the keys replaced
+        """
+        replaced = []
+        found = self.balances()
+        for key in target.balance_dict:
+            if key in found:
+                target.balance_dict[key] = found[key]
+                replaced.append(key)
+        return replaced
+
+    def summary(self):
+        """
+        :return: list of [key, n, mean alpha, mean beta, s(alpha), s(beta)]
+        """
+        rows = []
+        for key in self.accumulators:
+            acc = self.accumulators[key]
+            var_a, var_b, cov = acc.variance()
+            rows.append([key, acc.n, acc.mean[0], acc.mean[1], sqrt(var_a), sqrt(var_b)])
+        return rows
+
+
+def log_reading(file_name, key, balance):
+    """
+    Appends one reading to a csv log
+    :param file_name: full name of the csv log
+    :param key: e.g. 'r11' or 's3'
+    :param balance: (alpha, beta) floats
+    :return:
+    """
+    with open(file_name, 'a', newline='') as csvfile:
+        csv.writer(csvfile).writerow([key, balance[0], balance[1]])
+    return
+
+
+if __name__ == '__main__':
+    from GTC import ureal
+    from GTC.reporting import budget
+    from meas_cap_ratio import CAPSCALE
+    import random
+    print('Testing readings.py')
+    w = 1e4
+    cap = 99.999581e-12
+    g = ureal(1.9e-6 * w * cap, 0.6e-6 / 2 * w * cap, 50, label='ah11c1d')
+    c = ureal(cap, cap * 0.11e-6 / 2, 50, label='ah11c1c')
+    scale = CAPSCALE('G:\\My Drive\\KJ\\PycharmProjects\\CapacitanceScale\\datastore',
+                     ['in.csv', 'leads_and_caps.csv'], 'out.csv', g + 1j * w * c)
+    log = READINGLOG()
+    noise = random.Random(1)
+    for key in scale.balance_dict:  # 50 simulated readings of every ratio
+        for i in range(50):
+            alpha, beta = scale.balance_dict[key]
+            log.add(key, (alpha + noise.gauss(0, 2e-4), beta + noise.gauss(0, 2e-4)))
+    print(log.apply(scale))
+    scale.buildup()
+    capacitance = scale.caps['gr1000a'].best_value.imag / w
+    print('gr1000a', capacitance, 'df', capacitance.df)
+    for l, u, uid in budget(capacitance, trim=0.05):
+        print("{:^20} {:.2e}".format(l, u))
@@ -0,0 +1,409 @@
+#  python3.8 som environment
+from archive import COMPONENTSTORE
+from json import dumps, loads
+from pathlib import Path
+import hashlib
+import sqlite3
+import threading
+
+"""
+SQLite form of COMPONENTSTORE. Leads, capacitors, their uncertain values and the runs that set best values are kept
+in separate tables of one database file, so one capacitor's best value is changed by writing one row rather than
+rewriting a whole csv file. The database is in WAL mode, so readers (e.g. the worker threads of buildup_graph.py or
+another process) are not blocked by a writer. Bulk writes go in one transaction through parameterised statements.
+lookup and iter_component_dicts return the same lead_to_dict and capacitor_to_dict dictionaries as COMPONENTSTORE,
+so find_component and read_components work unchanged with a database file in place of leads_and_caps.csv, as do
+CAPSCALE, DIALCAL, PERMUTE and COMPONENTREGISTRY given storecomp=SQLITESTORE().
+"""
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS uncertain (
+    id INTEGER PRIMARY KEY,
+    label TEXT,
+    xreal REAL NOT NULL,
+    ximag REAL NOT NULL,
+    ureal REAL NOT NULL,
+    uimag REAL NOT NULL,
+    v11 REAL NOT NULL,
+    v12 REAL NOT NULL,
+    v21 REAL NOT NULL,
+    v22 REAL NOT NULL,
+    df REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS leads (
+    id INTEGER PRIMARY KEY,
+    digest TEXT UNIQUE NOT NULL,
+    label TEXT NOT NULL,
+    w REAL NOT NULL,
+    relu REAL NOT NULL,
+    z_id INTEGER NOT NULL REFERENCES uncertain(id),
+    y_id INTEGER NOT NULL REFERENCES uncertain(id)
+);
+CREATE TABLE IF NOT EXISTS lead_keys (
+    key TEXT PRIMARY KEY,
+    lead INTEGER NOT NULL REFERENCES leads(id)
+);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    date TEXT,
+    reference TEXT,
+    source TEXT
+);
+CREATE TABLE IF NOT EXISTS capacitors (
+    key TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    relu REAL NOT NULL,
+    ang_freq REAL NOT NULL,
+    nom_g REAL NOT NULL,
+    nom_c REAL NOT NULL,
+    yhv_g REAL NOT NULL,
+    yhv_c REAL NOT NULL,
+    ylv_g REAL NOT NULL,
+    ylv_c REAL NOT NULL,
+    hv_lead INTEGER NOT NULL REFERENCES leads(id),
+    lv_lead INTEGER NOT NULL REFERENCES leads(id),
+    best_value INTEGER REFERENCES uncertain(id),
+    run INTEGER REFERENCES runs(id)
+);
+'''
+
+CAPACITOR_SQL = '''
+SELECT c.key, c.name, c.relu, c.ang_freq, c.nom_g, c.nom_c, c.yhv_g, c.yhv_c, c.ylv_g, c.ylv_c, c.hv_lead, c.lv_lead,
+       b.label, b.xreal, b.ximag, b.ureal, b.uimag, b.v11, b.v12, b.v21, b.v22, b.df
+FROM capacitors c LEFT JOIN uncertain b ON b.id = c.best_value
+'''
+
+LEAD_SQL = '''
+SELECT l.id, l.label, l.w, l.relu,
+       z.label, z.xreal, z.ximag, z.ureal, z.uimag, z.v11, z.v12, z.v21, z.v22, z.df,
+       y.label, y.xreal, y.ximag, y.ureal, y.uimag, y.v11, y.v12, y.v21, y.v22, y.df
+FROM leads l JOIN uncertain z ON z.id = l.z_id JOIN uncertain y ON y.id = l.y_id
+'''
+
+
+def json_to_row(unc_json):
+    """
+    :param unc_json: json string from GTCSTORE.ucomplex_to_json
+    :return: tuple of the uncertain table columns after id
+    """
+    unc = loads(unc_json)
+    return (unc['label'], unc['xreal'], unc['ximag'], unc['u'][0], unc['u'][1], unc['v'][0], unc['v'][1],
+            unc['v'][2], unc['v'][3], unc['df'])
+
+
+def row_to_json(row):
+    """
+    :param row: the uncertain table columns after id
+    :return: json string as GTCSTORE.ucomplex_to_json would write it
+    """
+    label, xreal, ximag, ureal, uimag, v11, v12, v21, v22, df = row
+    return dumps({'xreal': xreal, 'ximag': ximag, 'u': [ureal, uimag], 'v': [v11, v12, v21, v22], 'df': df,
+                  'label': label})
+
+
+class SQLITESTORE(COMPONENTSTORE):
+    def __init__(self, **kwargs):
+        """
+        :param kwargs: timeout= seconds a writer waits for another writer (default 30)
+        """
+        COMPONENTSTORE.__init__(self)
+        self.timeout = 30.0
+        for arg in kwargs.keys():
+            if arg == 'timeout':
+                self.timeout = kwargs[arg]
+        self.local = threading.local()  # sqlite3 connections can only be used by the thread that made them
+
+    def connect(self, file_name):
+        """
+        :param file_name: full name of the database file, made with the tables if it does not exist
+        :return: sqlite3 connection of this thread to the database
+        """
+        name = str(Path(file_name).resolve())
+        connections = getattr(self.local, 'connections', None)
+        if connections is None:
+            connections = self.local.connections = {}
+        if name not in connections:
+            db = sqlite3.connect(name, timeout=self.timeout)
+            db.execute('PRAGMA journal_mode=WAL')  # readers see the last commit while a write is under way
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute('PRAGMA foreign_keys=ON')
+            db.executescript(SCHEMA)
+            connections[name] = db
+        return connections[name]
+
+    def close(self):
+        """
+        Closes the connections of this thread
+        :return:
+        """
+        for db in getattr(self.local, 'connections', {}).values():
+            db.close()
+        self.local.connections = {}
+        return
+
+    def file_version(self, file_name):
+        """
+        :param file_name: full name of the database file
+        :return: size and modification time of the database and its write ahead log, as commits go to the log first
+        """
+        version = COMPONENTSTORE.file_version(self, file_name)
+        wal = Path(str(file_name) + '-wal')
+        if wal.exists():
+            version += COMPONENTSTORE.file_version(self, wal)
+        return version
+
+    def insert_uncertain(self, db, unc_json):
+        cursor = db.execute('INSERT INTO uncertain (label, xreal, ximag, ureal, uimag, v11, v12, v21, v22, df) '
+                            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', json_to_row(unc_json))
+        return cursor.lastrowid
+
+    def insert_lead(self, db, filed, key=None):
+        """
+        Leads are stored once however many capacitors use them, identified by the sha1 digest of their dictionary
+        :param db: connection, in a transaction
+        :param filed: dictionary in the form of lead_to_dict
+        :param key: key of the lead in the store, None for a lead only known as part of a capacitor
+        :return: id of the lead row
+        """
+        digest = hashlib.sha1(dumps(filed, sort_keys=True).encode()).hexdigest()
+        found = db.execute('SELECT id FROM leads WHERE digest = ?', (digest,)).fetchone()
+        if found is None:
+            z_id = self.insert_uncertain(db, filed['z'])
+            y_id = self.insert_uncertain(db, filed['y'])
+            cursor = db.execute('INSERT INTO leads (digest, label, w, relu, z_id, y_id) VALUES (?, ?, ?, ?, ?, ?)',
+                                (digest, filed['label'], filed['w'], filed['relu'], z_id, y_id))
+            found = (cursor.lastrowid,)
+        if key is not None:  # several keys can name the same lead
+            db.execute('INSERT OR REPLACE INTO lead_keys (key, lead) VALUES (?, ?)', (key, found[0]))
+        return found[0]
+
+    def add_run(self, file_name, date, reference, **kwargs):
+        """
+        :param file_name: full name of the database file
+        :param date: e.g. the Date row of in.csv
+        :param reference: e.g. the Reference row of in.csv
+        :param kwargs: source= e.g. the run file name
+        :return: id of the run
+        """
+        source = None
+        for arg in kwargs.keys():
+            if arg == 'source':
+                source = kwargs[arg]
+        db = self.connect(file_name)
+        with db:
+            cursor = db.execute('INSERT INTO runs (date, reference, source) VALUES (?, ?, ?)',
+                                (date, reference, source))
+        return cursor.lastrowid
+
+    def save_dicts(self, file_name, items, **kwargs):
+        """
+        Adds or replaces components in one transaction
+        :param file_name: full name of the database file
+        :param items: iterable of (key, dictionary) tuples in the form of lead_to_dict or capacitor_to_dict, e.g. from
+        COMPONENTSTORE.iter_component_dicts
+        :param kwargs: run= id of the run from add_run that set the best values
+        :return: number of components saved
+        """
+        run = None
+        for arg in kwargs.keys():
+            if arg == 'run':
+                run = kwargs[arg]
+        db = self.connect(file_name)
+        capacitors = []
+        with db:  # one transaction, rolled back if anything fails
+            db.execute('BEGIN IMMEDIATE')  # take the write lock before reading the rows to be replaced
+            for key, filed in items:
+                if 'nom_cap' not in filed:
+                    self.insert_lead(db, filed, key)
+                    continue
+                hv = self.insert_lead(db, filed['hv_lead'])
+                lv = self.insert_lead(db, filed['lv_lead'])
+                best = None
+                if filed['flag'] == 'best value set':
+                    best = self.insert_uncertain(db, filed['best_value'])
+                capacitors.append((key, filed['name'], filed['relu'], filed['ang_freq'], filed['nom_cap'][0],
+                                   filed['nom_cap'][1], filed['yhv'][0], filed['yhv'][1], filed['ylv'][0],
+                                   filed['ylv'][1], hv, lv, best, run if best is not None else None))
+            replaced = [db.execute('SELECT best_value FROM capacitors WHERE key = ?', (x[0],)).fetchone()
+                        for x in capacitors]
+            db.executemany('INSERT OR REPLACE INTO capacitors VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           capacitors)
+            db.executemany('DELETE FROM uncertain WHERE id = ?', [x for x in replaced if x and x[0] is not None])
+            self.delete_unused_leads(db)
+        return len(capacitors)
+
+    def delete_unused_leads(self, db):
+        """
+        Deletes the leads that no capacitor or lead key refers to any more, with their uncertain rows
+        :param db: connection, in a transaction
+        :return: number of leads deleted
+        """
+        unused = db.execute('SELECT id, z_id, y_id FROM leads WHERE id NOT IN (SELECT hv_lead FROM capacitors) '
+                            'AND id NOT IN (SELECT lv_lead FROM capacitors) '
+                            'AND id NOT IN (SELECT lead FROM lead_keys)').fetchall()
+        db.executemany('DELETE FROM leads WHERE id = ?', [(x[0],) for x in unused])
+        db.executemany('DELETE FROM uncertain WHERE id = ?', [(x[i],) for x in unused for i in (1, 2)])
+        return len(unused)
+
+    def import_csv(self, file_name, csv_file_name):
+        """
+        :param file_name: full name of the database file
+        :param csv_file_name: full name of a [key, json string] csv file such as leads_and_caps.csv
+        :return: number of capacitors saved
+        """
+        return self.save_dicts(file_name, COMPONENTSTORE.iter_component_dicts(self, csv_file_name))
+
+    def save_components(self, file_name, caps, leads, **kwargs):
+        """
+        :param file_name: full name of the database file
+        :param caps: dictionary of CAPACITOR objects
+        :param leads: dictionary of LEAD objects
+        :param kwargs: run= id of the run from add_run
+        :return: number of capacitors saved
+        """
+        items = [(x, self.lead_to_dict(leads[x])) for x in leads]
+        items += [(x, self.capacitor_to_dict(caps[x])) for x in caps]
+        return self.save_dicts(file_name, items, **kwargs)
+
+    def store_buildup(self, file_name, scale):
+        """
+        Records the best values of a build up as one run, the database form of CAPSCALE.store_buildup
+        :param file_name: full name of the database file
+        :param scale: a meas_cap_ratio.CAPSCALE object after buildup()
+        :return: id of the run
+        """
+        run = self.add_run(file_name, scale.date_string, scale.reference_string)
+        self.save_components(file_name, scale.caps, {}, run=run)
+        return run
+
+    def update_best_value(self, file_name, key, value, **kwargs):
+        """
+        Replaces the best value of one capacitor, writing only its uncertain row (and the run of the capacitor row)
+        :param file_name: full name of the database file
+        :param key: key of the capacitor
+        :param value: ucomplex best value
+        :param kwargs: run= id of the run from add_run
+        :return:
+        """
+        run = None
+        for arg in kwargs.keys():
+            if arg == 'run':
+                run = kwargs[arg]
+        row = json_to_row(self.gs.ucomplex_to_json(value))
+        db = self.connect(file_name)
+        with db:  # committed, or rolled back if anything fails
+            db.execute('BEGIN IMMEDIATE')  # take the write lock before reading the row to be changed
+            found = db.execute('SELECT best_value FROM capacitors WHERE key = ?', (key,)).fetchone()
+            if found is None:
+                raise KeyError('%r not found in %s' % (key, file_name))
+            if found[0] is None:
+                best = self.insert_uncertain(db, self.gs.ucomplex_to_json(value))
+                db.execute('UPDATE capacitors SET best_value = ?, run = ? WHERE key = ?', (best, run, key))
+            else:
+                db.execute('UPDATE uncertain SET label = ?, xreal = ?, ximag = ?, ureal = ?, uimag = ?, v11 = ?, '
+                           'v12 = ?, v21 = ?, v22 = ?, df = ? WHERE id = ?', row + (found[0],))
+                if run is not None:
+                    db.execute('UPDATE capacitors SET run = ? WHERE key = ?', (run, key))
+        return
+
+    def leads_by_id(self, db, ids):
+        """
+        :param db: connection
+        :param ids: collection of lead row ids
+        :return: dictionary of id: dictionary in the form of lead_to_dict
+        """
+        found = {}
+        ids = list(ids)
+        for start in range(0, len(ids), 500):  # keep within the SQLite limit on parameters
+            chunk = ids[start:start + 500]
+            sql = LEAD_SQL + ' WHERE l.id IN (%s)' % ', '.join('?' * len(chunk))
+            for row in db.execute(sql, chunk):
+                found[row[0]] = {'relu': row[3], 'w': row[2], 'label': row[1], 'z': row_to_json(row[4:14]),
+                                 'y': row_to_json(row[14:24])}
+        return found
+
+    def capacitor_dicts(self, db, rows):
+        """
+        :param db: connection
+        :param rows: rows of CAPACITOR_SQL
+        :return: list of (key, dictionary in the form of capacitor_to_dict)
+        """
+        leads = self.leads_by_id(db, set(x[10] for x in rows) | set(x[11] for x in rows))
+        found = []
+        for row in rows:
+            filed = {'relu': row[2], 'name': row[1], 'nom_cap': (row[4], row[5]), 'yhv': (row[6], row[7]),
+                     'ylv': (row[8], row[9]), 'ang_freq': row[3], 'lv_lead': leads[row[11]],
+                     'hv_lead': leads[row[10]]}
+            if row[13] is not None:
+                filed['best_value'] = row_to_json(row[12:22])
+                filed['flag'] = 'best value set'
+            else:
+                filed['flag'] = 'no best value set'
+            found.append((row[0], filed))
+        return found
+
+    def lookup(self, file_name, keys):
+        """
+        Drop in for COMPONENTSTORE.lookup with a database file
+        :param file_name: full name of the database file
+        :param keys: collection of the keys wanted, any not in the database are left out
+        :return: dictionary of key: dictionary in the form of lead_to_dict or capacitor_to_dict
+        """
+        keys = list(keys)
+        db = self.connect(file_name)
+        found = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            marks = ', '.join('?' * len(chunk))
+            rows = db.execute(CAPACITOR_SQL + ' WHERE c.key IN (%s)' % marks, chunk).fetchall()
+            found.update(self.capacitor_dicts(db, rows))
+            ids = dict(db.execute('SELECT key, lead FROM lead_keys WHERE key IN (%s)' % marks, chunk).fetchall())
+            leads = self.leads_by_id(db, ids.values())
+            for x in ids:
+                found[x] = leads[ids[x]]
+        return found
+
+    def iter_component_dicts(self, file_name, **kwargs):
+        """
+        Drop in for COMPONENTSTORE.iter_component_dicts with a database file
+        :param file_name: full name of the database file
+        :param kwargs: keys= collection of the components wanted (default all)
+        :return: yields (key, dictionary) tuples, leads first
+        """
+        for arg in kwargs.keys():
+            if arg == 'keys':
+                found = self.lookup(file_name, kwargs[arg])
+                for x in found:
+                    yield x, found[x]
+                return
+        db = self.connect(file_name)
+        ids = db.execute('SELECT key, lead FROM lead_keys ORDER BY rowid').fetchall()
+        leads = self.leads_by_id(db, [x[1] for x in ids])
+        for key, lead_id in ids:
+            yield key, leads[lead_id]
+        for item in self.capacitor_dicts(db, db.execute(CAPACITOR_SQL + ' ORDER BY c.rowid').fetchall()):
+            yield item
+
+    def build_index(self, file_name):
+        raise TypeError('%s is a database, it needs no index' % file_name)
+
+    def load_index(self, file_name):
+        raise TypeError('%s is a database, it needs no index' % file_name)
+
+
+if __name__ == '__main__':
+    from GTC import ureal
+    from meas_cap_ratio import CAPSCALE
+    print('Testing sqlite_store.py')
+    folder = Path('G:\\My Drive\\KJ\\PycharmProjects\\CapacitanceScale\\datastore')
+    db_store = SQLITESTORE()
+    print(db_store.import_csv(folder / 'leads_and_caps.db', folder / 'leads_and_caps.csv'), 'capacitors imported')
+    w = 1e4
+    cap = 99.999581e-12
+    g = ureal(1.9e-6 * w * cap, 0.6e-6 / 2 * w * cap, 50, label='ah11c1d')
+    c = ureal(cap, cap * 0.11e-6 / 2, 50, label='ah11c1c')
+    scale = CAPSCALE(folder, ['in.csv', 'leads_and_caps.db'], 'out.csv', g + 1j * w * c, storecomp=db_store)
+    scale.buildup()
+    print('run', db_store.store_buildup(folder / 'leads_and_caps.db', scale))
+    db_store.update_best_value(folder / 'leads_and_caps.db', 'gr10', scale.caps['gr10'].best_value)
+    print(db_store.find_component(folder / 'leads_and_caps.db', 'gr10')['best_value'])
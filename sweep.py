@@ -0,0 +1,173 @@
+#  python3.8 som environment
+import numpy as np
+from components import pi_correction
+
+"""
+Frequency sweeps of lead corrections. The classes take the same R, L and G, C tuples as LEAD and CAPACITOR but no
+angular frequency; every method evaluates nominal complex values for a whole NumPy array of angular frequencies.
+"""
+
+
+class LEADSWEEP(object):
+    def __init__(self, name, series_z, parallel_y):
+        """
+        Pi transform of a cable at any angular frequency
+        :param name: label to identify cable
+        :param series_z: series impedance as tuple of resistance (ohm) and inductance (H)
+        :param parallel_y: admittance of cable as tuple of conductance (S) and capacitance (F)
+        """
+        self.label = name
+        self.series_z = series_z
+        self.parallel_y = parallel_y
+
+    def z(self, w):
+        """
+        :param w: array of angular frequencies in radians per second
+        :return: array of series impedance
+        """
+        return self.series_z[0] + 1j * self.series_z[1] * np.asarray(w, dtype=float)
+
+    def y(self, w):
+        """
+        :param w: array of angular frequencies in radians per second
+        :return: array of admittance to screen
+        """
+        return self.parallel_y[0] + 1j * self.parallel_y[1] * np.asarray(w, dtype=float)
+
+
+class CONNECTSWEEP(object):
+    def __init__(self, lead1, lead2):
+        """
+        Two LEADSWEEP objects in series, as CONNECT
+        :param lead1: LEADSWEEP object
+        :param lead2: LEADSWEEP object
+        """
+        self.label = lead1.label + lead2.label
+        self.lead1 = lead1
+        self.lead2 = lead2
+
+    def z(self, w):
+        return self.lead1.z(w) + self.lead2.z(w)
+
+    def y(self, w):
+        return self.lead1.y(w) + self.lead2.y(w)
+
+
+class CAPACITORSWEEP(object):
+    def __init__(self, name, nom_cap, yhv, ylv, hv_lead, lv_lead):
+        """
+        Two terminal-pair capacitor at any angular frequency
+        :param name: label to identify capacitor
+        :param nom_cap: the main capacitor as a tuple of conductance and capacitance
+        :param yhv: additional admittance to screen at the HV terminal as a tuple of conductance and capacitance
+        :param ylv: additional admittance to screen at the LV terminal as a tuple of conductance and capacitance
+        :param hv_lead: LEADSWEEP or CONNECTSWEEP object
+        :param lv_lead: LEADSWEEP or CONNECTSWEEP object
+        """
+        self.label = name
+        self.nom_cap = nom_cap
+        self.yhv = yhv
+        self.ylv = ylv
+        self.hvlead = hv_lead
+        self.lvlead = lv_lead
+
+    def y13(self, w):
+        return self.nom_cap[0] + 1j * self.nom_cap[1] * np.asarray(w, dtype=float)
+
+    def y12(self, w):
+        return self.yhv[0] + 1j * self.yhv[1] * np.asarray(w, dtype=float)
+
+    def y34(self, w):
+        return self.ylv[0] + 1j * self.ylv[1] * np.asarray(w, dtype=float)
+
+    def lead_correction(self, w):
+        """
+        :param w: array of angular frequencies in radians per second
+        :return: array of corrections so that true Y = measured Y + correction at each frequency
+        """
+        return pi_correction(self.hvlead.z(w), self.hvlead.y(w), self.lvlead.z(w), self.lvlead.y(w), self.y12(w),
+                             self.y34(w), self.y13(w))
+
+    def set_new_leads(self, hv, lv):
+        self.hvlead = hv
+        self.lvlead = lv
+        return
+
+
+class PARALLELSWEEP(CAPACITORSWEEP):
+    def __init__(self, cap1, cap2, hv_common, lv_lead):
+        """
+        Two CAPACITORSWEEP objects in parallel with their own leads paralleled, as PARALLEL
+        :param cap1: CAPACITORSWEEP object
+        :param cap2: CAPACITORSWEEP object
+        :param hv_common: LEADSWEEP object
+        :param lv_lead: LEADSWEEP object
+        """
+        self.cap1 = cap1
+        self.cap2 = cap2
+        CAPACITORSWEEP.__init__(self, cap1.label + cap2.label, None, None, None, hv_common, lv_lead)
+
+    def y13(self, w):
+        return self.cap1.y13(w) + self.cap2.y13(w)
+
+    def y12(self, w):  # add paralleled lead admittance to screen admittance of capacitor
+        return self.cap1.y12(w) + self.cap2.y12(w) + self.cap1.hvlead.y(w) + self.cap2.hvlead.y(w)
+
+    def y34(self, w):
+        return self.cap1.y34(w) + self.cap2.y34(w) + self.cap1.lvlead.y(w) + self.cap2.lvlead.y(w)
+
+
+def lead_sweep(lead):
+    """
+    Recovers the R, L and G, C tuples of a LEAD or CONNECT object
+    :param lead: LEAD or CONNECT object
+    :return: LEADSWEEP object
+    """
+    z = lead.z.x
+    y = lead.y.x
+    return LEADSWEEP(lead.label, (z.real, z.imag / lead.w), (y.real, y.imag / lead.w))
+
+
+def capacitor_sweep(cap):
+    """
+    Recovers the conductance and capacitance tuples of a CAPACITOR (or PARALLEL) object and its leads
+    :param cap: CAPACITOR object
+    :return: CAPACITORSWEEP object
+    """
+    y13 = cap.y13.x
+    y12 = cap.y12.x
+    y34 = cap.y34.x
+    return CAPACITORSWEEP(cap.label, (y13.real, y13.imag / cap.w), (y12.real, y12.imag / cap.w),
+                          (y34.real, y34.imag / cap.w), lead_sweep(cap.hvlead), lead_sweep(cap.lvlead))
+
+
+def sweep_corrections(caps, w):
+    """
+    Lead corrections of many capacitors over a frequency sweep
+    :param caps: dictionary of CAPACITORSWEEP objects
+    :param w: array of angular frequencies in radians per second
+    :return: list of keys and a complex array with one row of corrections per capacitor
+    """
+    keys = list(caps.keys())
+    w = np.asarray(w, dtype=float)
+    table = np.empty((len(keys), w.size), dtype=complex)
+    for i, x in enumerate(keys):
+        table[i] = caps[x].lead_correction(w)
+    return keys, table
+
+
+if __name__ == '__main__':
+    from components import LEAD, CAPACITOR
+    print('Testing sweep.py')
+    hv1 = LEADSWEEP('ah11hv1', (286e-3, 0.782e-6), (0.28e-9, 255.2e-12))
+    lv1 = LEADSWEEP('ah11lv1', (302e-3, 0.616e-6), (0.20e-9, 93.6e-12))
+    ah11a1 = CAPACITORSWEEP('AH11A1', (0.0, 10e-12), (1.62e-9, 84.2e-12), (0.72e-9, 120.8e-12), hv1, lv1)
+    w = 2 * np.pi * np.logspace(2, 5, 31)
+    correction = ah11a1.lead_correction(w)
+    for f, corr in zip(w / (2 * np.pi), correction):
+        print("{:10.1f} Hz {:12.4e} ppm".format(f, corr.imag / ah11a1.y13(2 * np.pi * f).imag * 1e6))
+    # check against the single frequency classes
+    one = CAPACITOR('AH11A1', (0.0, 10e-12), (1.62e-9, 84.2e-12), (0.72e-9, 120.8e-12), 1e4,
+                    LEAD('ah11hv1', (286e-3, 0.782e-6), (0.28e-9, 255.2e-12), 1e4, 0.05),
+                    LEAD('ah11lv1', (302e-3, 0.616e-6), (0.20e-9, 93.6e-12), 1e4, 0.05), 0.01)
+    print(one.lead_correction().x, ah11a1.lead_correction([1e4])[0])